@@ -0,0 +1,237 @@
+"""
+Offline benchmarks of the wrapper, ran against a fake GitLab and a stub Docker executable.
+
+Usage: python -m benchmarks.benchmark --output results.json [--baseline previous-results.json]
+"""
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+
+import yaml
+from typing import Dict, List, NamedTuple, Any, Optional
+
+from dockerwithgitlabsecrets.configuration import GITLAB_PROPERTY, GITLAB_URL_PROPERTY, GITLAB_TOKEN_PROPERTY, \
+    GITLAB_PROJECT_PROPERTY
+from dockerwithgitlabsecrets.testsupport.fakegitlab import FakeGitLab
+
+_TOKEN = "benchmark-token"
+_PROJECT = "benchmark/project"
+_PASS_THROUGH_ARGUMENTS = ["version"]
+_RUN_ARGUMENTS = ["run", "--rm", "alpine", "true"]
+
+# Stub that reads the env file, as Docker would, then exits
+_STUB_DOCKER = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = "--env-file" ]; then
+        cat "$2" > /dev/null
+        shift
+    fi
+    shift
+done
+"""
+
+
+class BenchmarkParameters(NamedTuple):
+    """
+    Benchmark parameters.
+    """
+    latency: float = 0.05
+    per_page: int = 100
+    variables: int = 50
+    value_size: int = 32
+    repetitions: int = 20
+    concurrency: int = 8
+    concurrent_invocations: int = 64
+
+
+class Invocation(NamedTuple):
+    """
+    Measurements of a wrapper invocation.
+    """
+    duration: float
+    returncode: int
+    max_rss_kib: int
+
+
+class BenchmarkEnvironment:
+    """
+    Fake GitLab, stub Docker and configuration that the wrapper is benchmarked against.
+    """
+    def __init__(self, parameters: BenchmarkParameters):
+        self.parameters = parameters
+        self.gitlab = FakeGitLab(_TOKEN, latency=parameters.latency, max_per_page=parameters.per_page)
+        self.gitlab.set_project_variables(
+            _PROJECT, {f"VARIABLE_{i}": "x" * parameters.value_size for i in range(parameters.variables)})
+        self._temp_directory = mkdtemp()
+        self.environment: Dict[str, str] = {}
+        self.configuration_location = os.path.join(self._temp_directory, "config.yml")
+
+    def __enter__(self) -> "BenchmarkEnvironment":
+        self.gitlab.start()
+        bin_directory = os.path.join(self._temp_directory, "bin")
+        os.mkdir(bin_directory)
+        docker_location = os.path.join(bin_directory, "docker")
+        with open(docker_location, "w") as file:
+            file.write(_STUB_DOCKER)
+        os.chmod(docker_location, 0o700)
+
+        with open(self.configuration_location, "w") as file:
+            yaml.dump({GITLAB_PROPERTY: {GITLAB_URL_PROPERTY: self.gitlab.url, GITLAB_TOKEN_PROPERTY: _TOKEN,
+                                         GITLAB_PROJECT_PROPERTY: _PROJECT}}, file)
+
+        self.environment = dict(os.environ)
+        self.environment["PATH"] = f"{bin_directory}{os.pathsep}{os.environ.get('PATH', '')}"
+        self.environment["XDG_CACHE_HOME"] = os.path.join(self._temp_directory, "cache")
+        self.environment["XDG_RUNTIME_DIR"] = os.path.join(self._temp_directory, "runtime")
+        self.environment["PYTHONPATH"] = os.pathsep.join(sys.path)
+        self.environment.pop("DWGS_PROFILE", None)
+        return self
+
+    def __exit__(self, *args):
+        self.gitlab.stop()
+        shutil.rmtree(self._temp_directory)
+
+    def invoke(self, docker_arguments: List[str]) -> Invocation:
+        """
+        Invokes the wrapper with the given Docker arguments.
+        :param docker_arguments: the Docker arguments
+        :return: measurements of the invocation
+        """
+        started_at = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "dockerwithgitlabsecrets.entrypoint", "--dwgs-config", self.configuration_location]
+            + docker_arguments, env=self.environment, stdout=subprocess.DEVNULL)
+        _, status, resource_usage = os.wait4(process.pid, 0)
+        duration = time.monotonic() - started_at
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise RuntimeError(f"Wrapper invocation with {docker_arguments} failed with {process.returncode}")
+        return Invocation(duration=duration, returncode=process.returncode, max_rss_kib=resource_usage.ru_maxrss)
+
+
+def summarise(durations: List[float]) -> Dict[str, float]:
+    """
+    Summarises the given durations.
+    :param durations: the durations (in seconds)
+    :return: summary statistics
+    """
+    ordered = sorted(durations)
+    return {
+        "mean": statistics.mean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "min": ordered[0],
+        "max": ordered[-1]
+    }
+
+
+def run_benchmarks(parameters: BenchmarkParameters) -> Dict[str, Any]:
+    """
+    Runs the benchmarks.
+    :param parameters: the benchmark parameters
+    :return: the (JSON) results
+    """
+    invocations: List[Invocation] = []
+    with BenchmarkEnvironment(parameters) as environment:
+        startup = [environment.invoke(_PASS_THROUGH_ARGUMENTS) for _ in range(parameters.repetitions)]
+        latency = [environment.invoke(_RUN_ARGUMENTS) for _ in range(parameters.repetitions)]
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=parameters.concurrency) as executor:
+            concurrent = list(executor.map(lambda _: environment.invoke(_RUN_ARGUMENTS),
+                                           range(parameters.concurrent_invocations)))
+        concurrent_duration = time.monotonic() - started_at
+        invocations += startup + latency + concurrent
+        gitlab_requests = len(environment.gitlab.requests)
+
+    return {
+        "commit": _get_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "parameters": parameters._asdict(),
+        "results": {
+            "startup": summarise([invocation.duration for invocation in startup]),
+            "latency": summarise([invocation.duration for invocation in latency]),
+            "throughput": {
+                "concurrency": parameters.concurrency,
+                "invocations": parameters.concurrent_invocations,
+                "duration": concurrent_duration,
+                "per_second": parameters.concurrent_invocations / concurrent_duration,
+                "latency": summarise([invocation.duration for invocation in concurrent])
+            },
+            "peak_rss_kib": max(invocation.max_rss_kib for invocation in invocations),
+            "gitlab_requests": gitlab_requests
+        }
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    Compares the given results with those of a baseline run.
+    :param results: the results
+    :param baseline: the baseline results
+    :return: lines describing the relative change of each headline measurement
+    """
+    def headline(run: Dict[str, Any]) -> Dict[str, float]:
+        return {
+            "startup median (s)": run["results"]["startup"]["median"],
+            "latency median (s)": run["results"]["latency"]["median"],
+            "throughput (invocations/s)": run["results"]["throughput"]["per_second"],
+            "peak RSS (KiB)": run["results"]["peak_rss_kib"]
+        }
+
+    lines = []
+    for (name, value), baseline_value in zip(headline(results).items(), headline(baseline).values()):
+        change = (value - baseline_value) / baseline_value * 100 if baseline_value else float("nan")
+        lines.append(f"{name}: {baseline_value:.4g} -> {value:.4g} ({change:+.1f}%)")
+    return lines
+
+
+def _get_commit() -> Optional[str]:
+    """
+    Gets the commit of the code being benchmarked.
+    :return: the commit hash or `None` if it cannot be determined
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Main method.
+    """
+    defaults = BenchmarkParameters()
+    parser = ArgumentParser(description="Docker With GitLab Secrets offline benchmarks")
+    parser.add_argument("--output", type=str, help="file to write the JSON results to (printed if not given)")
+    parser.add_argument("--baseline", type=str, help="JSON results of a previous run to compare against")
+    for field, default in defaults._asdict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default,
+                            help=f"(default: {default})")
+    arguments = vars(parser.parse_args())
+
+    parameters = BenchmarkParameters(**{field: arguments[field] for field in BenchmarkParameters._fields})
+    results = run_benchmarks(parameters)
+
+    if arguments["output"] is not None:
+        with open(arguments["output"], "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if arguments["baseline"] is not None:
+        with open(arguments["baseline"], "r") as file:
+            print("\n".join(compare(results, json.load(file))))
+
+
+if __name__ == "__main__":
+    main()
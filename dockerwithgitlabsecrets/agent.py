@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+from typing import Callable, Dict, Optional, Tuple
+
+from dockerwithgitlabsecrets.cache import CacheEntry, CacheStatus, ensure_private_directory
+from dockerwithgitlabsecrets.configuration import Configuration, GitLabConfiguration
+
+URL_PROPERTY = "url"
+PROJECT_PROPERTY = "project"
+REFRESH_PROPERTY = "refresh"
+VARIABLES_PROPERTY = "variables"
+STATUS_PROPERTY = "status"
+ERROR_PROPERTY = "error"
+
+DEFAULT_CLIENT_TIMEOUT = 30.0
+
+_SOCKET_MODE = 0o600
+_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+_PEER_CREDENTIALS_FORMAT = "3i"
+_ENCODING = "utf-8"
+
+ProjectVariablesFetcher = Callable[[GitLabConfiguration, str], Dict[str, str]]
+
+_logger = logging.getLogger(__name__)
+
+
+class AgentError(Exception):
+    """
+    Error reported by the secrets agent.
+    """
+
+
+class _InFlightFetch:
+    """
+    Fetch of a project's variables that requests for the same project wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.variables: Dict[str, str] = None
+        self.error: Exception = None
+
+
+class SecretsAgent:
+    """
+    Agent that serves project variables to local clients over a Unix socket, holding the variables in memory and
+    collapsing concurrent requests for the same project into one fetch.
+    """
+    def __init__(self, configuration: Configuration, fetcher: ProjectVariablesFetcher):
+        """
+        Constructor.
+        :param configuration: the program configuration
+        :param fetcher: fetches the variables of a project from GitLab
+        """
+        self.configuration = configuration
+        self._fetcher = fetcher
+        self._cache: Dict[str, CacheEntry] = {}
+        self._in_flight: Dict[str, _InFlightFetch] = {}
+        self._lock = threading.Lock()
+        self._server: ThreadingUnixStreamServer = None
+
+    def get_variables(self, project: str, refresh: bool=False) -> Tuple[Dict[str, str], CacheStatus]:
+        """
+        Gets the variables of the given project, fetching them if they are not held or have expired.
+        :param project: the namespaced project (or group)
+        :param refresh: whether to fetch the variables even if they are held
+        :return: tuple where the first element is the variables and the second is how they were retrieved
+        """
+        with self._lock:
+            entry = self._cache.get(project)
+            if entry is not None and not refresh and entry.age() <= self.configuration.agent.ttl:
+                return entry.variables, CacheStatus.HIT
+            in_flight = self._in_flight.get(project)
+            leader = in_flight is None
+            if leader:
+                in_flight = _InFlightFetch()
+                self._in_flight[project] = in_flight
+
+        if leader:
+            try:
+                in_flight.variables = self._fetcher(self.configuration.gitlab, project)
+                with self._lock:
+                    self._cache[project] = CacheEntry(variables=in_flight.variables, fetched=time.time())
+            except Exception as e:
+                in_flight.error = e
+            finally:
+                with self._lock:
+                    del self._in_flight[project]
+                in_flight.done.set()
+        else:
+            in_flight.done.wait()
+
+        if in_flight.error is not None:
+            raise in_flight.error
+        return in_flight.variables, CacheStatus.REFRESH if refresh else CacheStatus.MISS
+
+    def serve(self):
+        """
+        Serves requests on the configured socket until `shutdown` is called (or the process is interrupted).
+        """
+        self._prepare_socket_location()
+        previous_umask = os.umask(0o777 ^ _SOCKET_MODE)
+        try:
+            self._server = ThreadingUnixStreamServer(self.configuration.agent.socket, _create_request_handler(self))
+        finally:
+            os.umask(previous_umask)
+        self._server.daemon_threads = True
+        _logger.info(f"Secrets agent listening on {self.configuration.agent.socket}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(self.configuration.agent.socket)
+
+    def shutdown(self):
+        """
+        Stops the agent serving requests (must be called from a different thread to `serve`).
+        """
+        if self._server is not None:
+            self._server.shutdown()
+
+    def handle(self, request: Dict) -> Dict:
+        """
+        Handles the given request from a client.
+        :param request: the request
+        :return: the response
+        """
+        url = request.get(URL_PROPERTY, "")
+        if url.rstrip("/") != self.configuration.gitlab.url.rstrip("/"):
+            return {ERROR_PROPERTY: f"Agent serves variables from {self.configuration.gitlab.url}, not {url}"}
+        try:
+            variables, status = self.get_variables(request[PROJECT_PROPERTY], request.get(REFRESH_PROPERTY, False))
+        except Exception as e:
+            _logger.warning(f"Could not get variables for request {request}: {e}")
+            return {ERROR_PROPERTY: str(e)}
+        _logger.info(f"Variables {status.value} for project \"{request[PROJECT_PROPERTY]}\"")
+        return {VARIABLES_PROPERTY: variables, STATUS_PROPERTY: status.value}
+
+    def _prepare_socket_location(self):
+        """
+        Prepares the location of the socket, removing the socket left by an agent that is no longer running.
+        """
+        location = self.configuration.agent.socket
+        if not ensure_private_directory(os.path.dirname(location)):
+            raise AgentError(f"Socket directory of \"{location}\" is not private")
+        if os.path.exists(location):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as existing_socket:
+                try:
+                    existing_socket.connect(location)
+                except ConnectionRefusedError:
+                    os.remove(location)
+                    return
+            raise AgentError(f"Agent is already listening on {location}")
+
+
+def _create_request_handler(agent: SecretsAgent) -> type:
+    """
+    Creates a handler of client connections to the given agent.
+    :param agent: the agent
+    :return: the request handler class
+    """
+    class RequestHandler(StreamRequestHandler):
+        def handle(self):
+            if not _is_same_user(self.connection):
+                _logger.warning("Rejected connection from a different user")
+                return
+            line = self.rfile.readline(_MAX_MESSAGE_SIZE)
+            try:
+                request = json.loads(line.decode(_ENCODING))
+                response = agent.handle(request)
+            except (ValueError, KeyError, AttributeError) as e:
+                response = {ERROR_PROPERTY: f"Invalid request: {e}"}
+            self.wfile.write(json.dumps(response).encode(_ENCODING) + b"\n")
+
+    return RequestHandler
+
+
+def _is_same_user(connection: socket.socket) -> bool:
+    """
+    Gets whether the peer of the given connection is running as the same user as this process.
+    :param connection: the Unix socket connection
+    :return: whether the peer is the same user (`True` if it cannot be determined as the socket's permissions also
+    restrict access)
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize(_PEER_CREDENTIALS_FORMAT))
+    _, uid, _ = struct.unpack(_PEER_CREDENTIALS_FORMAT, credentials)
+    return uid == os.getuid()
+
+
+class AgentClient:
+    """
+    Client of a secrets agent.
+    """
+    def __init__(self, socket_location: str, timeout: Optional[float]=DEFAULT_CLIENT_TIMEOUT):
+        """
+        Constructor.
+        :param socket_location: location of the agent's socket
+        :param timeout: seconds to wait for the agent to respond
+        """
+        self.socket_location = socket_location
+        self.timeout = timeout
+
+    def is_available(self) -> bool:
+        """
+        Gets whether an agent may be listening on the socket.
+        :return: whether the socket exists
+        """
+        return os.path.exists(self.socket_location)
+
+    def get(self, url: str, project: str, refresh: bool=False) -> Dict[str, str]:
+        """
+        Gets the variables of the given project from the agent.
+        :param url: the URL of the GitLab instance the variables are to come from
+        :param project: the namespaced project (or group)
+        :param refresh: whether the agent should fetch the variables even if it holds them
+        :return: the project's variables
+        :raises AgentError: if the agent could not get the variables
+        :raises OSError: if the agent could not be communicated with
+        """
+        request = {URL_PROPERTY: url, PROJECT_PROPERTY: project, REFRESH_PROPERTY: refresh}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.settimeout(self.timeout)
+            client_socket.connect(self.socket_location)
+            client_socket.sendall(json.dumps(request).encode(_ENCODING) + b"\n")
+            with client_socket.makefile("rb") as response_file:
+                line = response_file.readline(_MAX_MESSAGE_SIZE)
+        if len(line) == 0:
+            raise AgentError("Agent closed the connection without responding")
+        response = json.loads(line.decode(_ENCODING))
+        if ERROR_PROPERTY in response:
+            raise AgentError(response[ERROR_PROPERTY])
+        _logger.info(f"Variables {response.get(STATUS_PROPERTY)} in agent for project \"{project}\"")
+        return response[VARIABLES_PROPERTY]
@@ -0,0 +1,210 @@
+import asyncio
+import sys
+import time
+from contextlib import ExitStack
+
+from typing import List, NamedTuple, Optional, Tuple, BinaryIO, AsyncIterator, Dict
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_MAX_CONCURRENCY
+from dockerwithgitlabsecrets.envfile import DEFAULT_ENV_FILE_BACKEND, EnvFile
+from dockerwithgitlabsecrets.profiling import Profiler, NULL_PROFILER, DOCKER_PHASE
+from dockerwithgitlabsecrets.wrapper import ProgramOutputType, VariablesType, OutputTail, get_supported_action_index, \
+    create_docker_call, create_docker_environment, uses_env_file, uses_secret_files, SecretFileKeysType, \
+    prepare_secret_files, prepare_env_file, prepare_docker_call, write_output, STREAM_CHUNK_SIZE
+
+_ENCODING = "utf-8"
+
+
+class BatchResult(NamedTuple):
+    """
+    Result of running one of a batch of Docker commands.
+    """
+    index: int
+    docker_arguments: List[str]
+    output: ProgramOutputType
+    duration: float
+
+
+async def run_wrapped_async(docker_arguments: List[str], variables: VariablesType, stream: bool=False,
+                            tail_size: int=None, env_file_backend: str=DEFAULT_ENV_FILE_BACKEND,
+                            secret_file_keys: SecretFileKeysType=(), profiler: Profiler=NULL_PROFILER) \
+        -> ProgramOutputType:
+    """
+    Runs Docker (non-interactively) with the given arguments with the given variables set in the environment, as an
+    asyncio subprocess.
+    :param docker_arguments: the arguments to pass to Docker
+    :param variables: see `wrapper.run_wrapped`
+    :param stream: see `wrapper.run_wrapped`
+    :param tail_size: see `wrapper.run_wrapped`
+    :param env_file_backend: see `wrapper.run_wrapped`
+    :param secret_file_keys: see `wrapper.run_wrapped`
+    :param profiler: profiler of the run
+    :return: the output of running Docker
+    """
+    docker_action_index = get_supported_action_index(docker_arguments)
+    if docker_action_index is None:
+        with profiler.phase(DOCKER_PHASE):
+            return await _run_docker_async(create_docker_call(docker_arguments, None), (), stream, tail_size)
+
+    profiler.record("action", docker_arguments[docker_action_index])
+    variables = await _resolve_variables(variables)
+    with ExitStack() as exit_stack:
+        profiler.record("variable_count", len(variables))
+        action_arguments = []
+        if uses_secret_files(docker_arguments):
+            variables, action_arguments = prepare_secret_files(exit_stack, variables, secret_file_keys, profiler)
+        docker_call = prepare_docker_call(exit_stack, docker_arguments, variables, action_arguments, env_file_backend,
+                                          profiler)
+
+        with profiler.phase(DOCKER_PHASE):
+            return await _run_docker_async(docker_call.arguments, docker_call.pass_fds, stream, tail_size,
+                                           docker_call.environment)
+
+
+async def run_batch_async(docker_argument_lists: List[List[str]], variables: VariablesType,
+                          max_concurrency: int=DEFAULT_MAX_CONCURRENCY, stream: bool=False, tail_size: int=None,
+                          env_file_backend: str=DEFAULT_ENV_FILE_BACKEND, secret_file_keys: SecretFileKeysType=(),
+                          profiler: Profiler=NULL_PROFILER) -> AsyncIterator[BatchResult]:
+    """
+    Runs Docker (non-interactively) with each of the given lists of arguments, with the given variables set in the
+    environment. The variables are resolved, and the env file written, once for the whole batch.
+    :param docker_argument_lists: the lists of arguments to pass to Docker
+    :param variables: see `wrapper.run_wrapped`
+    :param max_concurrency: the maximum number of Docker commands to run at the same time
+    :param stream: see `wrapper.run_wrapped`
+    :param tail_size: see `wrapper.run_wrapped`
+    :param env_file_backend: see `wrapper.run_wrapped`
+    :param secret_file_keys: see `wrapper.run_wrapped`
+    :param profiler: profiler of the batch
+    :return: asynchronous iterator of the results, in the order that the commands finish
+    """
+    profiler.record("batch_size", len(docker_argument_lists))
+    with ExitStack() as exit_stack:
+        if any(get_supported_action_index(docker_arguments) is not None
+               for docker_arguments in docker_argument_lists):
+            variables = await _resolve_variables(variables)
+            profiler.record("variable_count", len(variables))
+
+        file_variables = variables
+        mount_arguments = []
+        if any(uses_secret_files(docker_arguments) for docker_arguments in docker_argument_lists):
+            file_variables, mount_arguments = prepare_secret_files(exit_stack, variables, secret_file_keys, profiler)
+
+        # Commands that are given variables as files need an env file of their own
+        env_files: Dict[bool, EnvFile] = {}
+        for docker_arguments in docker_argument_lists:
+            if uses_env_file(docker_arguments):
+                with_files = uses_secret_files(docker_arguments) and len(mount_arguments) > 0
+                if with_files not in env_files:
+                    env_files[with_files] = prepare_env_file(
+                        exit_stack, file_variables if with_files else variables, env_file_backend, profiler)
+        pass_fds = tuple(file_descriptor for docker_env_file in env_files.values()
+                         for file_descriptor in docker_env_file.get_inherited_file_descriptors())
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(index: int, docker_arguments: List[str]) -> BatchResult:
+            async with semaphore:
+                started_at = time.monotonic()
+                if get_supported_action_index(docker_arguments) is None:
+                    docker_call, environment = create_docker_call(docker_arguments, None), None
+                else:
+                    with_files = uses_secret_files(docker_arguments) and len(mount_arguments) > 0
+                    docker_env_file = env_files.get(with_files)
+                    docker_call = create_docker_call(
+                        docker_arguments, docker_env_file.location if docker_env_file is not None else None,
+                        variables.keys(), mount_arguments if with_files else [])
+                    environment = create_docker_environment(docker_arguments, variables)
+                output = await _run_docker_async(docker_call, pass_fds, stream, tail_size, environment)
+                return BatchResult(index=index, docker_arguments=docker_arguments, output=output,
+                                   duration=time.monotonic() - started_at)
+
+        tasks = [asyncio.ensure_future(run(index, docker_arguments))
+                 for index, docker_arguments in enumerate(docker_argument_lists)]
+        try:
+            with profiler.phase(DOCKER_PHASE):
+                for next_result in asyncio.as_completed(tasks):
+                    yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_batch(docker_argument_lists: List[List[str]], variables: VariablesType,
+              max_concurrency: int=DEFAULT_MAX_CONCURRENCY, stream: bool=False, tail_size: int=None,
+              env_file_backend: str=DEFAULT_ENV_FILE_BACKEND, secret_file_keys: SecretFileKeysType=(),
+              profiler: Profiler=NULL_PROFILER) -> List[BatchResult]:
+    """
+    Blocking equivalent of `run_batch_async`.
+    :return: the results, in the order that the commands finished
+    """
+    async def collect() -> List[BatchResult]:
+        return [result async for result in run_batch_async(
+            docker_argument_lists, variables, max_concurrency, stream, tail_size, env_file_backend, secret_file_keys,
+            profiler)]
+
+    event_loop = asyncio.new_event_loop()
+    try:
+        return event_loop.run_until_complete(collect())
+    finally:
+        event_loop.close()
+
+
+async def _resolve_variables(variables: VariablesType) -> Dict[str, str]:
+    """
+    Resolves the given variables, calling the getter (if given) in a thread so the event loop is not blocked.
+    :param variables: the variables or a callable that gets them
+    :return: the variables
+    """
+    if callable(variables):
+        # Called in a coroutine, so this is the running event loop (`asyncio.get_running_loop` requires Python 3.7)
+        return await asyncio.get_event_loop().run_in_executor(None, variables)
+    return variables
+
+
+async def _run_docker_async(docker_call: List[str], pass_fds: Tuple[int, ...], stream: bool,
+                            tail_size: Optional[int], environment: Dict[str, str]=None) -> ProgramOutputType:
+    """
+    Runs the given (non-interactive) Docker call as an asyncio subprocess.
+    :param docker_call: the Docker call
+    :param pass_fds: file descriptors that Docker is to inherit
+    :param stream: see `wrapper.run_wrapped`
+    :param tail_size: see `wrapper.run_wrapped`
+    :param environment: the environment to run Docker in (inherits this process' if `None`)
+    :return: the output of running Docker
+    """
+    process = await asyncio.create_subprocess_exec(
+        *docker_call, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, pass_fds=pass_fds,
+        env=environment)
+    try:
+        if not stream:
+            stdout, stderr = await process.communicate()
+            return process.returncode, stdout.decode(_ENCODING), stderr.decode(_ENCODING)
+
+        tails = (OutputTail(tail_size), OutputTail(tail_size)) if tail_size is not None else (None, None)
+        await asyncio.gather(_pump_async(process.stdout, sys.stdout.buffer, tails[0]),
+                             _pump_async(process.stderr, sys.stderr.buffer, tails[1]))
+        await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if tail_size is None:
+        return process.returncode, None, None
+    return process.returncode, tails[0].getvalue(), tails[1].getvalue()
+
+
+async def _pump_async(source: asyncio.StreamReader, sink: BinaryIO, tail: Optional[OutputTail]):
+    """
+    Copies raw bytes from the given source to the given sink until the end of the source is reached.
+    :param source: the source
+    :param sink: the sink
+    :param tail: buffer for the end of the output (optional)
+    """
+    while True:
+        data = await source.read(STREAM_CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        sink = write_output(data, sink, tail)
@@ -0,0 +1,253 @@
+import base64
+import hashlib
+import json
+import os
+import struct
+import time
+
+from typing import Dict, List, NamedTuple, Optional
+
+from dockerwithgitlabsecrets.cache import write_private_file
+from dockerwithgitlabsecrets.defaults import BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE
+
+BUNDLE_VERSION = 1
+
+_MAGIC = b"DWGSBNDL"
+_PREAMBLE_FORMAT = ">8sHI"
+_PREAMBLE_SIZE = struct.calcsize(_PREAMBLE_FORMAT)
+_MAX_HEADER_SIZE = 64 * 1024
+
+_KDF_PROPERTY = "kdf"
+_KDF_NAME_PROPERTY = "name"
+_KDF_SALT_PROPERTY = "salt"
+_KDF_N_PROPERTY = "n"
+_KDF_R_PROPERTY = "r"
+_KDF_P_PROPERTY = "p"
+_CREATED_PROPERTY = "created"
+_INDEX_NONCE_PROPERTY = "index_nonce"
+_INDEX_LENGTH_PROPERTY = "index_length"
+_URL_PROPERTY = "url"
+_NAMESPACE_PROPERTY = "namespace"
+_ENTRIES_PROPERTY = "entries"
+
+_SCRYPT_KDF = "scrypt"
+# Costs about 100ms (and 32MiB of memory) per bundle opened
+_SCRYPT_N = 2 ** 15
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+_SCRYPT_MAX_MEMORY = 64 * 1024 * 1024
+_SALT_SIZE = 16
+_KEY_SIZE = 32
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+
+_ENCODING = "utf-8"
+
+
+class BundleError(Exception):
+    """
+    Error reading or writing a bundle.
+    """
+
+
+class _BundleEntry(NamedTuple):
+    """
+    Location of a source's encrypted variables in a bundle.
+    """
+    offset: int
+    length: int
+    nonce: bytes
+
+
+def get_bundle_passphrase() -> str:
+    """
+    Gets the passphrase that bundles are encrypted with, from the environment.
+    :return: the passphrase
+    :raises BundleError: if the passphrase is not set
+    """
+    passphrase = os.environ.get(BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE)
+    if not passphrase:
+        raise BundleError(f"The bundle passphrase must be set in the {BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE} "
+                          f"environment variable")
+    return passphrase
+
+
+def write_bundle(location: str, source_variables: Dict[str, Dict[str, str]], passphrase: str, url: str=None,
+                 namespace: str=None):
+    """
+    Writes the given variables to an encrypted bundle, which only the current user can read.
+
+    The bundle starts with a plain header, giving the parameters needed to derive the key from the passphrase, followed
+    by an encrypted index of where the (separately encrypted) variables of each source are in the bundle. Variables are
+    encrypted using AES-GCM, with the header authenticated with the index and the source with its variables, so that
+    neither can be swapped without detection.
+    :param location: the location of the bundle
+    :param source_variables: the variables of each source, with sources in order of increasing precedence
+    :param passphrase: the passphrase to encrypt the bundle with
+    :param url: the URL of the GitLab instance the variables come from
+    :param namespace: the default namespace of the sources
+    :raises BundleError: if the optional `cryptography` package is not installed
+    """
+    salt = os.urandom(_SALT_SIZE)
+    cipher = _get_cipher(_derive_key(passphrase, salt, _SCRYPT_N, _SCRYPT_R, _SCRYPT_P))
+
+    entries = []
+    encrypted_variables = []
+    offset = 0
+    for source, variables in source_variables.items():
+        nonce = os.urandom(_NONCE_SIZE)
+        encrypted = cipher.encrypt(nonce, json.dumps(variables).encode(_ENCODING), source.encode(_ENCODING))
+        entries.append([source, offset, len(encrypted), _encode(nonce)])
+        encrypted_variables.append(encrypted)
+        offset += len(encrypted)
+
+    index = json.dumps({_URL_PROPERTY: url, _NAMESPACE_PROPERTY: namespace, _ENTRIES_PROPERTY: entries})
+    index_nonce = os.urandom(_NONCE_SIZE)
+    # GCM does not pad, so the size of the encrypted index is known before it is encrypted
+    index_length = len(index.encode(_ENCODING)) + _TAG_SIZE
+    header = json.dumps({
+        _KDF_PROPERTY: {_KDF_NAME_PROPERTY: _SCRYPT_KDF, _KDF_SALT_PROPERTY: _encode(salt), _KDF_N_PROPERTY: _SCRYPT_N,
+                        _KDF_R_PROPERTY: _SCRYPT_R, _KDF_P_PROPERTY: _SCRYPT_P},
+        _CREATED_PROPERTY: time.time(),
+        _INDEX_NONCE_PROPERTY: _encode(index_nonce),
+        _INDEX_LENGTH_PROPERTY: index_length
+    }).encode(_ENCODING)
+    preamble = struct.pack(_PREAMBLE_FORMAT, _MAGIC, BUNDLE_VERSION, len(header))
+    encrypted_index = cipher.encrypt(index_nonce, index.encode(_ENCODING), preamble + header)
+    write_private_file(os.path.abspath(location), preamble + header + encrypted_index + b"".join(encrypted_variables))
+
+
+class Bundle:
+    """
+    Encrypted bundle of variables, written by `write_bundle`. Only the index is decrypted when the bundle is opened:
+    the variables of a source are read and decrypted when they are got.
+    """
+    def __init__(self, location: str, passphrase: str):
+        """
+        Constructor, which opens the bundle.
+        :param location: the location of the bundle
+        :param passphrase: the passphrase the bundle was encrypted with
+        :raises BundleError: if the bundle cannot be read or decrypted (e.g. the passphrase is wrong)
+        """
+        self.location = location
+        try:
+            with open(location, "rb") as file:
+                preamble = file.read(_PREAMBLE_SIZE)
+                if len(preamble) != _PREAMBLE_SIZE:
+                    raise BundleError(f"Not a bundle: {location}")
+                magic, version, header_length = struct.unpack(_PREAMBLE_FORMAT, preamble)
+                if magic != _MAGIC:
+                    raise BundleError(f"Not a bundle: {location}")
+                if version != BUNDLE_VERSION:
+                    raise BundleError(f"Unsupported bundle version {version} (expected {BUNDLE_VERSION}): {location}")
+                if header_length > _MAX_HEADER_SIZE:
+                    raise BundleError(f"Corrupt bundle header: {location}")
+                header = file.read(header_length)
+                json_header = json.loads(header.decode(_ENCODING))
+                encrypted_index = file.read(json_header[_INDEX_LENGTH_PROPERTY])
+                self._data_offset = file.tell()
+        except OSError as e:
+            raise BundleError(f"Cannot read bundle: {location}") from e
+        except (ValueError, KeyError, TypeError) as e:
+            raise BundleError(f"Corrupt bundle header: {location}") from e
+
+        try:
+            json_kdf = json_header[_KDF_PROPERTY]
+            if json_kdf[_KDF_NAME_PROPERTY] != _SCRYPT_KDF:
+                raise BundleError(f"Unsupported bundle key derivation function: {json_kdf[_KDF_NAME_PROPERTY]}")
+            key = _derive_key(passphrase, _decode(json_kdf[_KDF_SALT_PROPERTY]), json_kdf[_KDF_N_PROPERTY],
+                              json_kdf[_KDF_R_PROPERTY], json_kdf[_KDF_P_PROPERTY])
+            index_nonce = _decode(json_header[_INDEX_NONCE_PROPERTY])
+            self.created: float = json_header[_CREATED_PROPERTY]
+        except (ValueError, KeyError, TypeError) as e:
+            raise BundleError(f"Corrupt bundle header: {location}") from e
+        self._cipher = _get_cipher(key)
+
+        json_index = json.loads(self._decrypt(index_nonce, encrypted_index, preamble + header).decode(_ENCODING))
+        self.url: Optional[str] = json_index[_URL_PROPERTY]
+        self.namespace: Optional[str] = json_index[_NAMESPACE_PROPERTY]
+        self._entries: Dict[str, _BundleEntry] = {
+            source: _BundleEntry(offset, length, _decode(nonce))
+            for source, offset, length, nonce in json_index[_ENTRIES_PROPERTY]}
+        self.sources: List[str] = [entry[0] for entry in json_index[_ENTRIES_PROPERTY]]
+
+    def get_variables(self, source: str) -> Dict[str, str]:
+        """
+        Gets the variables of the given source.
+        :param source: the variables source
+        :return: the variables
+        :raises BundleError: if the bundle does not contain the source or its variables cannot be read
+        """
+        entry = self._entries.get(source)
+        if entry is None:
+            raise BundleError(f"Bundle does not contain variables for \"{source}\": {self.location}")
+        try:
+            with open(self.location, "rb") as file:
+                file.seek(self._data_offset + entry.offset)
+                encrypted = file.read(entry.length)
+        except OSError as e:
+            raise BundleError(f"Cannot read bundle: {self.location}") from e
+        return json.loads(self._decrypt(entry.nonce, encrypted, source.encode(_ENCODING)).decode(_ENCODING))
+
+    def _decrypt(self, nonce: bytes, encrypted: bytes, associated_data: bytes) -> bytes:
+        """
+        Decrypts (and authenticates) the given data from the bundle.
+        :param nonce: the nonce the data was encrypted with
+        :param encrypted: the encrypted data
+        :param associated_data: the data that was authenticated with the encrypted data
+        :return: the decrypted data
+        :raises BundleError: if the data cannot be authenticated
+        """
+        from cryptography.exceptions import InvalidTag
+        try:
+            return self._cipher.decrypt(nonce, encrypted, associated_data)
+        except InvalidTag as e:
+            raise BundleError(f"Cannot decrypt bundle (is the passphrase correct?): {self.location}") from e
+
+
+def _derive_key(passphrase: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    """
+    Derives the encryption key from the given passphrase.
+    :param passphrase: the passphrase
+    :param salt: the salt
+    :param n: the scrypt CPU/memory cost
+    :param r: the scrypt block size
+    :param p: the scrypt parallelism
+    :return: the key
+    """
+    return hashlib.scrypt(passphrase.encode(_ENCODING), salt=salt, n=n, r=r, p=p, maxmem=_SCRYPT_MAX_MEMORY,
+                          dklen=_KEY_SIZE)
+
+
+def _get_cipher(key: bytes):
+    """
+    Gets the AES-GCM cipher with the given key.
+    :param key: the key
+    :return: the cipher
+    :raises BundleError: if the optional `cryptography` package is not installed
+    """
+    try:
+        # Imported here as it is an optional dependency, only required for bundles
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError as e:
+        raise BundleError("Bundles require the \"cryptography\" package (install "
+                          "\"dockerwithgitlabsecrets[bundle]\")") from e
+    return AESGCM(key)
+
+
+def _encode(data: bytes) -> str:
+    """
+    Encodes the given binary data for JSON.
+    :param data: the data
+    :return: the data, base64 encoded
+    """
+    return base64.b64encode(data).decode(_ENCODING)
+
+
+def _decode(data: str) -> bytes:
+    """
+    Decodes the given binary data from JSON.
+    :param data: the base64 encoded data
+    :return: the data
+    """
+    return base64.b64decode(data)
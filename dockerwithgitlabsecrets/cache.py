@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from enum import Enum
+from tempfile import mkstemp
+
+from typing import Callable, Dict, NamedTuple, Optional, Tuple, List
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_CACHE_DIRECTORY
+
+
+_CACHE_FILE_SUFFIX = ".json"
+_DIRECTORY_MODE = 0o700
+_PERMISSIONS_MASK = 0o777
+
+_VARIABLES_PROPERTY = "variables"
+_FETCHED_PROPERTY = "fetched"
+_ETAG_PROPERTY = "etag"
+_DIGEST_PROPERTY = "digest"
+
+_ENCODING = "utf-8"
+
+VariablesFetcher = Callable[[], Dict[str, str]]
+ConditionalVariablesFetcher = Callable[[Optional[str]], Tuple[Optional[Dict[str, str]], Optional[str]]]
+
+_logger = logging.getLogger(__name__)
+
+
+class CacheStatus(Enum):
+    """
+    Outcome of getting variables through the cache.
+    """
+    HIT = "hit"
+    MISS = "miss"
+    STALE = "stale"
+    REFRESH = "refresh"
+    REVALIDATED = "revalidated"
+
+
+class CacheEntry(NamedTuple):
+    """
+    Variables stored in the cache.
+    """
+    variables: Dict[str, str]
+    fetched: float
+    etag: Optional[str] = None
+    digest: Optional[str] = None
+
+    def age(self) -> float:
+        """
+        Gets how long ago (in seconds) the variables in this entry were fetched.
+        :return: the age of the entry
+        """
+        return time.time() - self.fetched
+
+
+def get_variables_digest(variables: Dict[str, str]) -> str:
+    """
+    Gets a digest of the given variables, which changes if any variable is added, removed or changed.
+    :param variables: the variables
+    :return: the digest
+    """
+    return hashlib.sha256(json.dumps(variables, sort_keys=True).encode(_ENCODING)).hexdigest()
+
+
+def ensure_private_directory(directory: str) -> bool:
+    """
+    Ensures that the given directory exists and is only accessible by the current user.
+    :param directory: the directory
+    :return: whether the directory is private to the current user
+    """
+    os.makedirs(directory, mode=_DIRECTORY_MODE, exist_ok=True)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid():
+        _logger.warning(f"Not using directory \"{directory}\" as it is not owned by the current user")
+        return False
+    if status.st_mode & _PERMISSIONS_MASK != _DIRECTORY_MODE:
+        os.chmod(directory, _DIRECTORY_MODE)
+    return True
+
+
+def write_private_file(location: str, contents: bytes):
+    """
+    Atomically writes the given contents to a file that only the current user can read.
+    :param location: the location of the file
+    :param contents: the contents to write
+    """
+    file_handle, temp_location = mkstemp(dir=os.path.dirname(location))
+    try:
+        with os.fdopen(file_handle, "wb") as file:
+            file.write(contents)
+        os.replace(temp_location, location)
+    except BaseException:
+        os.remove(temp_location)
+        raise
+
+
+class VariablesCache:
+    """
+    On-disk cache of variables, keyed by GitLab URL and project.
+    """
+    def __init__(self, directory: str=DEFAULT_CACHE_DIRECTORY, ttl: float=0, stale_while_revalidate: float=0):
+        """
+        Constructor.
+        :param directory: the directory in which to store cached variables
+        :param ttl: the number of seconds for which cached variables are used without revalidation
+        :param stale_while_revalidate: the number of seconds after the TTL has expired for which cached variables are
+        still used, whilst they are refreshed in the background
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self._refreshes: List[threading.Thread] = []
+
+    def get(self, url: str, project: str, fetcher: VariablesFetcher, refresh: bool=False,
+            conditional_fetcher: ConditionalVariablesFetcher=None) -> Tuple[Dict[str, str], CacheStatus]:
+        """
+        Gets the variables for the given project, using cached variables where they are fresh enough.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :param fetcher: fetches the variables when they are not cached (or cannot be used)
+        :param refresh: whether to ignore any cached variables and fetch them again
+        :param conditional_fetcher: fetches the variables only if they have changed since they were fetched with the
+        given ETag (returning `None` in place of the variables if they have not), which is used in place of `fetcher`
+        when given
+        :return: tuple where the first element is the variables and the second is how they were retrieved
+        """
+        entry = self.get_entry(url, project)
+
+        if entry is not None and not refresh:
+            age = entry.age()
+            if age <= self.ttl:
+                return entry.variables, CacheStatus.HIT
+            if age <= self.ttl + self.stale_while_revalidate:
+                refresh_thread = threading.Thread(
+                    target=self._refresh, args=(url, project, entry, fetcher, conditional_fetcher), daemon=True)
+                refresh_thread.start()
+                self._refreshes.append(refresh_thread)
+                return entry.variables, CacheStatus.STALE
+
+        variables, changed = self._fetch(url, project, entry, fetcher, conditional_fetcher)
+        if not changed:
+            return variables, CacheStatus.REVALIDATED
+        return variables, CacheStatus.REFRESH if refresh else CacheStatus.MISS
+
+    def get_entry(self, url: str, project: str) -> Optional[CacheEntry]:
+        """
+        Gets the cache entry for the given project.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :return: the cache entry or `None` if there is no (readable) entry
+        """
+        location = self._get_entry_location(url, project)
+        try:
+            with open(location, "r", encoding=_ENCODING) as file:
+                json_entry = json.load(file)
+                # Entries that are revalidated without change are touched, rather than rewritten
+                modified = os.fstat(file.fileno()).st_mtime
+            return CacheEntry(variables=json_entry[_VARIABLES_PROPERTY],
+                              fetched=max(json_entry[_FETCHED_PROPERTY], modified),
+                              etag=json_entry.get(_ETAG_PROPERTY), digest=json_entry.get(_DIGEST_PROPERTY))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _logger.warning(f"Ignoring unreadable cache entry \"{location}\": {e}")
+            return None
+
+    def set_entry(self, url: str, project: str, variables: Dict[str, str], etag: str=None):
+        """
+        Stores the given variables for the given project in the cache.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :param variables: the variables to store
+        :param etag: the ETag GitLab gave the variables (optional)
+        """
+        if not ensure_private_directory(self.directory):
+            return
+        json_entry = {_VARIABLES_PROPERTY: variables, _FETCHED_PROPERTY: time.time(), _ETAG_PROPERTY: etag,
+                      _DIGEST_PROPERTY: get_variables_digest(variables)}
+        write_private_file(self._get_entry_location(url, project), json.dumps(json_entry).encode(_ENCODING))
+
+    def wait_for_refreshes(self):
+        """
+        Blocks until all background refreshes of stale variables have completed.
+        """
+        while len(self._refreshes) > 0:
+            self._refreshes.pop().join()
+
+    def _fetch(self, url: str, project: str, entry: Optional[CacheEntry], fetcher: VariablesFetcher,
+               conditional_fetcher: Optional[ConditionalVariablesFetcher]) -> Tuple[Dict[str, str], bool]:
+        """
+        Fetches the variables for the given project and stores them in the cache, if they have changed since they were
+        cached. Unchanged variables are detected using the cached ETag, if there is one, else by their digest.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :param entry: the cached entry (`None` if there is not one)
+        :param fetcher: see `get`
+        :param conditional_fetcher: see `get`
+        :return: tuple where the first element is the variables and the second is whether they have changed
+        """
+        if conditional_fetcher is not None:
+            variables, etag = conditional_fetcher(entry.etag if entry is not None else None)
+        else:
+            variables, etag = fetcher(), None
+
+        if entry is not None and (variables is None
+                                  or (entry.digest == get_variables_digest(variables) and entry.etag == etag)):
+            self._touch_entry(url, project)
+            return entry.variables, False
+        self.set_entry(url, project, variables, etag)
+        return variables, True
+
+    def _touch_entry(self, url: str, project: str):
+        """
+        Marks the cache entry of the given project as having been fetched now.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        """
+        try:
+            os.utime(self._get_entry_location(url, project))
+        except OSError as e:
+            _logger.warning(f"Could not update cache entry for project \"{project}\": {e}")
+
+    def _refresh(self, url: str, project: str, entry: CacheEntry, fetcher: VariablesFetcher,
+                 conditional_fetcher: Optional[ConditionalVariablesFetcher]):
+        """
+        Refreshes the cached variables for the given project.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :param entry: the cached entry
+        :param fetcher: see `get`
+        :param conditional_fetcher: see `get`
+        """
+        try:
+            self._fetch(url, project, entry, fetcher, conditional_fetcher)
+            _logger.info(f"Refreshed stale cached variables for project \"{project}\"")
+        except Exception as e:
+            _logger.warning(f"Could not refresh stale cached variables for project \"{project}\": {e}")
+
+    def _get_entry_location(self, url: str, project: str) -> str:
+        """
+        Gets the location of the cache entry for the given project.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :return: the location of the entry
+        """
+        key = hashlib.sha256(f"{url.rstrip('/')}\n{project}".encode(_ENCODING)).hexdigest()
+        return os.path.join(self.directory, f"{key}{_CACHE_FILE_SUFFIX}")
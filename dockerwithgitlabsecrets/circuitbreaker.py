@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from typing import List, Optional, Collection
+
+from dockerwithgitlabsecrets.cache import ensure_private_directory, write_private_file
+from dockerwithgitlabsecrets.defaults import DEFAULT_CACHE_DIRECTORY, DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT
+
+DEFAULT_CIRCUIT_BREAKER_DIRECTORY = DEFAULT_CACHE_DIRECTORY
+MAX_LATENCIES = 100
+MIN_LATENCIES_FOR_PERCENTILE = 20
+
+_STATE_FILE_PREFIX = "circuit-"
+_STATE_FILE_SUFFIX = ".json"
+_FAILURES_PROPERTY = "failures"
+_OPENED_PROPERTY = "opened"
+_LATENCIES_PROPERTY = "latencies"
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Error raised when requests are not made to a host because its circuit breaker is open.
+    """
+    def __init__(self, host: str, retry_in: float):
+        super().__init__(f"Not contacting {host} after repeated failures (retrying in {retry_in:.0f}s)")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the requests made to a host, whose state is stored in a file (that only the current user can
+    read) so that it persists between processes. The breaker opens after the given number of consecutive failures,
+    after which requests are not made until the reset timeout has passed. The next process to make a request then
+    (re)closes the breaker if it succeeds, or keeps it open for another reset timeout if it fails.
+
+    The latencies of recent successful requests are also stored, so that a percentile of them can be used to decide
+    when to hedge requests. Updates made by processes at the same time may be lost.
+    """
+    def __init__(self, host: str, failure_threshold: int=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float=DEFAULT_RESET_TIMEOUT, directory: str=DEFAULT_CIRCUIT_BREAKER_DIRECTORY):
+        """
+        Constructor.
+        :param host: the host (e.g. the GitLab URL)
+        :param failure_threshold: the number of consecutive failures after which the breaker opens (the breaker never
+        opens if not positive)
+        :param reset_timeout: seconds for which the breaker stays open
+        :param directory: the directory in which to store the breaker's state
+        """
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.directory = directory
+        self._location = os.path.join(directory, f"{_STATE_FILE_PREFIX}"
+                                                 f"{hashlib.sha256(host.encode(_ENCODING)).hexdigest()}"
+                                                 f"{_STATE_FILE_SUFFIX}")
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Checks that a request can be made to the host. If the reset timeout of the open breaker has passed, the request
+        is allowed as a trial, and other processes are not allowed to make requests until the reset timeout passes
+        again (or the trial succeeds).
+        :raises CircuitOpenError: if the breaker is open
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            state = self._read_state()
+            opened = state.get(_OPENED_PROPERTY)
+            if opened is None:
+                return
+            open_for = time.time() - opened
+            if open_for < self.reset_timeout:
+                raise CircuitOpenError(self.host, self.reset_timeout - open_for)
+            _logger.info(f"Trying {self.host} again after repeated failures")
+            state[_OPENED_PROPERTY] = time.time()
+            self._write_state(state)
+
+    def record_success(self, latencies: Collection[float]=()):
+        """
+        Records that a request to the host succeeded, closing the breaker. The breaker's state is only rewritten if it
+        changes (i.e. there were failures, the breaker was open or there are latencies to record).
+        :param latencies: the latencies (in seconds) of the successful requests made
+        """
+        with self._lock:
+            state = self._read_state()
+            if state.get(_FAILURES_PROPERTY, 0) == 0 and state.get(_OPENED_PROPERTY) is None and len(latencies) == 0:
+                return
+            state[_FAILURES_PROPERTY] = 0
+            state[_OPENED_PROPERTY] = None
+            state[_LATENCIES_PROPERTY] = (state.get(_LATENCIES_PROPERTY, []) + list(latencies))[-MAX_LATENCIES:]
+            self._write_state(state)
+
+    def record_failure(self):
+        """
+        Records that a request to the host failed, opening the breaker if it has failed too many times in a row.
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            state = self._read_state()
+            state[_FAILURES_PROPERTY] = state.get(_FAILURES_PROPERTY, 0) + 1
+            if state[_FAILURES_PROPERTY] >= self.failure_threshold:
+                if state.get(_OPENED_PROPERTY) is None:
+                    _logger.warning(f"Not contacting {self.host} for {self.reset_timeout}s after "
+                                    f"{state[_FAILURES_PROPERTY]} consecutive failures")
+                state[_OPENED_PROPERTY] = time.time()
+            self._write_state(state)
+
+    def get_latency_percentile(self, percentile: float) -> Optional[float]:
+        """
+        Gets the given percentile of the latencies of recent successful requests to the host.
+        :param percentile: the percentile (between 0 and 100)
+        :return: the latency (in seconds) or `None` if too few requests have been recorded
+        """
+        with self._lock:
+            latencies = sorted(self._read_state().get(_LATENCIES_PROPERTY, []))
+        if len(latencies) < MIN_LATENCIES_FOR_PERCENTILE:
+            return None
+        return latencies[min(len(latencies) - 1, max(0, math.ceil(percentile / 100 * len(latencies)) - 1))]
+
+    def _read_state(self) -> dict:
+        """
+        Reads the state of the breaker.
+        :return: the state (empty if there is no (readable) state)
+        """
+        try:
+            with open(self._location, "r", encoding=_ENCODING) as file:
+                state = json.load(file)
+            if not isinstance(state, dict):
+                raise ValueError(f"Expected an object but got: {state}")
+            return state
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            _logger.warning(f"Ignoring unreadable circuit breaker state \"{self._location}\": {e}")
+            return {}
+
+    def _write_state(self, state: dict):
+        """
+        Writes the state of the breaker.
+        :param state: the state
+        """
+        try:
+            if ensure_private_directory(self.directory):
+                write_private_file(self._location, json.dumps(state).encode(_ENCODING))
+        except OSError as e:
+            _logger.warning(f"Could not write circuit breaker state \"{self._location}\": {e}")
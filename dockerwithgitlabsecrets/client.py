@@ -0,0 +1,585 @@
+import http.client
+import json
+import logging
+import random
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from fnmatch import fnmatchcase
+from queue import LifoQueue, Empty, Queue
+from urllib.parse import urlsplit, quote, urlencode
+
+from typing import Dict, List, NamedTuple, Tuple, Optional, Collection, Callable, Iterator, TypeVar
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES
+
+API_PATH = "/api/v4"
+LEGACY_API_PATH = "/api/v3"
+VERSION_PATH = "/version"
+TOKEN_HEADER = "PRIVATE-TOKEN"
+TOTAL_PAGES_HEADER = "X-Total-Pages"
+NEXT_PAGE_HEADER = "X-Next-Page"
+ETAG_HEADER = "ETag"
+IF_NONE_MATCH_HEADER = "If-None-Match"
+RETRY_AFTER_HEADER = "Retry-After"
+
+DEFAULT_PER_PAGE = 100
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_RETRY_WAIT = 10.0
+TRANSIENT_ERROR_STATUSES = (429, 502, 503, 504)
+
+_VARIABLE_KEY_PROPERTY = "key"
+_VARIABLE_VALUE_PROPERTY = "value"
+_VARIABLE_ENVIRONMENT_SCOPE_PROPERTY = "environment_scope"
+_ALL_ENVIRONMENTS_SCOPE = "*"
+_HTTPS_SCHEME = "https"
+_ENCODING = "utf-8"
+_RETRIABLE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+_NOT_MODIFIED_STATUS = 304
+_NOT_FOUND_STATUS = 404
+_CONFLICT_STATUS = 409
+
+_T = TypeVar("_T")
+
+_logger = logging.getLogger(__name__)
+
+
+class GitLabRequestError(Exception):
+    """
+    Error response from GitLab.
+    """
+    def __init__(self, status: int, path: str, message: str, retry_after: float=None):
+        super().__init__(f"GitLab responded to {path} with {status}: {message}")
+        self.status = status
+        self.path = path
+        self.retry_after = retry_after
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Gets whether the given error, raised when making a request to GitLab, may not happen if the request is retried
+    (i.e. it was caused by GitLab being overloaded or unavailable, or by the network).
+    :param error: the error
+    :return: whether the error is transient
+    """
+    if isinstance(error, GitLabRequestError):
+        return error.status in TRANSIENT_ERROR_STATUSES
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+
+class RequestTiming(NamedTuple):
+    """
+    Timing of a request made to GitLab.
+    """
+    path: str
+    status: int
+    duration: float
+    reused_connection: bool
+
+
+class GitLabVariablesClient:
+    """
+    Client that gets variables from GitLab, reusing (keep-alive) connections and getting pages in parallel.
+
+    Requests that fail with a transient error (see `is_transient_error`) are retried, after a jittered exponential
+    backoff or the time GitLab asks for (with `Retry-After`). If a hedge delay is set, a second, identical request is
+    made if there is no response to the first within that time, and whichever response comes first is used.
+
+    Version 4 of the API is used, unless GitLab does not support it (i.e. GitLab is older than 9.0), in which case
+    version 3 is used.
+    """
+    def __init__(self, url: str, token: str, per_page: int=DEFAULT_PER_PAGE,
+                 max_connections: int=DEFAULT_MAX_CONNECTIONS, connect_timeout: float=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float=DEFAULT_READ_TIMEOUT, ssl_verify: bool=True, retries: int=DEFAULT_RETRIES,
+                 retry_backoff: float=DEFAULT_RETRY_BACKOFF, max_retry_wait: float=DEFAULT_MAX_RETRY_WAIT,
+                 hedge_delay: Optional[float]=None):
+        """
+        Constructor.
+        :param url: the URL of the GitLab instance
+        :param token: the access token
+        :param per_page: the number of variables to get per page
+        :param max_connections: the maximum number of pages to get in parallel
+        :param connect_timeout: seconds to wait to connect to GitLab
+        :param read_timeout: seconds to wait for GitLab to send (each part of) a response
+        :param ssl_verify: whether to verify GitLab's SSL certificate
+        :param retries: the maximum number of times a request is retried after a transient error
+        :param retry_backoff: seconds to (at most) wait before the first retry, which doubles with each retry
+        :param max_retry_wait: the maximum number of seconds to wait before a retry (requests are not retried if
+        GitLab asks for a longer wait)
+        :param hedge_delay: seconds after which a second request is made if there is no response to the first (`None`
+        to not hedge requests)
+        """
+        split_url = urlsplit(url)
+        self._https = split_url.scheme == _HTTPS_SCHEME
+        self._host = split_url.hostname
+        self._port = split_url.port
+        self._url_path = split_url.path.rstrip("/")
+        self._base_path = f"{self._url_path}{API_PATH}"
+        self._api_version_checked = False
+        self._api_version_lock = threading.Lock()
+        self._token = token
+        self.per_page = per_page
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_wait = max_retry_wait
+        self.hedge_delay = hedge_delay
+        self.retried = 0
+        self.hedged = 0
+        self._ssl_context = ssl.create_default_context()
+        if not ssl_verify:
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._idle_connections: LifoQueue = LifoQueue()
+        self._timings: List[RequestTiming] = []
+        self._timings_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def timings(self) -> List[RequestTiming]:
+        """
+        Gets the timings of the requests made by this client.
+        :return: the request timings
+        """
+        with self._timings_lock:
+            return list(self._timings)
+
+    @contextmanager
+    def recording_timings(self) -> Iterator[List[RequestTiming]]:
+        """
+        Records the timings of the requests made in the context, by this thread (including on the threads that the
+        client starts to make them), separately from those that other threads make at the same time.
+        :return: context of the timings of the requests made in it
+        """
+        previous_recorded = getattr(self._local, "recorded", None)
+        recorded: List[RequestTiming] = []
+        self._local.recorded = recorded
+        try:
+            yield recorded
+        finally:
+            self._local.recorded = previous_recorded
+
+    def get_project_variables(self, project: str, environment_scope: str=None) -> Dict[str, str]:
+        """
+        Gets the variables of the given project.
+        :param project: the namespaced project
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: the project's variables
+        """
+        return self.get_project_variables_if_changed(project, None, environment_scope)[0]
+
+    def get_group_variables(self, group: str, environment_scope: str=None) -> Dict[str, str]:
+        """
+        Gets the variables of the given group.
+        :param group: the group (including any parent groups)
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: the group's variables
+        """
+        return self.get_group_variables_if_changed(group, None, environment_scope)[0]
+
+    def get_project_variables_if_changed(self, project: str, etag: Optional[str], environment_scope: str=None) \
+            -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+        """
+        Gets the variables of the given project, if they have changed since they were got with the given ETag.
+        :param project: the namespaced project
+        :param etag: the ETag of the variables when they were last got (`None` to get them unconditionally)
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: see `_get_variables`
+        """
+        return self._get_variables(_get_project_variables_path(project), etag, environment_scope)
+
+    def get_group_variables_if_changed(self, group: str, etag: Optional[str], environment_scope: str=None) \
+            -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+        """
+        Gets the variables of the given group, if they have changed since they were got with the given ETag.
+        :param group: the group (including any parent groups)
+        :param etag: the ETag of the variables when they were last got (`None` to get them unconditionally)
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: see `_get_variables`
+        """
+        return self._get_variables(_get_group_variables_path(group), etag, environment_scope)
+
+    def get_project_variables_by_key(self, project: str, keys: Collection[str], environment_scope: str=None) \
+            -> Dict[str, str]:
+        """
+        Gets the variables of the given project that have the given keys.
+        :param project: the namespaced project
+        :param keys: the keys of the variables to get
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: see `_get_variables_by_key`
+        """
+        return self._get_variables_by_key(_get_project_variables_path(project), keys, environment_scope)
+
+    def get_group_variables_by_key(self, group: str, keys: Collection[str], environment_scope: str=None) \
+            -> Dict[str, str]:
+        """
+        Gets the variables of the given group that have the given keys.
+        :param group: the group (including any parent groups)
+        :param keys: the keys of the variables to get
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: see `_get_variables_by_key`
+        """
+        return self._get_variables_by_key(_get_group_variables_path(group), keys, environment_scope)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except Empty:
+                return
+
+    def _get_variables(self, path: str, etag: Optional[str]=None, environment_scope: str=None) \
+            -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+        """
+        Gets all pages of the variables at the given API path.
+
+        If an ETag is given, the request is conditional: GitLab can respond that the variables have not changed,
+        without sending them. Only variables that fit in one page have an ETag, as the ETag of a page does not cover the
+        others.
+
+        If an environment is given, only the variables whose environment scope matches it are got and, where there is
+        more than one variable with the same key, the one with the most specific scope is used (as in GitLab CI).
+        Otherwise, variables are got regardless of their scope.
+        :param path: the API path (relative to the API root)
+        :param etag: the ETag of the variables when they were last got (`None` to get them unconditionally)
+        :param environment_scope: the environment to get the variables of (optional)
+        :return: tuple where the first element is the variables (`None` if they have not changed) and the second is
+        their ETag (`None` if GitLab did not give one)
+        """
+        status, json_variables, headers = self._get_page(path, 1, etag)
+        if status == _NOT_MODIFIED_STATUS:
+            return None, etag
+        total_pages = headers.get(TOTAL_PAGES_HEADER)
+        single_page = total_pages == "1" or (total_pages is None and not headers.get(NEXT_PAGE_HEADER))
+
+        if total_pages is not None and total_pages.isdigit():
+            pages = range(2, int(total_pages) + 1)
+            if len(pages) > 0:
+                with ThreadPoolExecutor(max_workers=min(len(pages), self.max_connections)) as executor:
+                    for _, page_variables, _ in executor.map(
+                            self._in_recording(lambda page: self._get_page(path, page)), pages):
+                        json_variables += page_variables
+        else:
+            # GitLab does not report the total for very large collections, so pages must be followed in turn
+            next_page = headers.get(NEXT_PAGE_HEADER)
+            while next_page:
+                _, page_variables, headers = self._get_page(path, int(next_page))
+                json_variables += page_variables
+                next_page = headers.get(NEXT_PAGE_HEADER)
+
+        if environment_scope is not None:
+            json_variables = _select_environment_variables(json_variables, environment_scope)
+        variables = {variable[_VARIABLE_KEY_PROPERTY]: variable[_VARIABLE_VALUE_PROPERTY]
+                     for variable in json_variables}
+        return variables, headers.get(ETAG_HEADER) if single_page else None
+
+    def _get_variables_by_key(self, path: str, keys: Collection[str], environment_scope: str=None) -> Dict[str, str]:
+        """
+        Gets the variables with the given keys from the collection at the given API path, requesting each variable in
+        parallel rather than listing the collection. Falls back to listing the collection if there is more than one
+        variable with a key (each with a different environment scope).
+        :param path: the API path of the collection (relative to the API root)
+        :param keys: the keys of the variables to get
+        :param environment_scope: the environment to get the variables of (optional, see `_get_variables`)
+        :return: the variables (without those that do not exist)
+        """
+        if len(keys) == 0:
+            return {}
+
+        def get_variable(key: str) -> Optional[Dict]:
+            try:
+                return json.loads(self._get(f"{path}/{quote(key, safe='')}")[2].decode(_ENCODING))
+            except GitLabRequestError as e:
+                if e.status == _NOT_FOUND_STATUS:
+                    return None
+                raise
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(keys), self.max_connections)) as executor:
+                json_variables = [variable for variable in executor.map(self._in_recording(get_variable), keys)
+                                  if variable is not None]
+        except GitLabRequestError as e:
+            if e.status != _CONFLICT_STATUS:
+                raise
+            _logger.info(f"Variables at {path} have keys in more than one environment scope: listing them instead")
+            variables = self._get_variables(path, environment_scope=environment_scope)[0]
+            return {key: value for key, value in variables.items() if key in keys}
+
+        if environment_scope is not None:
+            json_variables = _select_environment_variables(json_variables, environment_scope)
+        return {variable[_VARIABLE_KEY_PROPERTY]: variable[_VARIABLE_VALUE_PROPERTY] for variable in json_variables}
+
+    def _get_page(self, path: str, page: int, etag: Optional[str]=None) \
+            -> Tuple[int, Optional[List[Dict]], http.client.HTTPMessage]:
+        """
+        Gets the given page of the collection at the given API path.
+        :param path: the API path (relative to the API root)
+        :param page: the page number (starting at 1)
+        :param etag: ETag to make the request conditional on (optional)
+        :return: tuple where the first element is the response status, the second is the JSON page contents (`None`
+        if not modified) and the third is the response headers
+        """
+        status, headers, body = self._get(f"{path}?{urlencode({'per_page': self.per_page, 'page': page})}",
+                                          {IF_NONE_MATCH_HEADER: etag} if etag is not None else {})
+        if status == _NOT_MODIFIED_STATUS:
+            return status, None, headers
+        return status, json.loads(body.decode(_ENCODING)), headers
+
+    def _get(self, path: str, headers: Dict[str, str]=None) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """
+        Makes a GET request to the given API path, retrying it after transient errors.
+        :param path: the API path (relative to the API root)
+        :param headers: additional request headers
+        :return: tuple where the first element is the response status, the second is the headers and the third is the
+        body
+        :raises GitLabRequestError: if GitLab responds with an error
+        """
+        attempt = 0
+        while True:
+            base_path = self._base_path
+            try:
+                return self._get_hedged(path, headers)
+            except Exception as e:
+                if isinstance(e, GitLabRequestError) and e.status == _NOT_FOUND_STATUS \
+                        and self._use_legacy_api(base_path):
+                    continue
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+                retry_after = e.retry_after if isinstance(e, GitLabRequestError) else None
+                if retry_after is not None and retry_after > self.max_retry_wait:
+                    raise
+                # "Full jitter", so that clients that failed at the same time do not retry at the same time
+                wait = random.uniform(0, min(self.retry_backoff * 2 ** attempt, self.max_retry_wait))
+                if retry_after is not None:
+                    wait = max(wait, retry_after)
+                _logger.info(f"Retrying GET {path} in {wait:.3f}s after transient error: {e}")
+                time.sleep(wait)
+                attempt += 1
+                with self._timings_lock:
+                    self.retried += 1
+
+    def _use_legacy_api(self, base_path: str) -> bool:
+        """
+        Switches to version 3 of the API if GitLab does not support version 4, which is checked (once) after a request
+        is not found.
+        :param base_path: the base path of the request that was not found
+        :return: whether the API has been switched from the given base path, so the request should be made again
+        """
+        with self._api_version_lock:
+            if not self._api_version_checked:
+                try:
+                    self._get_once(VERSION_PATH)
+                except GitLabRequestError as e:
+                    if e.status == _NOT_FOUND_STATUS:
+                        _logger.info(f"GitLab does not support API {API_PATH}: using {LEGACY_API_PATH}")
+                        self._base_path = f"{self._url_path}{LEGACY_API_PATH}"
+                self._api_version_checked = True
+            return self._base_path != base_path
+
+    def _get_hedged(self, path: str, headers: Dict[str, str]=None) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """
+        Makes a GET request to the given API path, making a second (hedged) request if there is no response to the
+        first within the hedge delay.
+        :param path: the API path (relative to the API root)
+        :param headers: additional request headers
+        :return: see `_get`
+        :raises GitLabRequestError: if GitLab responds with an error (to both requests, if hedged)
+        """
+        if self.hedge_delay is None:
+            return self._get_once(path, headers)
+
+        # The request that loses the race is left to finish in the background, then its connection is returned
+        results: Queue = Queue()
+
+        @self._in_recording
+        def request():
+            try:
+                results.put((self._get_once(path, headers), None))
+            except Exception as e:
+                results.put((None, e))
+
+        threading.Thread(target=request, daemon=True).start()
+        try:
+            response, error = results.get(timeout=self.hedge_delay)
+        except Empty:
+            _logger.debug(f"Hedging GET {path}: no response after {self.hedge_delay:.3f}s")
+            with self._timings_lock:
+                self.hedged += 1
+            threading.Thread(target=request, daemon=True).start()
+            response, error = results.get()
+            if error is not None:
+                response, error = results.get()
+        if error is not None:
+            raise error
+        return response
+
+    def _get_once(self, path: str, headers: Dict[str, str]=None) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """
+        Makes a GET request to the given API path, on a pooled connection.
+        :param path: the API path (relative to the API root)
+        :param headers: additional request headers
+        :return: see `_get`
+        :raises GitLabRequestError: if GitLab responds with an error
+        """
+        full_path = f"{self._base_path}{path}"
+        headers = dict(headers or {}, **{TOKEN_HEADER: self._token})
+        connection, reused = self._acquire_connection()
+        started_at = time.monotonic()
+        try:
+            try:
+                response = self._request(connection, full_path, headers)
+            except _RETRIABLE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # GitLab closed the idle keep-alive connection: retry on a new connection
+                connection.close()
+                connection, reused = self._create_connection(), False
+                response = self._request(connection, full_path, headers)
+            body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        duration = time.monotonic() - started_at
+        timing = RequestTiming(path=path, status=response.status, duration=duration, reused_connection=reused)
+        with self._timings_lock:
+            self._timings.append(timing)
+            recorded = getattr(self._local, "recorded", None)
+            if recorded is not None:
+                recorded.append(timing)
+        _logger.debug(f"GET {path}: {response.status} in {duration:.3f}s (reused connection: {reused})")
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle_connections.put(connection)
+
+        if response.status >= 400:
+            raise GitLabRequestError(response.status, path, body.decode(_ENCODING, errors="replace"),
+                                     _parse_retry_after(response.headers.get(RETRY_AFTER_HEADER)))
+        return response.status, response.headers, body
+
+    def _in_recording(self, function: Callable[..., _T]) -> Callable[..., _T]:
+        """
+        Wraps the given function so that, when called on another thread, the requests that it makes are recorded in
+        the same timings as those of this thread (see `recording_timings`).
+        :param function: the function
+        :return: the wrapped function
+        """
+        recorded = getattr(self._local, "recorded", None)
+
+        def call(*args):
+            self._local.recorded = recorded
+            try:
+                return function(*args)
+            finally:
+                self._local.recorded = None
+
+        return call
+
+    def _request(self, connection: http.client.HTTPConnection, full_path: str, headers: Dict[str, str]) \
+            -> http.client.HTTPResponse:
+        """
+        Makes a GET request to the given path using the given connection.
+        :param connection: the connection
+        :param full_path: the full path
+        :param headers: the request headers
+        :return: the response
+        """
+        if connection.sock is None:
+            # Connections are created with the connect timeout, which is replaced once connected
+            connection.connect()
+            connection.sock.settimeout(self.read_timeout)
+        connection.request("GET", full_path, headers=headers)
+        return connection.getresponse()
+
+    def _acquire_connection(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """
+        Gets an idle connection from the pool, or creates a new one if there are none.
+        :return: tuple where the first element is the connection and the second is whether it has been used before
+        """
+        try:
+            return self._idle_connections.get_nowait(), True
+        except Empty:
+            return self._create_connection(), False
+
+    def _create_connection(self) -> http.client.HTTPConnection:
+        """
+        Creates a new connection to GitLab.
+        :return: the connection
+        """
+        if self._https:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self.connect_timeout,
+                                               context=self._ssl_context)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.connect_timeout)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses the value of a `Retry-After` header.
+    :param value: the header value, which is either a number of seconds or an HTTP date (`None` if there is no header)
+    :return: the number of seconds to wait before retrying (`None` if not given or invalid)
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _get_project_variables_path(project: str) -> str:
+    """
+    Gets the API path of the variables of the given project.
+    :param project: the namespaced project
+    :return: the API path (relative to the API root)
+    """
+    return f"/projects/{quote(project, safe='')}/variables"
+
+
+def _get_group_variables_path(group: str) -> str:
+    """
+    Gets the API path of the variables of the given group.
+    :param group: the group (including any parent groups)
+    :return: the API path (relative to the API root)
+    """
+    return f"/groups/{quote(group, safe='')}/variables"
+
+
+def _select_environment_variables(json_variables: List[Dict], environment_scope: str) -> List[Dict]:
+    """
+    Selects the variables that apply to the given environment. A variable applies if its environment scope (which may
+    contain wildcards) matches the environment. Where more than one variable with the same key applies, the one with
+    an exactly matching scope is selected over one with a wildcard scope, which is selected over one that applies to all
+    environments.
+    :param json_variables: the variables, as given by GitLab
+    :param environment_scope: the environment
+    :return: the selected variables
+    """
+    def get_precedence(scope: str) -> int:
+        if scope == environment_scope:
+            return 2
+        return 0 if scope == _ALL_ENVIRONMENTS_SCOPE else 1
+
+    selected: Dict[str, Tuple[int, Dict]] = {}
+    for variable in json_variables:
+        scope = variable.get(_VARIABLE_ENVIRONMENT_SCOPE_PROPERTY) or _ALL_ENVIRONMENTS_SCOPE
+        if not fnmatchcase(environment_scope, scope):
+            continue
+        precedence = get_precedence(scope)
+        key = variable[_VARIABLE_KEY_PROPERTY]
+        if key not in selected or precedence >= selected[key][0]:
+            selected[key] = (precedence, variable)
+    return [variable for _, variable in selected.values()]
@@ -1,23 +1,138 @@
+import hashlib
+import json
+import logging
 import os
 
-import yaml
-from typing import NamedTuple
+from typing import NamedTuple, List, Dict, Optional, Any
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_CACHE_DIRECTORY, DEFAULT_FAILURE_THRESHOLD, \
+    DEFAULT_RESET_TIMEOUT, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES, DEFAULT_SINGLE_FLIGHT_WAIT
 
 GITLAB_PROPERTY = "gitlab"
 GITLAB_URL_PROPERTY = "url"
 GITLAB_TOKEN_PROPERTY = "token"
 GITLAB_PROJECT_PROPERTY = "project"
+GITLAB_PROJECTS_PROPERTY = "projects"
 GITLAB_NAMESPACE_PROPERTY = "namespace"
+GITLAB_SSL_VERIFY_PROPERTY = "ssl-verify"
+GITLAB_INCLUDE_PROPERTY = "include"
+GITLAB_EXCLUDE_PROPERTY = "exclude"
+GITLAB_ENVIRONMENT_SCOPE_PROPERTY = "environment-scope"
+GITLAB_CONNECT_TIMEOUT_PROPERTY = "connect-timeout"
+GITLAB_READ_TIMEOUT_PROPERTY = "read-timeout"
+GITLAB_RETRIES_PROPERTY = "retries"
+GITLAB_HEDGE_PERCENTILE_PROPERTY = "hedge-percentile"
+GITLAB_CIRCUIT_BREAKER_PROPERTY = "circuit-breaker"
+CIRCUIT_BREAKER_FAILURES_PROPERTY = "failures"
+CIRCUIT_BREAKER_RESET_TIMEOUT_PROPERTY = "reset-timeout"
+
+CACHE_PROPERTY = "cache"
+CACHE_TTL_PROPERTY = "ttl"
+CACHE_STALE_WHILE_REVALIDATE_PROPERTY = "stale-while-revalidate"
+CACHE_LOCATION_PROPERTY = "location"
+
+AGENT_PROPERTY = "agent"
+AGENT_SOCKET_PROPERTY = "socket"
+AGENT_TTL_PROPERTY = "ttl"
+
+SECRET_FILES_PROPERTY = "secret-files"
+SECRET_FILES_KEYS_PROPERTY = "keys"
+SECRET_FILES_SIZE_THRESHOLD_PROPERTY = "size-threshold"
+SECRET_FILES_MULTILINE_PROPERTY = "multiline"
+
+SINGLE_FLIGHT_PROPERTY = "single-flight"
+SINGLE_FLIGHT_WAIT_PROPERTY = "wait"
+
+_COMPILED_CONFIGURATION_PREFIX = "configuration-"
+_COMPILED_CONFIGURATION_SUFFIX = ".json"
+_COMPILED_SOURCE_PROPERTY = "source"
+_COMPILED_CONFIGURATION_PROPERTY = "configuration"
+_PRIVATE_FILE_PERMISSIONS_MASK = 0o077
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_AGENT_SOCKET_LOCATION = os.path.join(
+    os.environ["XDG_RUNTIME_DIR"], "dockerwithgitlabsecrets", "agent.sock") if "XDG_RUNTIME_DIR" in os.environ \
+    else os.path.join(DEFAULT_CACHE_DIRECTORY, "agent.sock")
+
+
+class CircuitBreakerConfiguration(NamedTuple):
+    """
+    Configuration of the circuit breaker around requests to GitLab (disabled if the failure threshold is not positive).
+    Its state is stored in the directory given as the cache location.
+    """
+    failure_threshold: int = DEFAULT_FAILURE_THRESHOLD
+    reset_timeout: float = DEFAULT_RESET_TIMEOUT
+    directory: str = DEFAULT_CACHE_DIRECTORY
 
 
 class GitLabConfiguration(NamedTuple):
     """
-    GitLab configuration.
+    GitLab configuration. Only variables with keys that match one of the `include` glob patterns (if any) and none of
+    the `exclude` glob patterns are used. If `environment_scope` is set, only variables that apply to that environment
+    are used. If `hedge_percentile` is set, a second request is made if there is no response to a request within that
+    percentile of the latencies of recent requests.
     """
     url: str
     token: str
     project: str = None
     namespace: str = None
+    projects: List[str] = []
+    ssl_verify: bool = True
+    include: List[str] = []
+    exclude: List[str] = []
+    environment_scope: str = None
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+    read_timeout: float = DEFAULT_READ_TIMEOUT
+    retries: int = DEFAULT_RETRIES
+    hedge_percentile: float = None
+    circuit_breaker: CircuitBreakerConfiguration = CircuitBreakerConfiguration()
+
+    def get_default_sources(self) -> List[str]:
+        """
+        Gets the default variable sources, in order of increasing precedence.
+        :return: the default sources (`projects`, if defined, else `project`)
+        """
+        if len(self.projects) > 0:
+            return self.projects
+        return [self.project] if self.project is not None else []
+
+
+class CacheConfiguration(NamedTuple):
+    """
+    Variables cache configuration (the cache is disabled if the TTL is not positive).
+    """
+    ttl: float = 0
+    stale_while_revalidate: float = 0
+    location: str = DEFAULT_CACHE_DIRECTORY
+
+
+class AgentConfiguration(NamedTuple):
+    """
+    Secrets agent configuration.
+    """
+    socket: str = DEFAULT_AGENT_SOCKET_LOCATION
+    ttl: float = 60
+
+
+class SecretFilesConfiguration(NamedTuple):
+    """
+    Configuration of which variables are given to containers as read-only files, rather than set in the environment. A
+    variable is given as a file if its key matches one of the `keys` glob patterns, if its value is at least
+    `size_threshold` bytes (if positive) or if `multiline` and its value contains line breaks.
+    """
+    keys: List[str] = []
+    size_threshold: int = 0
+    multiline: bool = False
+
+
+class SingleFlightConfiguration(NamedTuple):
+    """
+    Configuration of how variables fetches are shared between concurrent processes (disabled, by default, if the wait
+    is not positive).
+    """
+    wait: float = DEFAULT_SINGLE_FLIGHT_WAIT
 
 
 class Configuration(NamedTuple):
@@ -25,6 +140,10 @@ class Configuration(NamedTuple):
     Program configuration.
     """
     gitlab: GitLabConfiguration
+    cache: CacheConfiguration = CacheConfiguration()
+    agent: AgentConfiguration = AgentConfiguration()
+    secret_files: SecretFilesConfiguration = SecretFilesConfiguration()
+    single_flight: SingleFlightConfiguration = SingleFlightConfiguration()
 
 
 def parse_configuration(configuration_location: str) -> Configuration:
@@ -35,20 +154,176 @@ def parse_configuration(configuration_location: str) -> Configuration:
     """
     if not (os.path.isfile(configuration_location) and os.access(configuration_location, os.R_OK)):
         raise ValueError(f"Cannot read configuration file: {configuration_location}")
+    return _create_configuration(_read_configuration_file(configuration_location))
+
+
+def load_configuration(configuration_location: str, compiled_directory: Optional[str]=DEFAULT_CACHE_DIRECTORY) \
+        -> Configuration:
+    """
+    Loads the program configuration in the given file, from its compiled form if the file has not changed since it was
+    compiled, so that the YAML does not need to be parsed (or the YAML library imported). Otherwise, the file is parsed
+    and compiled.
+
+    The compiled configuration is stored as JSON, in a file that only the current user can read (in a directory that
+    only the current user can access) as the configuration contains the GitLab token. It is used whilst the location,
+    modification time, size and inode of the configuration file are unchanged, and only if it is still private to the
+    current user.
+    :param configuration_location: the location of the configuration file to load
+    :param compiled_directory: the directory in which to store the compiled configuration (`None` to always parse the
+    configuration file)
+    :return: the configuration
+    """
+    if compiled_directory is None:
+        return parse_configuration(configuration_location)
+    try:
+        status = os.stat(configuration_location)
+    except OSError:
+        raise ValueError(f"Cannot read configuration file: {configuration_location}")
+
+    absolute_location = os.path.abspath(configuration_location)
+    source = [absolute_location, status.st_mtime_ns, status.st_size, status.st_ino]
+    compiled_location = os.path.join(compiled_directory, f"{_COMPILED_CONFIGURATION_PREFIX}"
+                                     f"{hashlib.sha256(absolute_location.encode(_ENCODING)).hexdigest()}"
+                                     f"{_COMPILED_CONFIGURATION_SUFFIX}")
+    json_configuration = _read_compiled_configuration(compiled_location, source)
+    if json_configuration is None:
+        json_configuration = _read_configuration_file(configuration_location)
+        _write_compiled_configuration(compiled_location, source, json_configuration)
+    return _create_configuration(json_configuration)
+
+
+def _read_configuration_file(configuration_location: str) -> Dict[str, Any]:
+    """
+    Reads the given configuration file.
+    :param configuration_location: the location of the configuration file
+    :return: the parsed YAML of the configuration
+    :raises ValueError: if the file cannot be read
+    """
+    # Imported here to avoid the import cost for Docker commands that do not need the configuration
+    import yaml
+    try:
+        with open(configuration_location, "r") as file:
+            # Use the (much faster) loader of the LibYAML bindings, if PyYAML has been built with them
+            return yaml.load(file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except OSError as e:
+        raise ValueError(f"Cannot read configuration file: {configuration_location}") from e
+
+
+def _read_compiled_configuration(compiled_location: str, source: List[Any]) -> Optional[Dict[str, Any]]:
+    """
+    Reads the given compiled configuration, if it was compiled from the given source.
+    :param compiled_location: the location of the compiled configuration
+    :param source: the location, modification time, size and inode of the configuration file
+    :return: the parsed YAML of the configuration or `None` if there is no (up to date and private) compiled
+    configuration
+    """
+    try:
+        with open(compiled_location, "r", encoding=_ENCODING) as file:
+            status = os.fstat(file.fileno())
+            if status.st_uid != os.getuid() or status.st_mode & _PRIVATE_FILE_PERMISSIONS_MASK != 0:
+                # It is replaced with a private file when the configuration is compiled again
+                _logger.warning(f"Ignoring compiled configuration \"{compiled_location}\" as it is not private to the "
+                                f"current user")
+                return None
+            compiled = json.load(file)
+        if compiled[_COMPILED_SOURCE_PROPERTY] != source:
+            return None
+        return compiled[_COMPILED_CONFIGURATION_PROPERTY]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        _logger.warning(f"Ignoring unreadable compiled configuration \"{compiled_location}\": {e}")
+        return None
 
-    with open(configuration_location, "r") as file:
-        json_configuration = yaml.load(file)
 
+def _write_compiled_configuration(compiled_location: str, source: List[Any], json_configuration: Dict[str, Any]):
+    """
+    Writes the given compiled configuration.
+    :param compiled_location: the location of the compiled configuration
+    :param source: the location, modification time, size and inode of the configuration file
+    :param json_configuration: the parsed YAML of the configuration
+    """
+    # Imported here so that loading a compiled configuration does not import the cache
+    from dockerwithgitlabsecrets.cache import ensure_private_directory, write_private_file
+    try:
+        contents = json.dumps({_COMPILED_SOURCE_PROPERTY: source, _COMPILED_CONFIGURATION_PROPERTY: json_configuration})
+        if ensure_private_directory(os.path.dirname(compiled_location)):
+            write_private_file(compiled_location, contents.encode(_ENCODING))
+    except (OSError, TypeError, ValueError) as e:
+        # e.g. the cache directory is read-only or the YAML contains values that cannot be represented in JSON
+        _logger.info(f"Could not compile configuration: {e}")
+
+
+def _create_configuration(json_configuration: Dict[str, Any]) -> Configuration:
+    """
+    Creates the program configuration from the given parsed YAML.
+    :param json_configuration: the parsed YAML of the configuration
+    :return: the configuration
+    """
     project = json_configuration[GITLAB_PROPERTY][GITLAB_PROJECT_PROPERTY] \
         if GITLAB_PROJECT_PROPERTY in json_configuration[GITLAB_PROPERTY] else None
     namespace = json_configuration[GITLAB_PROPERTY][GITLAB_NAMESPACE_PROPERTY] \
         if GITLAB_NAMESPACE_PROPERTY in json_configuration[GITLAB_PROPERTY] else None
 
+    json_cache_configuration = json_configuration.get(CACHE_PROPERTY) or {}
+    cache_configuration = CacheConfiguration(
+        ttl=json_cache_configuration.get(CACHE_TTL_PROPERTY, CacheConfiguration._field_defaults["ttl"]),
+        stale_while_revalidate=json_cache_configuration.get(
+            CACHE_STALE_WHILE_REVALIDATE_PROPERTY, CacheConfiguration._field_defaults["stale_while_revalidate"]),
+        location=os.path.expanduser(json_cache_configuration.get(
+            CACHE_LOCATION_PROPERTY, CacheConfiguration._field_defaults["location"]))
+    )
+
+    json_circuit_breaker_configuration = json_configuration[GITLAB_PROPERTY].get(GITLAB_CIRCUIT_BREAKER_PROPERTY) or {}
+    circuit_breaker_configuration = CircuitBreakerConfiguration(
+        failure_threshold=json_circuit_breaker_configuration.get(
+            CIRCUIT_BREAKER_FAILURES_PROPERTY, CircuitBreakerConfiguration._field_defaults["failure_threshold"]),
+        reset_timeout=json_circuit_breaker_configuration.get(
+            CIRCUIT_BREAKER_RESET_TIMEOUT_PROPERTY, CircuitBreakerConfiguration._field_defaults["reset_timeout"]),
+        directory=cache_configuration.location
+    )
+
     gitlab_configuration = GitLabConfiguration(
         url=json_configuration[GITLAB_PROPERTY][GITLAB_URL_PROPERTY],
         token=json_configuration[GITLAB_PROPERTY][GITLAB_TOKEN_PROPERTY],
         project=project,
-        namespace=namespace
+        namespace=namespace,
+        projects=json_configuration[GITLAB_PROPERTY].get(GITLAB_PROJECTS_PROPERTY) or [],
+        ssl_verify=json_configuration[GITLAB_PROPERTY].get(GITLAB_SSL_VERIFY_PROPERTY, True),
+        include=json_configuration[GITLAB_PROPERTY].get(GITLAB_INCLUDE_PROPERTY) or [],
+        exclude=json_configuration[GITLAB_PROPERTY].get(GITLAB_EXCLUDE_PROPERTY) or [],
+        environment_scope=json_configuration[GITLAB_PROPERTY].get(GITLAB_ENVIRONMENT_SCOPE_PROPERTY),
+        connect_timeout=json_configuration[GITLAB_PROPERTY].get(
+            GITLAB_CONNECT_TIMEOUT_PROPERTY, GitLabConfiguration._field_defaults["connect_timeout"]),
+        read_timeout=json_configuration[GITLAB_PROPERTY].get(
+            GITLAB_READ_TIMEOUT_PROPERTY, GitLabConfiguration._field_defaults["read_timeout"]),
+        retries=json_configuration[GITLAB_PROPERTY].get(
+            GITLAB_RETRIES_PROPERTY, GitLabConfiguration._field_defaults["retries"]),
+        hedge_percentile=json_configuration[GITLAB_PROPERTY].get(GITLAB_HEDGE_PERCENTILE_PROPERTY),
+        circuit_breaker=circuit_breaker_configuration
+    )
+
+    json_agent_configuration = json_configuration.get(AGENT_PROPERTY) or {}
+    agent_configuration = AgentConfiguration(
+        socket=os.path.expanduser(json_agent_configuration.get(
+            AGENT_SOCKET_PROPERTY, AgentConfiguration._field_defaults["socket"])),
+        ttl=json_agent_configuration.get(AGENT_TTL_PROPERTY, AgentConfiguration._field_defaults["ttl"])
+    )
+
+    json_secret_files_configuration = json_configuration.get(SECRET_FILES_PROPERTY) or {}
+    secret_files_configuration = SecretFilesConfiguration(
+        keys=json_secret_files_configuration.get(SECRET_FILES_KEYS_PROPERTY) or [],
+        size_threshold=json_secret_files_configuration.get(
+            SECRET_FILES_SIZE_THRESHOLD_PROPERTY, SecretFilesConfiguration._field_defaults["size_threshold"]),
+        multiline=json_secret_files_configuration.get(
+            SECRET_FILES_MULTILINE_PROPERTY, SecretFilesConfiguration._field_defaults["multiline"])
+    )
+
+    json_single_flight_configuration = json_configuration.get(SINGLE_FLIGHT_PROPERTY) or {}
+    single_flight_configuration = SingleFlightConfiguration(
+        wait=json_single_flight_configuration.get(
+            SINGLE_FLIGHT_WAIT_PROPERTY, SingleFlightConfiguration._field_defaults["wait"])
     )
 
-    return Configuration(gitlab=gitlab_configuration)
+    return Configuration(gitlab=gitlab_configuration, cache=cache_configuration, agent=agent_configuration,
+                         secret_files=secret_files_configuration, single_flight=single_flight_configuration)
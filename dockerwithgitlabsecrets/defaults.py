@@ -0,0 +1,27 @@
+import os
+
+# Defaults (and names) shared by the configuration and command line and the modules that they configure. Kept free of
+# (slow to import) dependencies, so that the configuration and command line can be loaded without importing the modules
+# that use them.
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "dockerwithgitlabsecrets")
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRIES = 2
+
+DEFAULT_FAILURE_THRESHOLD = 0
+DEFAULT_RESET_TIMEOUT = 60.0
+
+# Single flight is disabled by default
+DEFAULT_SINGLE_FLIGHT_WAIT = 0.0
+
+DOCKER_BACKEND_CLI = "cli"
+DOCKER_BACKEND_ENGINE = "engine"
+DOCKER_BACKENDS = [DOCKER_BACKEND_CLI, DOCKER_BACKEND_ENGINE]
+DEFAULT_DOCKER_BACKEND = DOCKER_BACKEND_CLI
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE = "DWGS_BUNDLE_PASSPHRASE"
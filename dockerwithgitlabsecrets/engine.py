@@ -0,0 +1,464 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+from queue import LifoQueue, Empty
+from urllib.parse import quote, urlencode
+
+from typing import Dict, List, NamedTuple, Optional, Tuple, Iterator, Any
+
+from dockerwithgitlabsecrets.defaults import DOCKER_BACKEND_CLI, DOCKER_BACKEND_ENGINE, DOCKER_BACKENDS, \
+    DEFAULT_DOCKER_BACKEND
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_HOST_ENVIRONMENT_VARIABLE = "DOCKER_HOST"
+DOCKER_CONTEXT_ENVIRONMENT_VARIABLE = "DOCKER_CONTEXT"
+DOCKER_CONFIG_ENVIRONMENT_VARIABLE = "DOCKER_CONFIG"
+API_VERSION = "1.41"
+DEFAULT_TIMEOUT = 60.0
+
+STDOUT_STREAM = 1
+STDERR_STREAM = 2
+
+_UNIX_SCHEME = "unix://"
+_DEFAULT_CONTEXT = "default"
+_CURRENT_CONTEXT_PROPERTY = "currentContext"
+_DEFAULT_DOCKER_CONFIG_DIRECTORY = os.path.join(os.path.expanduser("~"), ".docker")
+_DOCKER_CONFIG_FILE = "config.json"
+_FRAME_HEADER_FORMAT = ">BxxxL"
+_FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER_FORMAT)
+_NO_CONTENT_STATUS = 204
+_ENCODING = "utf-8"
+
+_REMOVE_PARAMETER = "--rm"
+_NAME_PARAMETER = "--name"
+_MOUNT_PARAMETER = "--mount"
+_BIND_MOUNT_TYPE = "bind"
+_BIND_MOUNT_READ_ONLY_OPTIONS = ["readonly", "ro", "readonly=true", "ro=true"]
+_BIND_MOUNT_SOURCE_OPTIONS = ["source", "src"]
+_BIND_MOUNT_TARGET_OPTIONS = ["target", "destination", "dst"]
+_ENV_PARAMETERS = ["-e", "--env"]
+_LABEL_PARAMETERS = ["-l", "--label"]
+_VOLUME_PARAMETERS = ["-v", "--volume"]
+_SINGLE_VALUE_PARAMETERS = {
+    "-w": "WorkingDir", "--workdir": "WorkingDir",
+    "-u": "User", "--user": "User",
+    "-h": "Hostname", "--hostname": "Hostname"
+}
+_HOST_SINGLE_VALUE_PARAMETERS = {
+    "--network": "NetworkMode", "--net": "NetworkMode"
+}
+_HOST_FLAG_PARAMETERS = {
+    "--init": "Init",
+    "--read-only": "ReadonlyRootfs"
+}
+_ENTRYPOINT_PARAMETER = "--entrypoint"
+
+_logger = logging.getLogger(__name__)
+
+_clients: Dict[str, "DockerEngineClient"] = {}
+_clients_lock = threading.Lock()
+
+
+class DockerEngineError(Exception):
+    """
+    Error response from the Docker Engine.
+    """
+    def __init__(self, status: int, path: str, message: str):
+        super().__init__(f"Docker Engine responded to {path} with {status}: {message}")
+        self.status = status
+        self.path = path
+        self.message = message
+
+
+class RunConfiguration(NamedTuple):
+    """
+    Configuration of a container to run via the Docker Engine API, equivalent to the arguments of `docker run`.
+    """
+    container: Dict[str, Any]
+    name: Optional[str] = None
+    remove: bool = False
+
+
+def get_docker_socket_location() -> Optional[str]:
+    """
+    Gets the location of the socket of the Docker Engine that the Docker CLI would use.
+    :return: the location of the socket or `None` if the Docker CLI would not use a local socket (e.g. if `DOCKER_HOST`
+    is a TCP address or a Docker context is used)
+    """
+    docker_host = os.environ.get(DOCKER_HOST_ENVIRONMENT_VARIABLE)
+    if docker_host is not None:
+        return docker_host[len(_UNIX_SCHEME):] if docker_host.startswith(_UNIX_SCHEME) else None
+    if _get_docker_context() != _DEFAULT_CONTEXT:
+        return None
+    return DEFAULT_DOCKER_SOCKET
+
+
+def parse_run_arguments(run_arguments: List[str], variables: Dict[str, str]) -> Optional[RunConfiguration]:
+    """
+    Parses the given arguments of `docker run` into the configuration of the container to run, with the given
+    variables set in its environment.
+
+    Only a subset of the arguments of `docker run` is supported: `--rm`, `--name`, `-e`/`--env`, `-l`/`--label`,
+    `-v`/`--volume`, bind `--mount`s, `-w`/`--workdir`, `-u`/`--user`, `-h`/`--hostname`, `--network`,
+    `--entrypoint`, `--init` and `--read-only`.
+    :param run_arguments: the arguments given to `docker run` (i.e. after `run`)
+    :param variables: the variables
+    :return: the run configuration or `None` if the arguments are not supported
+    """
+    environment = dict(variables)
+    labels: Dict[str, str] = {}
+    container: Dict[str, Any] = {"AttachStdout": True, "AttachStderr": True}
+    host_configuration: Dict[str, Any] = {}
+    name = None
+    remove = False
+
+    index = 0
+    while index < len(run_arguments) and run_arguments[index].startswith("-"):
+        parameter, separator, value = run_arguments[index].partition("=")
+        if not parameter.startswith("--") and separator != "":
+            # Short parameters given with "=" (e.g. `-e=KEY=value`) are left to the Docker CLI
+            return None
+        if parameter in (_REMOVE_PARAMETER, *_HOST_FLAG_PARAMETERS.keys()):
+            if separator != "":
+                return None
+            if parameter == _REMOVE_PARAMETER:
+                remove = True
+            else:
+                host_configuration[_HOST_FLAG_PARAMETERS[parameter]] = True
+            index += 1
+            continue
+
+        if parameter not in (_NAME_PARAMETER, _MOUNT_PARAMETER, _ENTRYPOINT_PARAMETER, *_ENV_PARAMETERS,
+                             *_LABEL_PARAMETERS, *_VOLUME_PARAMETERS, *_SINGLE_VALUE_PARAMETERS.keys(),
+                             *_HOST_SINGLE_VALUE_PARAMETERS.keys()):
+            return None
+        if separator == "":
+            index += 1
+            if index == len(run_arguments):
+                return None
+            value = run_arguments[index]
+        index += 1
+
+        if parameter in _ENV_PARAMETERS:
+            key, separator, env_value = value.partition("=")
+            if separator != "":
+                environment[key] = env_value
+            elif key in os.environ:
+                environment[key] = os.environ[key]
+        elif parameter in _LABEL_PARAMETERS:
+            key, _, label_value = value.partition("=")
+            labels[key] = label_value
+        elif parameter in _VOLUME_PARAMETERS:
+            host_configuration.setdefault("Binds", []).append(value)
+        elif parameter == _MOUNT_PARAMETER:
+            mount = _parse_bind_mount(value)
+            if mount is None:
+                return None
+            host_configuration.setdefault("Mounts", []).append(mount)
+        elif parameter == _NAME_PARAMETER:
+            name = value
+        elif parameter == _ENTRYPOINT_PARAMETER:
+            container["Entrypoint"] = [value]
+        elif parameter in _SINGLE_VALUE_PARAMETERS:
+            container[_SINGLE_VALUE_PARAMETERS[parameter]] = value
+        else:
+            host_configuration[_HOST_SINGLE_VALUE_PARAMETERS[parameter]] = value
+
+    if index == len(run_arguments):
+        return None
+    container["Image"] = run_arguments[index]
+    if index + 1 < len(run_arguments):
+        container["Cmd"] = run_arguments[index + 1:]
+    container["Env"] = [f"{key}={value}" for key, value in environment.items()]
+    if len(labels) > 0:
+        container["Labels"] = labels
+    container["HostConfig"] = host_configuration
+    return RunConfiguration(container=container, name=name, remove=remove)
+
+
+def get_engine_client(socket_location: str) -> "DockerEngineClient":
+    """
+    Gets the client of the Docker Engine listening on the given socket, which is shared so that its connections are
+    reused.
+    :param socket_location: location of the Docker Engine's socket
+    :return: the client
+    """
+    with _clients_lock:
+        if socket_location not in _clients:
+            _clients[socket_location] = DockerEngineClient(socket_location)
+        return _clients[socket_location]
+
+
+def read_output_frames(attachment: http.client.HTTPResponse) -> Iterator[Tuple[int, bytes]]:
+    """
+    Reads the multiplexed stdout and stderr of a container without a TTY, from the given attachment to it, until the
+    container closes them.
+    :param attachment: the attachment to the container (see `DockerEngineClient.attach_container`)
+    :return: iterator of tuples where the first element is the stream (`STDOUT_STREAM` or `STDERR_STREAM`) and the
+    second is the data written to it
+    """
+    while True:
+        header = _read_exactly(attachment, _FRAME_HEADER_SIZE)
+        if len(header) < _FRAME_HEADER_SIZE:
+            return
+        stream, size = struct.unpack(_FRAME_HEADER_FORMAT, header)
+        data = _read_exactly(attachment, size)
+        if len(data) > 0:
+            yield stream, data
+        if len(data) < size:
+            return
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+    def __init__(self, socket_location: str, timeout: Optional[float]):
+        """
+        Constructor.
+        :param socket_location: location of the socket
+        :param timeout: seconds to wait to connect to, or get a response from, the server (`None` to wait indefinitely)
+        """
+        super().__init__("localhost", timeout=timeout)
+        self.socket_location = socket_location
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_location)
+
+
+class DockerEngineClient:
+    """
+    Client of the Docker Engine API, over the Engine's Unix socket, that reuses (keep-alive) connections.
+    """
+    def __init__(self, socket_location: str, timeout: float=DEFAULT_TIMEOUT):
+        """
+        Constructor.
+        :param socket_location: location of the Docker Engine's socket
+        :param timeout: seconds to wait for the Docker Engine to respond (other than whilst attached to a container or
+        waiting for it to exit)
+        """
+        self.socket_location = socket_location
+        self.timeout = timeout
+        self._idle_connections: LifoQueue = LifoQueue()
+
+    def is_available(self) -> bool:
+        """
+        Gets whether the Docker Engine may be listening on the socket.
+        :return: whether the socket exists
+        """
+        return os.path.exists(self.socket_location)
+
+    def create_container(self, configuration: Dict[str, Any], name: str=None) -> str:
+        """
+        Creates a container.
+        :param configuration: the container configuration
+        :param name: the name of the container (generated if `None`)
+        :return: the ID of the container
+        :raises DockerEngineError: if the container could not be created (with status 404 if the image is not present)
+        """
+        query = f"?{urlencode({'name': name})}" if name is not None else ""
+        return self._request("POST", f"/containers/create{query}", configuration)["Id"]
+
+    def attach_container(self, container_id: str) -> http.client.HTTPResponse:
+        """
+        Attaches to the stdout and stderr of the given container, on a connection of its own (which should be closed
+        once the output has been read). Attach before starting the container so that no output is missed.
+        :param container_id: the ID of the container
+        :return: the attachment, from which the container's output can be read (see `read_output_frames`)
+        :raises DockerEngineError: if the container could not be attached to
+        """
+        path = f"/containers/{quote(container_id)}/attach?{urlencode({'stream': 1, 'stdout': 1, 'stderr': 1})}"
+        connection = _UnixHTTPConnection(self.socket_location, None)
+        try:
+            response = self._send(connection, "POST", path)
+            if response.status >= 400:
+                self._read_response(response, path)
+        except BaseException:
+            connection.close()
+            raise
+        return response
+
+    def start_container(self, container_id: str):
+        """
+        Starts the given container.
+        :param container_id: the ID of the container
+        :raises DockerEngineError: if the container could not be started (e.g. if its command could not be found)
+        """
+        self._request("POST", f"/containers/{quote(container_id)}/start")
+
+    def wait_container(self, container_id: str) -> int:
+        """
+        Waits (indefinitely) for the given container to exit.
+        :param container_id: the ID of the container
+        :return: the container's exit code
+        """
+        path = f"/containers/{quote(container_id)}/wait"
+        connection = _UnixHTTPConnection(self.socket_location, None)
+        try:
+            return self._read_response(self._send(connection, "POST", path), path)["StatusCode"]
+        finally:
+            connection.close()
+
+    def kill_container(self, container_id: str):
+        """
+        Kills the given container.
+        :param container_id: the ID of the container
+        """
+        self._request("POST", f"/containers/{quote(container_id)}/kill")
+
+    def remove_container(self, container_id: str):
+        """
+        Removes the given container, with its anonymous volumes.
+        :param container_id: the ID of the container
+        """
+        self._request("DELETE", f"/containers/{quote(container_id)}?{urlencode({'v': 1, 'force': 1})}")
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except Empty:
+                return
+
+    def _request(self, method: str, path: str, json_body: Dict[str, Any]=None) -> Any:
+        """
+        Makes a request to the Docker Engine API, on a pooled connection.
+        :param method: the request method
+        :param path: the API path (relative to the versioned API root)
+        :param json_body: the JSON request body (optional)
+        :return: see `_read_response`
+        :raises DockerEngineError: if the Docker Engine responds with an error
+        """
+        try:
+            connection, reused = self._idle_connections.get_nowait(), True
+        except Empty:
+            connection, reused = _UnixHTTPConnection(self.socket_location, self.timeout), False
+        try:
+            try:
+                response = self._send(connection, method, path, json_body)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The Docker Engine closed the idle keep-alive connection: retry on a new connection
+                connection.close()
+                connection = _UnixHTTPConnection(self.socket_location, self.timeout)
+                response = self._send(connection, method, path, json_body)
+            response_body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle_connections.put(connection)
+        return self._read_response(response, path, response_body)
+
+    def _send(self, connection: http.client.HTTPConnection, method: str, path: str,
+              json_body: Dict[str, Any]=None) -> http.client.HTTPResponse:
+        """
+        Sends a request to the Docker Engine API using the given connection.
+        :param connection: the connection
+        :param method: the request method
+        :param path: the API path (relative to the versioned API root)
+        :param json_body: the JSON request body (optional)
+        :return: the response
+        """
+        body = json.dumps(json_body).encode(_ENCODING) if json_body is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        connection.request(method, f"/v{API_VERSION}{path}", body=body, headers=headers)
+        return connection.getresponse()
+
+    def _read_response(self, response: http.client.HTTPResponse, path: str, body: bytes=None) -> Any:
+        """
+        Reads the given response from the Docker Engine API.
+        :param response: the response
+        :param path: the API path that the response is to
+        :param body: the response body, if it has already been read
+        :return: the JSON response (`None` if there is no content)
+        :raises DockerEngineError: if the response is an error
+        """
+        if body is None:
+            body = response.read()
+        _logger.debug(f"{path}: {response.status}")
+        if response.status >= 400:
+            raise DockerEngineError(response.status, path, _get_error_message(body))
+        if response.status == _NO_CONTENT_STATUS or len(body) == 0:
+            return None
+        return json.loads(body.decode(_ENCODING))
+
+
+def _get_docker_context() -> str:
+    """
+    Gets the Docker context that the Docker CLI would use.
+    :return: the name of the context
+    """
+    context = os.environ.get(DOCKER_CONTEXT_ENVIRONMENT_VARIABLE)
+    if context is not None:
+        return context
+    config_location = os.path.join(
+        os.environ.get(DOCKER_CONFIG_ENVIRONMENT_VARIABLE, _DEFAULT_DOCKER_CONFIG_DIRECTORY), _DOCKER_CONFIG_FILE)
+    try:
+        with open(config_location, "r") as file:
+            return json.load(file).get(_CURRENT_CONTEXT_PROPERTY) or _DEFAULT_CONTEXT
+    except (OSError, ValueError, AttributeError):
+        return _DEFAULT_CONTEXT
+
+
+def _parse_bind_mount(value: str) -> Optional[Dict[str, Any]]:
+    """
+    Parses the value of a `docker run --mount` argument, if it is a bind mount.
+    :param value: the value (e.g. "type=bind,source=/a,target=/b,readonly")
+    :return: the mount configuration or `None` if it is not a bind mount with only a source, target and read-only option
+    """
+    mount: Dict[str, Any] = {}
+    for option in value.split(","):
+        key, _, option_value = option.partition("=")
+        if key == "type" and option_value == _BIND_MOUNT_TYPE:
+            mount["Type"] = _BIND_MOUNT_TYPE
+        elif key in _BIND_MOUNT_SOURCE_OPTIONS:
+            mount["Source"] = option_value
+        elif key in _BIND_MOUNT_TARGET_OPTIONS:
+            mount["Target"] = option_value
+        elif option in _BIND_MOUNT_READ_ONLY_OPTIONS:
+            mount["ReadOnly"] = True
+        else:
+            return None
+    return mount if {"Type", "Source", "Target"} <= mount.keys() else None
+
+
+def _get_error_message(body: bytes) -> str:
+    """
+    Gets the error message from the given body of an error response from the Docker Engine.
+    :param body: the response body
+    :return: the error message
+    """
+    try:
+        return json.loads(body.decode(_ENCODING))["message"]
+    except (ValueError, KeyError, TypeError):
+        return body.decode(_ENCODING, errors="replace")
+
+
+def _read_exactly(response: http.client.HTTPResponse, size: int) -> bytes:
+    """
+    Reads the given number of bytes from the given response, unless it ends first.
+    :param response: the response
+    :param size: the number of bytes to read
+    :return: the bytes read
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = response.read(size - len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return bytes(data)
@@ -1,33 +1,112 @@
+import json
+import logging
 import os
+import signal
 from argparse import ArgumentParser
+from collections import Counter
+from contextlib import contextmanager
 
 import sys
 
-from gitlabbuildvariables.common import GitLabConfig
-from gitlabbuildvariables.manager import ProjectVariablesManager
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Dict, Callable, Optional, Tuple, Any, TYPE_CHECKING
 
-from dockerwithgitlabsecrets.configuration import parse_configuration
-from dockerwithgitlabsecrets.wrapper import run_wrapped, ProgramOutputType, get_supported_action_index
+from dockerwithgitlabsecrets.cache import VariablesCache
+from dockerwithgitlabsecrets.circuitbreaker import CircuitOpenError
+from dockerwithgitlabsecrets.configuration import load_configuration, Configuration, GitLabConfiguration
+from dockerwithgitlabsecrets.defaults import DEFAULT_DOCKER_BACKEND, DOCKER_BACKENDS, DOCKER_BACKEND_ENGINE, \
+    DEFAULT_MAX_CONCURRENCY, BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE
+from dockerwithgitlabsecrets.envfile import DEFAULT_ENV_FILE_BACKEND, ENV_FILE_BACKENDS
+from dockerwithgitlabsecrets.metrics import METRICS_ENVIRONMENT_VARIABLE, PROJECT_PROPERTY, EXIT_CODE_PROPERTY, \
+    ERROR_EXIT_CODE, GITLAB_RESPONSES_PROPERTY, GITLAB_REQUEST_DURATIONS_PROPERTY, GITLAB_RETRIES_PROPERTY, \
+    GITLAB_HEDGES_PROPERTY
+from dockerwithgitlabsecrets.profiling import Profiler, NULL_PROFILER, PROFILE_ENVIRONMENT_VARIABLE, \
+    STDERR_LOCATION, CONFIGURATION_PHASE, VARIABLES_PHASE
+from dockerwithgitlabsecrets.secretfiles import select_secret_file_keys
+from dockerwithgitlabsecrets.variables import fetch_variables, parse_sources, namespace_source, \
+    get_merged_variables, find_client, GROUP_SOURCE_PREFIX, SOURCE_SEPARATOR, fetch_variables_if_changed, \
+    diff_variables, VariablesDiff, parse_key_patterns, scope_source, filter_variables, get_keys_to_fetch, \
+    KEY_PATTERN_SEPARATOR, ENVIRONMENT_SCOPE_SEPARATOR
+from dockerwithgitlabsecrets.wrapper import run_wrapped, ProgramOutputType, get_supported_action_index, \
+    INTERACTIVE_MODE_EXEC, INTERACTIVE_MODE_SPAWN
+
+if TYPE_CHECKING:
+    # Only imported where they are used (e.g. batches, bundles and the agent), so that other runs do not pay the cost of
+    # importing them (asyncio in particular)
+    from dockerwithgitlabsecrets.asynchronous import BatchResult
+    from dockerwithgitlabsecrets.bundle import Bundle
+
+AGENT_COMMAND = "agent"
+EXPORT_COMMAND = "export"
 
 CONFIG_PARAMETER = "dwgs-config"
 PROJECT_PARAMETER = "dwgs-project"
+REFRESH_PARAMETER = "dwgs-refresh"
+EXEC_PARAMETER = "dwgs-exec"
+ENV_FILE_BACKEND_PARAMETER = "dwgs-env-file-backend"
+DOCKER_BACKEND_PARAMETER = "dwgs-docker-backend"
+PROFILE_PARAMETER = "dwgs-profile"
+METRICS_PARAMETER = "dwgs-metrics"
+BATCH_PARAMETER = "dwgs-batch"
+PARALLELISM_PARAMETER = "dwgs-parallelism"
+BATCH_REPORT_PARAMETER = "dwgs-batch-report"
+DIFF_PARAMETER = "dwgs-diff"
+INCLUDE_PARAMETER = "dwgs-include"
+EXCLUDE_PARAMETER = "dwgs-exclude"
+ENVIRONMENT_SCOPE_PARAMETER = "dwgs-environment-scope"
+BUNDLE_PARAMETER = "dwgs-bundle"
 TTY_PARAMETER = "t"
 STDIN_OPEN_PARAMETER = "i"
+COMPOSE_ACTION = "compose"
+COMPOSE_RUN_ACTION = "run"
+COMPOSE_NON_INTERACTIVE_PARAMETERS = ["-T", "--no-TTY", "-d", "--detach"]
 
 DEFAULT_CONFIG_FILE = f"{os.path.expanduser('~')}/.dwgs-config.yml"
+LOG_LEVEL_ENVIRONMENT_VARIABLE = "DWGS_LOG_LEVEL"
+BATCH_STDIN_LOCATION = "-"
+
+BATCH_INDEX_PROPERTY = "index"
+BATCH_ARGUMENTS_PROPERTY = "arguments"
+BATCH_EXIT_CODE_PROPERTY = "exit_code"
+BATCH_DURATION_PROPERTY = "duration"
 
-_NAMESPACE_PROJECT_SEPARATOR = "/"
+_DEFAULT_LOG_LEVEL = "WARNING"
+
+_logger = logging.getLogger(__name__)
 
 
 class CliConfiguration(NamedTuple):
     """
-    Configuration given via the CLI.
+    Configuration given via the CLI. `project` is the (first) variables source and `projects` all of the sources (see
+    `get_projects`).
     """
     docker_args: List[str] = []
     config_location: str = None
     project: str = None
     interactive: bool = False
+    refresh: bool = False
+    exec_interactive: bool = False
+    env_file_backend: str = DEFAULT_ENV_FILE_BACKEND
+    docker_backend: str = DEFAULT_DOCKER_BACKEND
+    profile_location: str = None
+    metrics_location: str = None
+    batch_location: str = None
+    parallelism: int = DEFAULT_MAX_CONCURRENCY
+    batch_report_location: str = STDERR_LOCATION
+    diff: bool = False
+    include: List[str] = []
+    exclude: List[str] = []
+    environment_scope: str = None
+    bundle_location: str = None
+    projects: List[str] = []
+
+    def get_projects(self) -> List[str]:
+        """
+        Gets the variable sources, in order of increasing precedence.
+        :return: the sources (`projects`, if defined, else `project`)
+        """
+        if len(self.projects) > 0:
+            return self.projects
+        return [self.project] if self.project is not None else []
 
 
 def is_interactive(docker_arguments: List[str]) -> bool:
@@ -44,8 +123,12 @@ def is_interactive(docker_arguments: List[str]) -> bool:
     supported_action_index = get_supported_action_index(docker_arguments)
     if supported_action_index is None:
         return False
+    action_arguments = docker_arguments[supported_action_index:]
+    if action_arguments[0] == COMPOSE_ACTION and COMPOSE_RUN_ACTION in action_arguments:
+        # `compose run` allocates a TTY unless told not to
+        return len(set(COMPOSE_NON_INTERACTIVE_PARAMETERS) & set(action_arguments)) == 0
     return len({f"-{TTY_PARAMETER}", f"-{TTY_PARAMETER}{STDIN_OPEN_PARAMETER}",
-                f"-{STDIN_OPEN_PARAMETER}{TTY_PARAMETER}"} & set(docker_arguments[supported_action_index:])) > 0
+                f"-{STDIN_OPEN_PARAMETER}{TTY_PARAMETER}"} & set(action_arguments)) > 0
 
 
 def parse_cli_arguments(program_args: List[str]) -> CliConfiguration:
@@ -64,45 +147,609 @@ def parse_cli_arguments(program_args: List[str]) -> CliConfiguration:
         f"--{CONFIG_PARAMETER}", type=str,
         help=f"location of the configuration file (will default to {DEFAULT_CONFIG_FILE})")
     parser.add_argument(
-        f"--{PROJECT_PARAMETER}", type=str,
-        help="GitLab project (if not namespaced in the form \"namespace/project\", the default namespace defined in "
-             "the configuration file will be used). If not defined, the default project in the configuration file will "
-             "be used")
+        f"--{PROJECT_PARAMETER}", type=str, action="append", default=[],
+        help=f"GitLab project (if not namespaced in the form \"namespace/project\", the default namespace defined in "
+             f"the configuration file will be used) or group (in the form \"{GROUP_SOURCE_PREFIX}group\") to get "
+             f"variables from. Can be repeated or given as a \"{SOURCE_SEPARATOR}\" separated list, with variables "
+             f"from later sources taking precedence. If not defined, the default project(s) in the configuration file "
+             f"will be used")
+    parser.add_argument(
+        f"--{INCLUDE_PARAMETER}", type=str, action="append", default=[],
+        help=f"glob pattern of the keys of the variables to give to Docker (all are given if not defined). Can be "
+             f"repeated or given as a \"{KEY_PATTERN_SEPARATOR}\" separated list. Overrides the patterns in the "
+             f"configuration file")
+    parser.add_argument(
+        f"--{EXCLUDE_PARAMETER}", type=str, action="append", default=[],
+        help=f"glob pattern of the keys of the variables not to give to Docker, taking precedence over "
+             f"--{INCLUDE_PARAMETER}. Can be repeated or given as a \"{KEY_PATTERN_SEPARATOR}\" separated list. "
+             f"Overrides the patterns in the configuration file")
+    parser.add_argument(
+        f"--{ENVIRONMENT_SCOPE_PARAMETER}", type=str,
+        help=f"environment to get the variables of, according to their GitLab environment scope (variables of all "
+             f"scopes are got if not defined). A source can be given its own environment in the form "
+             f"\"project{ENVIRONMENT_SCOPE_SEPARATOR}environment\". Overrides the environment in the configuration "
+             f"file")
+    parser.add_argument(
+        f"--{REFRESH_PARAMETER}", action="store_true", default=False,
+        help="ignore any cached variables and fetch them from GitLab")
+    parser.add_argument(
+        f"--{BUNDLE_PARAMETER}", type=str,
+        help=f"bundle, written by the \"{EXPORT_COMMAND}\" command, to read the variables from instead of GitLab (the "
+             f"passphrase is read from the {BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE} environment variable). The "
+             f"configuration file is not required, in which case the variables of all sources in the bundle are used "
+             f"if no project is given")
+    parser.add_argument(
+        f"--{EXEC_PARAMETER}", action="store_true", default=False,
+        help="replace this process with Docker when running interactively, instead of running Docker as a child "
+             "process")
+    parser.add_argument(
+        f"--{ENV_FILE_BACKEND_PARAMETER}", type=str, choices=ENV_FILE_BACKENDS, default=DEFAULT_ENV_FILE_BACKEND,
+        help=f"where the env file containing the variables is created (falls back to the next option if unavailable, "
+             f"defaults to {DEFAULT_ENV_FILE_BACKEND})")
+    parser.add_argument(
+        f"--{DOCKER_BACKEND_PARAMETER}", type=str, choices=DOCKER_BACKENDS, default=DEFAULT_DOCKER_BACKEND,
+        help=f"how Docker is ran: \"{DOCKER_BACKEND_ENGINE}\" runs non-interactive containers via the Docker Engine "
+             f"API, without an env file, falling back to the Docker CLI for commands that it does not support "
+             f"(defaults to {DEFAULT_DOCKER_BACKEND})")
+    parser.add_argument(
+        f"--{PROFILE_PARAMETER}", type=str, default=os.environ.get(PROFILE_ENVIRONMENT_VARIABLE),
+        help=f"file to append a JSON trace of the run's timings to (\"{STDERR_LOCATION}\" for stderr). Can also be set "
+             f"using the {PROFILE_ENVIRONMENT_VARIABLE} environment variable")
+    parser.add_argument(
+        f"--{METRICS_PARAMETER}", type=str, default=os.environ.get(METRICS_ENVIRONMENT_VARIABLE),
+        help=f"Prometheus metrics file (e.g. in the node exporter's textfile collector directory) to add the run's "
+             f"metrics to, merging them with those of other runs. Can also be set using the "
+             f"{METRICS_ENVIRONMENT_VARIABLE} environment variable")
+
+    parser.add_argument(
+        f"--{BATCH_PARAMETER}", type=str,
+        help=f"file (or \"{BATCH_STDIN_LOCATION}\" for stdin) of Docker commands to run as a batch, given as JSON "
+             f"lines where each line is the list of arguments to pass to Docker. The variables are fetched and the env "
+             f"file written once for the whole batch. Commands are ran non-interactively")
+    parser.add_argument(
+        f"--{PARALLELISM_PARAMETER}", type=int, default=DEFAULT_MAX_CONCURRENCY,
+        help=f"maximum number of commands in a batch to run at the same time (defaults to {DEFAULT_MAX_CONCURRENCY})")
+    parser.add_argument(
+        f"--{BATCH_REPORT_PARAMETER}", type=str, default=STDERR_LOCATION,
+        help=f"file to append the exit code and duration of each command in a batch to, as JSON lines (defaults to "
+             f"\"{STDERR_LOCATION}\" for stderr)")
+
+    parser.add_argument(
+        f"--{DIFF_PARAMETER}", action="store_true", default=False,
+        help="fetch the variables and show the keys of those that have changed since they were last fetched, instead "
+             "of running Docker")
 
     parsed_program_args, parsed_docker_args = parser.parse_known_args(program_args)
     parsed_program_args = {key.replace("_", "-"):value for key, value in vars(parsed_program_args).items()}
+    if parsed_program_args[DIFF_PARAMETER] and len(parsed_docker_args) > 0:
+        parser.error(f"Docker arguments cannot be given with --{DIFF_PARAMETER}: {parsed_docker_args}")
+    if parsed_program_args[DIFF_PARAMETER] and parsed_program_args[BUNDLE_PARAMETER] is not None:
+        parser.error(f"--{BUNDLE_PARAMETER} cannot be given with --{DIFF_PARAMETER}")
+    if parsed_program_args[BATCH_PARAMETER] is not None and len(parsed_docker_args) > 0:
+        parser.error(f"Docker arguments cannot be given with --{BATCH_PARAMETER}: {parsed_docker_args}")
+    if parsed_program_args[PARALLELISM_PARAMETER] < 1:
+        parser.error(f"--{PARALLELISM_PARAMETER} must be at least 1")
+
+    projects = parse_sources(parsed_program_args[PROJECT_PARAMETER])
+    return CliConfiguration(
+        config_location=parsed_program_args[CONFIG_PARAMETER],
+        project=projects[0] if len(projects) > 0 else None, projects=projects,
+        interactive=is_interactive(parsed_docker_args), docker_args=parsed_docker_args,
+        refresh=parsed_program_args[REFRESH_PARAMETER], exec_interactive=parsed_program_args[EXEC_PARAMETER],
+        env_file_backend=parsed_program_args[ENV_FILE_BACKEND_PARAMETER],
+        docker_backend=parsed_program_args[DOCKER_BACKEND_PARAMETER],
+        profile_location=parsed_program_args[PROFILE_PARAMETER],
+        metrics_location=parsed_program_args[METRICS_PARAMETER],
+        batch_location=parsed_program_args[BATCH_PARAMETER],
+        parallelism=parsed_program_args[PARALLELISM_PARAMETER],
+        batch_report_location=parsed_program_args[BATCH_REPORT_PARAMETER],
+        diff=parsed_program_args[DIFF_PARAMETER],
+        include=parse_key_patterns(parsed_program_args[INCLUDE_PARAMETER]),
+        exclude=parse_key_patterns(parsed_program_args[EXCLUDE_PARAMETER]),
+        environment_scope=parsed_program_args[ENVIRONMENT_SCOPE_PARAMETER],
+        bundle_location=parsed_program_args[BUNDLE_PARAMETER])
+
+
+def parse_agent_cli_arguments(program_args: List[str]) -> CliConfiguration:
+    """
+    Parse the CLI arguments given to the agent command.
+    :param program_args: the CLI arguments (after the agent command)
+    :return: the configuration given via the CLI
+    """
+    parser = ArgumentParser(prog=f"docker-with-gitlab-secrets {AGENT_COMMAND}",
+                            description="Docker With GitLab Secrets agent, which serves variables to local wrappers")
+    parser.add_argument(
+        f"--{CONFIG_PARAMETER}", type=str,
+        help=f"location of the configuration file (will default to {DEFAULT_CONFIG_FILE})")
+    parsed_program_args = parser.parse_args(program_args)
+    return CliConfiguration(config_location=vars(parsed_program_args)[CONFIG_PARAMETER.replace("-", "_")])
+
 
+def parse_export_cli_arguments(program_args: List[str]) -> CliConfiguration:
+    """
+    Parse the CLI arguments given to the export command.
+    :param program_args: the CLI arguments (after the export command)
+    :return: the configuration given via the CLI
+    """
+    parser = ArgumentParser(prog=f"docker-with-gitlab-secrets {EXPORT_COMMAND}",
+                            description=f"Docker With GitLab Secrets export, which writes the variables to a bundle, "
+                                        f"encrypted with the passphrase in the "
+                                        f"{BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE} environment variable")
+    parser.add_argument(
+        f"--{CONFIG_PARAMETER}", type=str,
+        help=f"location of the configuration file (will default to {DEFAULT_CONFIG_FILE})")
+    parser.add_argument(
+        f"--{PROJECT_PARAMETER}", type=str, action="append", default=[],
+        help=f"GitLab project or group to export the variables of. Can be repeated or given as a "
+             f"\"{SOURCE_SEPARATOR}\" separated list. If not defined, the default project(s) in the configuration "
+             f"file will be exported")
+    parser.add_argument(
+        f"--{INCLUDE_PARAMETER}", type=str, action="append", default=[],
+        help="glob pattern of the keys of the variables to export (all are exported if not defined)")
+    parser.add_argument(
+        f"--{EXCLUDE_PARAMETER}", type=str, action="append", default=[],
+        help="glob pattern of the keys of the variables not to export")
+    parser.add_argument(
+        f"--{ENVIRONMENT_SCOPE_PARAMETER}", type=str,
+        help="environment to export the variables of, according to their GitLab environment scope")
+    parser.add_argument(
+        f"--{BUNDLE_PARAMETER}", type=str, required=True,
+        help="location to write the bundle to")
+    parsed_program_args = parser.parse_args(program_args)
+    parsed_program_args = {key.replace("_", "-"): value for key, value in vars(parsed_program_args).items()}
+    projects = parse_sources(parsed_program_args[PROJECT_PARAMETER])
     return CliConfiguration(
-        config_location=parsed_program_args[CONFIG_PARAMETER], project=parsed_program_args[PROJECT_PARAMETER],
-        interactive=is_interactive(parsed_docker_args), docker_args=parsed_docker_args)
+        config_location=parsed_program_args[CONFIG_PARAMETER],
+        project=projects[0] if len(projects) > 0 else None, projects=projects,
+        include=parse_key_patterns(parsed_program_args[INCLUDE_PARAMETER]),
+        exclude=parse_key_patterns(parsed_program_args[EXCLUDE_PARAMETER]),
+        environment_scope=parsed_program_args[ENVIRONMENT_SCOPE_PARAMETER],
+        bundle_location=parsed_program_args[BUNDLE_PARAMETER])
 
 
-def run(cli_configuration: CliConfiguration) -> ProgramOutputType:
+def run(cli_configuration: CliConfiguration, stream: bool=False, profiler: Profiler=NULL_PROFILER) \
+        -> ProgramOutputType:
     """
     Runs the program according to the given run configuration. 
     :param cli_configuration: the run configuration
+    :param stream: whether Docker's output should be written to stdout and stderr as it is produced, instead of being
+    returned
+    :param profiler: profiler of the run
     :return: the run output
     """
-    configuration = parse_configuration(cli_configuration.config_location if
-                                        cli_configuration.config_location is not None else DEFAULT_CONFIG_FILE)
+    caches: List[VariablesCache] = []
+    get_bundle = _create_bundle_getter(cli_configuration)
+    get_configuration = _create_configuration_getter(cli_configuration, profiler, get_bundle)
+    interactive_mode = INTERACTIVE_MODE_EXEC if cli_configuration.exec_interactive else INTERACTIVE_MODE_SPAWN
+    try:
+        return run_wrapped(cli_configuration.docker_args,
+                           _create_variables_getter(cli_configuration, get_configuration, profiler, caches,
+                                                    get_bundle),
+                           cli_configuration.interactive, stream, interactive_mode=interactive_mode,
+                           env_file_backend=cli_configuration.env_file_backend,
+                           secret_file_keys=_create_secret_file_keys_selector(get_configuration),
+                           docker_backend=cli_configuration.docker_backend, profiler=profiler)
+    finally:
+        for cache in caches:
+            cache.wait_for_refreshes()
+
+
+def run_batch_file(cli_configuration: CliConfiguration, stream: bool=False, profiler: Profiler=NULL_PROFILER) \
+        -> List["BatchResult"]:
+    """
+    Runs the batch of Docker commands in the batch file given in the run configuration, resolving the variables and
+    writing the env file once for all of them.
+    :param cli_configuration: the run configuration
+    :param stream: whether Docker's output should be written to stdout and stderr as it is produced, instead of being
+    returned
+    :param profiler: profiler of the run
+    :return: the results of the commands, in the order that they finished
+    """
+    from dockerwithgitlabsecrets.asynchronous import run_batch
+    docker_argument_lists = read_batch(cli_configuration.batch_location)
+    caches: List[VariablesCache] = []
+    try:
+        get_bundle = _create_bundle_getter(cli_configuration)
+        get_configuration = _create_configuration_getter(cli_configuration, profiler, get_bundle)
+        return run_batch(docker_argument_lists,
+                         _create_variables_getter(cli_configuration, get_configuration, profiler, caches,
+                                                  get_bundle),
+                         cli_configuration.parallelism, stream, env_file_backend=cli_configuration.env_file_backend,
+                         secret_file_keys=_create_secret_file_keys_selector(get_configuration), profiler=profiler)
+    finally:
+        for cache in caches:
+            cache.wait_for_refreshes()
+
+
+def read_batch(location: str) -> List[List[str]]:
+    """
+    Reads a batch of Docker commands, given as JSON lines where each line is the list of arguments to pass to Docker.
+    :param location: location of the batch file (or "-" for stdin)
+    :return: the lists of arguments to pass to Docker
+    :raises ValueError: if a line is not a list of strings
+    """
+    with (open(location, "r") if location != BATCH_STDIN_LOCATION else _null_context(sys.stdin)) as file:
+        lines = file.readlines()
+
+    docker_argument_lists = []
+    for line_number, line in enumerate(lines, 1):
+        if line.strip() == "":
+            continue
+        docker_arguments = json.loads(line)
+        if not isinstance(docker_arguments, list) \
+                or not all(isinstance(argument, str) for argument in docker_arguments):
+            raise ValueError(f"Line {line_number} of batch is not a list of Docker arguments: {line.strip()}")
+        docker_argument_lists.append(docker_arguments)
+    return docker_argument_lists
+
+
+def write_batch_report(results: List["BatchResult"], location: str):
+    """
+    Writes a report of the exit code and duration of each of the given batch results, as JSON lines.
+    :param results: the batch results
+    :param location: file to append the report to (or "-" for stderr)
+    """
+    lines = [json.dumps({BATCH_INDEX_PROPERTY: result.index, BATCH_ARGUMENTS_PROPERTY: result.docker_arguments,
+                         BATCH_EXIT_CODE_PROPERTY: result.output[0], BATCH_DURATION_PROPERTY: result.duration})
+             for result in results]
+    with (open(location, "a") if location != STDERR_LOCATION else _null_context(sys.stderr)) as file:
+        for line in lines:
+            file.write(f"{line}\n")
+
+
+def get_batch_exit_code(results: List["BatchResult"]) -> int:
+    """
+    Gets the exit code of a batch, which is the exit code of the first command in the batch that failed (or 0 if all
+    succeeded).
+    :param results: the batch results
+    :return: the exit code
+    """
+    for result in sorted(results, key=lambda result: result.index):
+        if result.output[0] != 0:
+            return result.output[0]
+    return 0
+
+
+def export_bundle(cli_configuration: CliConfiguration) -> List[str]:
+    """
+    Fetches the variables of each source given in the run configuration and writes them to the bundle given in the run
+    configuration.
+    :param cli_configuration: the run configuration
+    :return: the sources that were exported
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from dockerwithgitlabsecrets.bundle import write_bundle, get_bundle_passphrase
+    passphrase = get_bundle_passphrase()
+    configuration = _create_configuration_getter(cli_configuration, NULL_PROFILER)()
+    sources = _get_sources(cli_configuration, configuration)
+    include, exclude = _get_key_patterns(cli_configuration, configuration)
+    keys = get_keys_to_fetch(include, exclude)
+
+    def export_source(source: str) -> Dict[str, str]:
+        return filter_variables(fetch_variables(configuration.gitlab, source, keys), include, exclude)
+
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        source_variables = dict(zip(sources, executor.map(export_source, sources)))
+    write_bundle(cli_configuration.bundle_location, source_variables, passphrase, configuration.gitlab.url,
+                 configuration.gitlab.namespace)
+    return sources
+
+
+def diff_sources(cli_configuration: CliConfiguration) -> Dict[str, VariablesDiff]:
+    """
+    Fetches the variables of each source given in the run configuration and compares them with those that were last
+    fetched (and cached). The fetched variables are then cached, even if the cache is otherwise disabled.
+    :param cli_configuration: the run configuration
+    :return: the changes to the variables of each source since they were last fetched
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    configuration = _create_configuration_getter(cli_configuration, NULL_PROFILER)()
+    sources = _get_sources(cli_configuration, configuration)
+    cache = VariablesCache(configuration.cache.location, configuration.cache.ttl,
+                           configuration.cache.stale_while_revalidate)
+
+    def diff_source(source: str) -> VariablesDiff:
+        entry = cache.get_entry(configuration.gitlab.url, source)
+        variables, _ = cache.get(
+            configuration.gitlab.url, source, lambda: fetch_variables(configuration.gitlab, source), refresh=True,
+            conditional_fetcher=lambda etag: fetch_variables_if_changed(configuration.gitlab, source, etag))
+        return diff_variables(entry.variables if entry is not None else {}, variables)
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        return dict(zip(sources, executor.map(diff_source, sources)))
+
+
+def format_variables_diff(source: str, diff: VariablesDiff) -> str:
+    """
+    Formats the given changes to the variables of the given source (only keys are included, never values).
+    :param source: the variables source
+    :param diff: the changes to the source's variables
+    :return: the formatted changes
+    """
+    if diff.is_empty():
+        return f"{source}: unchanged"
+    changes = [f"{description} {', '.join(keys)}" for description, keys
+               in (("added", diff.added), ("changed", diff.changed), ("removed", diff.removed)) if len(keys) > 0]
+    return f"{source}: {'; '.join(changes)}"
+
+
+@contextmanager
+def _null_context(value: Any=None):
+    """
+    Context manager that does nothing (`contextlib.nullcontext` is not available before Python 3.7).
+    :param value: the value to give as the target of the context
+    """
+    yield value
+
+
+def _get_sources(cli_configuration: CliConfiguration, configuration: Configuration) -> List[str]:
+    """
+    Gets the (namespaced and scoped) variable sources given in the run configuration, else in the program
+    configuration.
+    :param cli_configuration: the run configuration
+    :param configuration: the program configuration
+    :return: the sources, in order of increasing precedence
+    :raises ValueError: if no sources are given
+    """
+    sources = cli_configuration.get_projects()
+    if len(sources) == 0:
+        sources = configuration.gitlab.get_default_sources()
+    if len(sources) == 0:
+        raise ValueError("No GitLab project given (on the command line or in the configuration file)")
+    environment_scope = cli_configuration.environment_scope if cli_configuration.environment_scope is not None \
+        else configuration.gitlab.environment_scope
+    return [scope_source(namespace_source(source, configuration.gitlab.namespace), environment_scope)
+            for source in sources]
+
+
+def _get_key_patterns(cli_configuration: CliConfiguration, configuration: Configuration) \
+        -> Tuple[List[str], List[str]]:
+    """
+    Gets the patterns of the keys of the variables to include and exclude, given in the run configuration, else in the
+    program configuration.
+    :param cli_configuration: the run configuration
+    :param configuration: the program configuration
+    :return: tuple where the first element is the include patterns and the second is the exclude patterns
+    """
+    include = cli_configuration.include if len(cli_configuration.include) > 0 else configuration.gitlab.include
+    exclude = cli_configuration.exclude if len(cli_configuration.exclude) > 0 else configuration.gitlab.exclude
+    return include, exclude
+
+
+def _create_configuration_getter(cli_configuration: CliConfiguration, profiler: Profiler,
+                                 get_bundle: Callable[[], "Bundle"]=None) -> Callable[[], Configuration]:
+    """
+    Creates a callable that parses the configuration file given in the run configuration on its first call.
+    :param cli_configuration: the run configuration
+    :param profiler: profiler of the run
+    :param get_bundle: gets the bundle that variables are read from, if one is used, in which case the default
+    configuration file is not required (the configuration then comes from the bundle)
+    :return: callable that gets the configuration
+    """
+    configurations: List[Configuration] = []
+
+    def get_configuration() -> Configuration:
+        if len(configurations) == 0:
+            with profiler.phase(CONFIGURATION_PHASE):
+                if get_bundle is not None and cli_configuration.config_location is None \
+                        and not os.path.exists(DEFAULT_CONFIG_FILE):
+                    # Bundles are used where GitLab cannot be accessed, so there may not be a configuration file
+                    bundle = get_bundle()
+                    configurations.append(Configuration(GitLabConfiguration(
+                        url=bundle.url, token=None, namespace=bundle.namespace, projects=bundle.sources)))
+                else:
+                    configurations.append(load_configuration(
+                        cli_configuration.config_location if cli_configuration.config_location is not None
+                        else DEFAULT_CONFIG_FILE))
+        return configurations[0]
+
+    return get_configuration
+
+
+def _create_bundle_getter(cli_configuration: CliConfiguration) -> Optional[Callable[[], "Bundle"]]:
+    """
+    Creates a callable that opens the bundle given in the run configuration on its first call.
+    :param cli_configuration: the run configuration
+    :return: callable that gets the bundle or `None` if a bundle is not to be used
+    """
+    if cli_configuration.bundle_location is None:
+        return None
+    bundles: List["Bundle"] = []
+
+    def get_bundle() -> "Bundle":
+        if len(bundles) == 0:
+            from dockerwithgitlabsecrets.bundle import Bundle, get_bundle_passphrase
+            bundles.append(Bundle(cli_configuration.bundle_location, get_bundle_passphrase()))
+        return bundles[0]
+
+    return get_bundle
+
+
+def _create_secret_file_keys_selector(get_configuration: Callable[[], Configuration]) \
+        -> Callable[[Dict[str, str]], List[str]]:
+    """
+    Creates a callable that selects the keys of the variables to give as files, according to the configuration.
+    :param get_configuration: gets the program configuration
+    :return: callable that selects the keys from the variables
+    """
+    def select(variables: Dict[str, str]) -> List[str]:
+        return select_secret_file_keys(variables, get_configuration().secret_files)
+
+    return select
+
+
+def _create_variables_getter(cli_configuration: CliConfiguration, get_configuration: Callable[[], Configuration],
+                             profiler: Profiler, caches: List[VariablesCache],
+                             get_bundle: Callable[[], "Bundle"]=None) -> Callable[[], Dict[str, str]]:
+    """
+    Creates a callable that gets the variables according to the given run configuration.
+    :param cli_configuration: the run configuration
+    :param get_configuration: gets the program configuration
+    :param profiler: profiler of the run
+    :param caches: list to which any variables cache that is used is added, so background refreshes can be waited for
+    :param get_bundle: gets the bundle to read the variables from, instead of GitLab (optional)
+    :return: callable that gets the variables
+    """
+    def resolve_variables() -> Dict[str, str]:
+        configuration = get_configuration()
+        sources = _get_sources(cli_configuration, configuration)
+        include, exclude = _get_key_patterns(cli_configuration, configuration)
+        profiler.record(PROJECT_PROPERTY, SOURCE_SEPARATOR.join(sources))
+
+        if get_bundle is not None:
+            with profiler.phase(VARIABLES_PHASE):
+                bundle = get_bundle()
+                variables = filter_variables(get_merged_variables(sources, bundle.get_variables), include, exclude)
+            for source in sources:
+                profiler.record_item("sources", source, "bundle")
+            return variables
 
-    project = cli_configuration.project if cli_configuration.project is not None else configuration.gitlab.project
-    if _NAMESPACE_PROJECT_SEPARATOR not in project:
-        project = f"{configuration.gitlab.namespace}{_NAMESPACE_PROJECT_SEPARATOR}{project}"
+        from dockerwithgitlabsecrets.agent import AgentClient, AgentError
+        agent_client = AgentClient(configuration.agent.socket)
+        use_agent = agent_client.is_available()
+        cache = VariablesCache(configuration.cache.location, configuration.cache.ttl,
+                               configuration.cache.stale_while_revalidate) if configuration.cache.ttl > 0 else None
+        if cache is not None:
+            caches.append(cache)
+        single_flight = None
+        if configuration.single_flight.wait > 0:
+            from dockerwithgitlabsecrets.singleflight import SingleFlight
+            single_flight = SingleFlight(wait=configuration.single_flight.wait)
 
-    gitlab_config = GitLabConfig(configuration.gitlab.url, configuration.gitlab.token)
-    project_variables_manager = ProjectVariablesManager(gitlab_config, project)
-    project_variables = project_variables_manager.get()
+        def get_source_variables(source: str) -> Dict[str, str]:
+            if use_agent:
+                try:
+                    variables = agent_client.get(configuration.gitlab.url, source, cli_configuration.refresh)
+                    profiler.record_item("sources", source, "agent")
+                    return variables
+                except (OSError, ValueError, AgentError) as e:
+                    _logger.warning(f"Could not get variables from agent (fetching them directly instead): {e}")
 
-    return run_wrapped(cli_configuration.docker_args, project_variables, cli_configuration.interactive)
+            if cache is None:
+                # Only variables that are not cached can be fetched by key, as cached variables are shared by commands
+                # that include different keys
+                keys = get_keys_to_fetch(include, exclude)
+
+                def keys_fetcher() -> Dict[str, str]:
+                    return fetch_variables(configuration.gitlab, source, keys)
+
+                if single_flight is None:
+                    profiler.record_item("sources", source, "fetched")
+                    return keys_fetcher()
+                variables, shared = single_flight.get(configuration.gitlab.url, source, keys_fetcher, keys)
+                profiler.record_item("sources", source, "shared" if shared else "fetched")
+                return variables
+
+            def fetcher() -> Dict[str, str]:
+                return fetch_variables(configuration.gitlab, source)
+
+            def conditional_fetcher(etag: Optional[str]) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+                return fetch_variables_if_changed(configuration.gitlab, source, etag)
+
+            try:
+                # Processes that miss the cache at the same time wait for the first to populate it, rather than all
+                # fetching
+                with single_flight.lock(configuration.gitlab.url, source) \
+                        if single_flight is not None and not cli_configuration.refresh else _null_context():
+                    variables, cache_status = cache.get(configuration.gitlab.url, source, fetcher,
+                                                        refresh=cli_configuration.refresh,
+                                                        conditional_fetcher=conditional_fetcher)
+            except Exception as e:
+                from dockerwithgitlabsecrets.client import is_transient_error
+                if cli_configuration.refresh or not (isinstance(e, CircuitOpenError) or is_transient_error(e)):
+                    raise
+                entry = cache.get_entry(configuration.gitlab.url, source)
+                if entry is None:
+                    raise
+                # Serve the last known good variables, rather than failing, whilst GitLab is unavailable
+                _logger.warning(f"Using variables for \"{source}\" that were cached {entry.age():.0f}s ago as they "
+                                f"could not be fetched: {e}")
+                profiler.record_item("sources", source, "cache last known good")
+                return entry.variables
+            _logger.info(f"Variables cache {cache_status.value} for \"{source}\"")
+            profiler.record_item("sources", source, f"cache {cache_status.value}")
+            return variables
+
+        with profiler.phase(VARIABLES_PHASE):
+            variables = filter_variables(get_merged_variables(sources, get_source_variables), include, exclude)
+        # The client is not created (or its library imported) if GitLab was not contacted, e.g. if the agent served
+        # the variables
+        client = find_client(configuration.gitlab)
+        gitlab_timings = client.timings if client is not None else []
+        profiler.record("gitlab_requests", len(gitlab_timings))
+        profiler.record("gitlab_request_time", sum(timing.duration for timing in gitlab_timings))
+        if len(gitlab_timings) > 0:
+            profiler.record(GITLAB_RESPONSES_PROPERTY, dict(Counter(str(timing.status) for timing in gitlab_timings)))
+            profiler.record(GITLAB_REQUEST_DURATIONS_PROPERTY, [timing.duration for timing in gitlab_timings])
+        if client is not None and (client.retried > 0 or client.hedged > 0):
+            profiler.record(GITLAB_RETRIES_PROPERTY, client.retried)
+            profiler.record(GITLAB_HEDGES_PROPERTY, client.hedged)
+        if cache is not None and cli_configuration.exec_interactive and cli_configuration.interactive:
+            # Background refreshes would not survive this process being replaced
+            cache.wait_for_refreshes()
+        return variables
+
+    return resolve_variables
+
+
+def run_agent(cli_configuration: CliConfiguration):
+    """
+    Runs the secrets agent until the process is terminated.
+    :param cli_configuration: the run configuration
+    """
+    from dockerwithgitlabsecrets.agent import SecretsAgent
+    configuration = load_configuration(cli_configuration.config_location if
+                                       cli_configuration.config_location is not None else DEFAULT_CONFIG_FILE)
+
+    def terminate(signal_number: int, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        SecretsAgent(configuration, fetch_variables).serve()
+    except KeyboardInterrupt:
+        pass
 
 
 def main():
     """
     Main method.
     """
+    logging.basicConfig(level=os.environ.get(LOG_LEVEL_ENVIRONMENT_VARIABLE, _DEFAULT_LOG_LEVEL).upper())
+    if len(sys.argv) > 1 and sys.argv[1] == AGENT_COMMAND:
+        run_agent(parse_agent_cli_arguments(sys.argv[2:]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == EXPORT_COMMAND:
+        cli_configuration = parse_export_cli_arguments(sys.argv[2:])
+        sources = export_bundle(cli_configuration)
+        _logger.info(f"Exported variables of {sources} to bundle: {cli_configuration.bundle_location}")
+        return
+
     cli_configuration = parse_cli_arguments(sys.argv[1:])
-    returncode, stdout, stderr = run(cli_configuration)
+    if cli_configuration.diff:
+        for source, diff in diff_sources(cli_configuration).items():
+            print(format_variables_diff(source, diff))
+        return
+
+    profiler = Profiler(cli_configuration.profile_location, cli_configuration.metrics_location)
+    stdout, stderr = None, None
+    try:
+        if cli_configuration.batch_location is not None:
+            results = run_batch_file(cli_configuration, stream=True, profiler=profiler)
+            write_batch_report(results, cli_configuration.batch_report_location)
+            returncode = get_batch_exit_code(results)
+        else:
+            returncode, stdout, stderr = run(cli_configuration, stream=True, profiler=profiler)
+    except BaseException:
+        # Failed runs (e.g. where the variables could not be fetched) are still profiled
+        profiler.record(EXIT_CODE_PROPERTY, ERROR_EXIT_CODE)
+        raise
+    else:
+        profiler.record(EXIT_CODE_PROPERTY, returncode)
+    finally:
+        # Already written if the process was to be replaced by Docker (but could not be)
+        if not profiler.written:
+            profiler.write()
     if stdout is not None:
         sys.stdout.write(stdout)
     if stderr is not None:
@@ -0,0 +1,292 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from tempfile import NamedTemporaryFile, TemporaryFile, gettempdir
+
+from typing import Dict, NamedTuple, Optional, Iterator, BinaryIO, Tuple
+
+from dockerwithgitlabsecrets.cache import ensure_private_directory, write_private_file
+
+ENV_FILE_BACKEND_SHARED = "shared"
+ENV_FILE_BACKEND_MEMFD = "memfd"
+ENV_FILE_BACKEND_TMPFS = "tmpfs"
+ENV_FILE_BACKEND_FILE = "file"
+ENV_FILE_BACKENDS = [ENV_FILE_BACKEND_SHARED, ENV_FILE_BACKEND_MEMFD, ENV_FILE_BACKEND_TMPFS, ENV_FILE_BACKEND_FILE]
+DEFAULT_ENV_FILE_BACKEND = ENV_FILE_BACKEND_MEMFD
+
+TMPFS_DIRECTORY = "/dev/shm"
+DEFAULT_SHARED_ENV_FILE_DIRECTORY = os.path.join(
+    os.environ["XDG_RUNTIME_DIR"], "dockerwithgitlabsecrets", "env-files") if "XDG_RUNTIME_DIR" in os.environ \
+    else os.path.join(TMPFS_DIRECTORY, f"dockerwithgitlabsecrets-{os.getuid()}")
+DEFAULT_SHARED_ENV_FILE_TTL = 600.0
+
+_LINE_BREAK = "\n"
+SAFE_LINE_BREAK = "\\n"
+
+_ENV_FILE_SUFFIX = ".env"
+_MEMFD_NAME = "dwgs-env"
+_INHERITED_FILE_DIRECTORY = "/dev/fd"
+_DIGEST_SEPARATOR = "-"
+_KEYS_DIGEST_LENGTH = 16
+_MAX_SHARED_OPEN_ATTEMPTS = 5
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+
+class EnvFile(NamedTuple):
+    """
+    Env file that can be given to Docker.
+    """
+    location: str
+    file_descriptor: Optional[int] = None
+    size: int = 0
+    reused: bool = False
+
+    def get_inherited_file_descriptors(self) -> Tuple[int, ...]:
+        """
+        Gets the file descriptors that Docker must inherit to be able to read the env file.
+        :return: the file descriptors
+        """
+        return (self.file_descriptor, ) if self.file_descriptor is not None else ()
+
+
+def warn_if_new_lines_in_variables(variables: Dict[str, str]):
+    """
+    Emits a warning to the logger if one of the given key/value variables contains new line characters in its output.
+    :param variables: the variables
+    """
+    for key, value in variables.items():
+        if _LINE_BREAK in value:
+            _logger.warning(f"New line characters in variable with key \"{key}\" have been escaped to \\\\n")
+
+
+def write_env_file(file: BinaryIO, variables: Dict[str, str]) -> int:
+    """
+    Writes the given variables to the given file in the env file format, one variable at a time.
+    :param file: the (binary) file to write to
+    :param variables: the variables to write
+    :return: the number of bytes written
+    """
+    size = 0
+    for key, value in variables.items():
+        size += file.write(f"{key}={value.replace(_LINE_BREAK, SAFE_LINE_BREAK)}{_LINE_BREAK}".encode(_ENCODING))
+    file.flush()
+    return size
+
+
+def is_env_file_backend_available(backend: str) -> bool:
+    """
+    Gets whether the given env file backend can be used on this system.
+    :param backend: the env file backend
+    :return: whether the backend is available
+    """
+    if backend == ENV_FILE_BACKEND_SHARED:
+        return _is_shared_env_file_directory_available(DEFAULT_SHARED_ENV_FILE_DIRECTORY)
+    elif backend == ENV_FILE_BACKEND_MEMFD:
+        return hasattr(os, "memfd_create") and os.path.isdir(_INHERITED_FILE_DIRECTORY)
+    elif backend == ENV_FILE_BACKEND_TMPFS:
+        return os.path.isdir(TMPFS_DIRECTORY) and os.access(TMPFS_DIRECTORY, os.W_OK | os.X_OK)
+    elif backend == ENV_FILE_BACKEND_FILE:
+        return True
+    raise ValueError(f"Unknown env file backend \"{backend}\" (known: {ENV_FILE_BACKENDS})")
+
+
+@contextmanager
+def env_file(variables: Dict[str, str], backend: str=DEFAULT_ENV_FILE_BACKEND, anonymous: bool=False) \
+        -> Iterator[EnvFile]:
+    """
+    Creates an env file containing the given variables, which is removed on exit of the context.
+
+    If the backend is unavailable, the next backend in `ENV_FILE_BACKENDS` is used.
+    :param variables: the variables to put in the env file
+    :param backend: the env file backend: `ENV_FILE_BACKEND_SHARED` reuses a file shared with other runs with the same
+    variables (see `shared_env_file`), `ENV_FILE_BACKEND_MEMFD` creates the file in anonymous memory,
+    `ENV_FILE_BACKEND_TMPFS` creates the file on tmpfs and `ENV_FILE_BACKEND_FILE` creates the file in the temp
+    directory
+    :param anonymous: whether the file must not be linked into the file system, in which case it is only accessible via
+    its (inheritable) file descriptor
+    :return: context manager for the env file
+    """
+    if backend not in ENV_FILE_BACKENDS:
+        raise ValueError(f"Unknown env file backend \"{backend}\" (known: {ENV_FILE_BACKENDS})")
+    for fallback_backend in ENV_FILE_BACKENDS[ENV_FILE_BACKENDS.index(backend):]:
+        # Shared env files outlive the run, so cannot be used when the file must not be linked into the file system
+        if not (anonymous and fallback_backend == ENV_FILE_BACKEND_SHARED) \
+                and is_env_file_backend_available(fallback_backend):
+            break
+        _logger.debug(f"Env file backend \"{fallback_backend}\" is not available")
+
+    if fallback_backend == ENV_FILE_BACKEND_SHARED:
+        with shared_env_file(variables) as docker_env_file:
+            yield docker_env_file
+        return
+
+    warn_if_new_lines_in_variables(variables)
+
+    if fallback_backend == ENV_FILE_BACKEND_MEMFD:
+        file_descriptor = os.memfd_create(_MEMFD_NAME)
+        try:
+            with os.fdopen(file_descriptor, "wb", closefd=False) as file:
+                size = write_env_file(file, variables)
+            yield _create_inherited_env_file(file_descriptor, size)
+        finally:
+            os.close(file_descriptor)
+        return
+
+    directory = TMPFS_DIRECTORY if fallback_backend == ENV_FILE_BACKEND_TMPFS else gettempdir()
+    if anonymous:
+        with TemporaryFile(suffix=_ENV_FILE_SUFFIX, dir=directory) as file:
+            size = write_env_file(file, variables)
+            file.seek(0)
+            yield _create_inherited_env_file(file.fileno(), size)
+    else:
+        with NamedTemporaryFile(suffix=_ENV_FILE_SUFFIX, dir=directory) as file:
+            size = write_env_file(file, variables)
+            yield EnvFile(location=file.name, size=size)
+
+
+@contextmanager
+def shared_env_file(variables: Dict[str, str], directory: str=DEFAULT_SHARED_ENV_FILE_DIRECTORY,
+                    ttl: float=DEFAULT_SHARED_ENV_FILE_TTL) -> Iterator[EnvFile]:
+    """
+    Gets an env file containing the given variables that is shared with other runs (of the current user) with the same
+    variables, writing it if there is not one. Env files are named by the digest of their variables and are kept in a
+    directory that only the current user can access (which should be on tmpfs).
+
+    Runs hold a shared lock on the env file whilst in the context, so that it is not removed whilst in use. On exit of
+    the context, env files that are not in use are removed if they have not been used for the given TTL or if they have
+    been superseded by a newer env file with the same keys (i.e. the secrets have rotated).
+    :param variables: the variables to put in the env file
+    :param directory: the directory of the shared env files
+    :param ttl: the number of seconds after it was last used that an env file is removed
+    :return: context manager for the env file
+    """
+    json_variables = json.dumps(variables, sort_keys=True).encode(_ENCODING)
+    keys_digest = hashlib.sha256(json.dumps(sorted(variables.keys())).encode(_ENCODING)).hexdigest()
+    location = os.path.join(directory, f"{keys_digest[:_KEYS_DIGEST_LENGTH]}{_DIGEST_SEPARATOR}"
+                                       f"{hashlib.sha256(json_variables).hexdigest()}{_ENV_FILE_SUFFIX}")
+    file_descriptor, reused = _open_shared_env_file(location, variables)
+    try:
+        _logger.debug(f"{'Reusing' if reused else 'Created'} shared env file: {location}")
+        yield EnvFile(location=location, size=os.fstat(file_descriptor).st_size, reused=reused)
+    finally:
+        # Closing the file releases the lock
+        os.close(file_descriptor)
+        remove_unused_env_files(directory, ttl)
+
+
+def remove_unused_env_files(directory: str, ttl: float=DEFAULT_SHARED_ENV_FILE_TTL):
+    """
+    Removes the shared env files in the given directory that are not in use and have either not been used for the given
+    TTL or been superseded by a newer env file with the same keys.
+    :param directory: the directory of the shared env files
+    :param ttl: the number of seconds after it was last used that an env file is removed
+    """
+    now = time.time()
+    last_used: Dict[str, float] = {}
+    latest: Dict[str, str] = {}
+    for name in os.listdir(directory):
+        try:
+            modified = os.stat(os.path.join(directory, name)).st_mtime
+        except FileNotFoundError:
+            continue
+        if not name.endswith(_ENV_FILE_SUFFIX):
+            # Left by a run that failed whilst writing an env file
+            if now - modified > ttl:
+                _remove_if_unused(os.path.join(directory, name))
+            continue
+        last_used[name] = modified
+        keys_digest = name.partition(_DIGEST_SEPARATOR)[0]
+        if keys_digest not in latest or modified > last_used[latest[keys_digest]]:
+            latest[keys_digest] = name
+
+    for name, modified in last_used.items():
+        if now - modified > ttl or latest[name.partition(_DIGEST_SEPARATOR)[0]] != name:
+            _remove_if_unused(os.path.join(directory, name))
+
+
+def _is_shared_env_file_directory_available(directory: str) -> bool:
+    """
+    Gets whether the given shared env file directory can be used.
+    :param directory: the directory of the shared env files
+    :return: whether the directory can be used
+    """
+    try:
+        return ensure_private_directory(directory)
+    except OSError as e:
+        _logger.debug(f"Cannot use shared env file directory \"{directory}\": {e}")
+        return False
+
+
+def _open_shared_env_file(location: str, variables: Dict[str, str]) -> Tuple[int, bool]:
+    """
+    Opens the shared env file at the given location, with a shared lock, writing it first if it does not exist.
+    :param location: the location of the env file
+    :param variables: the variables in the env file
+    :return: tuple where the first element is the file descriptor of the env file and the second is whether the env
+    file already existed
+    :raises OSError: if the env file keeps being removed before it can be locked
+    """
+    reused = True
+    for _ in range(_MAX_SHARED_OPEN_ATTEMPTS):
+        try:
+            file_descriptor = os.open(location, os.O_RDONLY)
+        except FileNotFoundError:
+            reused = False
+            warn_if_new_lines_in_variables(variables)
+            contents = BytesIO()
+            write_env_file(contents, variables)
+            write_private_file(location, contents.getvalue())
+            continue
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_SH)
+            # The env file may have been removed (or replaced) before it was locked
+            if os.path.samestat(os.fstat(file_descriptor), os.stat(location)):
+                if reused:
+                    # Renews the env file's lease
+                    os.utime(file_descriptor)
+                return file_descriptor, reused
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(file_descriptor)
+            raise
+        os.close(file_descriptor)
+    raise OSError(f"Shared env file kept being removed before it could be used: {location}")
+
+
+def _remove_if_unused(location: str):
+    """
+    Removes the given file if no other process holds a lock on it.
+    :param location: the location of the file
+    """
+    try:
+        file_descriptor = os.open(location, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.path.samestat(os.fstat(file_descriptor), os.stat(location)):
+            os.remove(location)
+    except (BlockingIOError, FileNotFoundError):
+        pass
+    finally:
+        os.close(file_descriptor)
+
+
+def _create_inherited_env_file(file_descriptor: int, size: int) -> EnvFile:
+    """
+    Creates a model of an env file that is accessed via the given file descriptor.
+    :param file_descriptor: the file descriptor, which is made inheritable
+    :param size: the size of the env file in bytes
+    :return: the env file model
+    """
+    os.set_inheritable(file_descriptor, True)
+    return EnvFile(location=f"{_INHERITED_FILE_DIRECTORY}/{file_descriptor}", file_descriptor=file_descriptor,
+                   size=size)
@@ -0,0 +1,329 @@
+import fcntl
+import json
+import logging
+import math
+import os
+from tempfile import mkstemp
+
+from typing import Dict, Any, NamedTuple, Tuple
+
+from dockerwithgitlabsecrets.profiling import PHASES_PROPERTY, CONFIGURATION_PHASE, VARIABLES_PHASE, DOCKER_PHASE
+
+METRICS_ENVIRONMENT_VARIABLE = "DWGS_METRICS"
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+RUNS_METRIC = "dwgs_runs_total"
+SOURCES_METRIC = "dwgs_sources_total"
+CONFIGURATION_SECONDS_METRIC = "dwgs_configuration_load_seconds"
+VARIABLES_SECONDS_METRIC = "dwgs_variables_seconds"
+GITLAB_REQUEST_SECONDS_METRIC = "dwgs_gitlab_request_seconds"
+GITLAB_REQUESTS_METRIC = "dwgs_gitlab_requests_total"
+GITLAB_RETRIES_METRIC = "dwgs_gitlab_retries_total"
+GITLAB_HEDGES_METRIC = "dwgs_gitlab_hedges_total"
+VARIABLES_INJECTED_METRIC = "dwgs_variables_injected"
+VARIABLE_BYTES_INJECTED_METRIC = "dwgs_variable_bytes_injected"
+DOCKER_SECONDS_METRIC = "dwgs_docker_seconds"
+
+PROJECT_LABEL = "project"
+SOURCE_LABEL = "source"
+STATUS_LABEL = "status"
+EXIT_CODE_LABEL = "exit_code"
+
+# Exit code label of runs where the process was replaced by Docker
+REPLACED_EXIT_CODE = "replaced"
+# Exit code label of runs that failed before Docker exited (e.g. because the variables could not be fetched)
+ERROR_EXIT_CODE = "error"
+
+# Measurements recorded in the profiler's trace that metrics are derived from
+PROJECT_PROPERTY = "project"
+SOURCES_PROPERTY = "sources"
+EXIT_CODE_PROPERTY = "exit_code"
+GITLAB_RESPONSES_PROPERTY = "gitlab_responses"
+GITLAB_REQUEST_DURATIONS_PROPERTY = "gitlab_request_durations"
+GITLAB_RETRIES_PROPERTY = "gitlab_retries"
+GITLAB_HEDGES_PROPERTY = "gitlab_hedges"
+VARIABLE_COUNT_PROPERTY = "variable_count"
+VARIABLE_BYTES_PROPERTY = "variable_bytes"
+
+_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_DOCKER_DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+_COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+_BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_STATE_FILE_SUFFIX = ".json"
+_LOCK_FILE_SUFFIX = ".lock"
+_METRICS_FILE_MODE = 0o644
+_COUNTS_PROPERTY = "counts"
+_SUM_PROPERTY = "sum"
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+
+class MetricDefinition(NamedTuple):
+    """
+    Definition of a Prometheus metric.
+    """
+    type: str
+    help: str
+    buckets: Tuple[float, ...] = ()
+
+
+METRIC_DEFINITIONS: Dict[str, MetricDefinition] = {
+    RUNS_METRIC: MetricDefinition(COUNTER, "Runs of the wrapper, by exit code."),
+    SOURCES_METRIC: MetricDefinition(
+        COUNTER, "Variables sources got, by how they were got (e.g. fetched or a cache hit)."),
+    CONFIGURATION_SECONDS_METRIC: MetricDefinition(
+        HISTOGRAM, "Time taken to load the configuration.", _DURATION_BUCKETS),
+    VARIABLES_SECONDS_METRIC: MetricDefinition(
+        HISTOGRAM, "Time taken to get the variables (from GitLab, the cache, the agent or a bundle).",
+        _DURATION_BUCKETS),
+    GITLAB_REQUEST_SECONDS_METRIC: MetricDefinition(
+        HISTOGRAM, "Latency of requests (each for a page of variables) to GitLab.", _DURATION_BUCKETS),
+    GITLAB_REQUESTS_METRIC: MetricDefinition(COUNTER, "Requests (each for a page of variables) to GitLab, by status."),
+    GITLAB_RETRIES_METRIC: MetricDefinition(COUNTER, "Requests to GitLab retried after a transient error."),
+    GITLAB_HEDGES_METRIC: MetricDefinition(COUNTER, "Requests to GitLab hedged with a second request."),
+    VARIABLES_INJECTED_METRIC: MetricDefinition(HISTOGRAM, "Number of variables given to Docker.", _COUNT_BUCKETS),
+    VARIABLE_BYTES_INJECTED_METRIC: MetricDefinition(
+        HISTOGRAM, "Size of the env file of variables given to Docker.", _BYTES_BUCKETS),
+    DOCKER_SECONDS_METRIC: MetricDefinition(
+        HISTOGRAM, "Time from spawning Docker to it exiting.", _DOCKER_DURATION_BUCKETS)
+}
+
+
+class Metrics:
+    """
+    Counters and histograms, in the Prometheus data model, that can be merged with those written by other processes.
+    Series are keyed by metric name then by their labels (as a JSON object with sorted keys).
+    """
+    def __init__(self):
+        self.counters: Dict[str, Dict[str, float]] = {}
+        self.histograms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    def increment(self, name: str, labels: Dict[str, str], value: float=1):
+        """
+        Increments the given counter.
+        :param name: the name of the counter
+        :param labels: the labels of the series
+        :param value: the amount to increment by
+        """
+        series = self.counters.setdefault(name, {})
+        label_key = _get_label_key(labels)
+        series[label_key] = series.get(label_key, 0) + value
+
+    def observe(self, name: str, labels: Dict[str, str], value: float):
+        """
+        Records an observation in the given histogram.
+        :param name: the name of the histogram
+        :param labels: the labels of the series
+        :param value: the observed value
+        """
+        buckets = METRIC_DEFINITIONS[name].buckets
+        histogram = self.histograms.setdefault(name, {}).setdefault(
+            _get_label_key(labels), {_COUNTS_PROPERTY: [0] * (len(buckets) + 1), _SUM_PROPERTY: 0.0})
+        # The last count is of observations greater than all of the buckets' upper bounds
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        histogram[_COUNTS_PROPERTY][index] += 1
+        histogram[_SUM_PROPERTY] += value
+
+    def merge(self, other: "Metrics"):
+        """
+        Adds the given metrics to these.
+        :param other: the metrics to add
+        """
+        for name, series in other.counters.items():
+            for label_key, value in series.items():
+                counters = self.counters.setdefault(name, {})
+                counters[label_key] = counters.get(label_key, 0) + value
+        for name, series in other.histograms.items():
+            for label_key, histogram in series.items():
+                existing = self.histograms.setdefault(name, {}).get(label_key)
+                if existing is None or len(existing[_COUNTS_PROPERTY]) != len(histogram[_COUNTS_PROPERTY]):
+                    self.histograms[name][label_key] = {_COUNTS_PROPERTY: list(histogram[_COUNTS_PROPERTY]),
+                                                        _SUM_PROPERTY: histogram[_SUM_PROPERTY]}
+                    continue
+                existing[_COUNTS_PROPERTY] = [a + b for a, b in zip(existing[_COUNTS_PROPERTY],
+                                                                    histogram[_COUNTS_PROPERTY])]
+                existing[_SUM_PROPERTY] += histogram[_SUM_PROPERTY]
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Gets the JSON representation of these metrics.
+        :return: the JSON representation
+        """
+        return {COUNTER: self.counters, HISTOGRAM: self.histograms}
+
+    @staticmethod
+    def from_json(json_metrics: Dict[str, Any]) -> "Metrics":
+        """
+        Creates metrics from their JSON representation.
+        :param json_metrics: the JSON representation (see `to_json`)
+        :return: the metrics
+        :raises ValueError: if the JSON representation is not valid
+        """
+        if not isinstance(json_metrics, dict) or not isinstance(json_metrics.get(COUNTER), dict) \
+                or not isinstance(json_metrics.get(HISTOGRAM), dict):
+            raise ValueError(f"Expected counters and histograms but got: {json_metrics}")
+        metrics = Metrics()
+        metrics.counters = json_metrics[COUNTER]
+        metrics.histograms = json_metrics[HISTOGRAM]
+        return metrics
+
+    def to_text(self) -> str:
+        """
+        Gets these metrics in the Prometheus text exposition format.
+        :return: the metrics as text
+        """
+        lines = []
+        for name, definition in METRIC_DEFINITIONS.items():
+            series = self.counters.get(name, {}) if definition.type == COUNTER else self.histograms.get(name, {})
+            if len(series) == 0:
+                continue
+            lines.append(f"# HELP {name} {definition.help}")
+            lines.append(f"# TYPE {name} {definition.type}")
+            for label_key in sorted(series.keys()):
+                labels = json.loads(label_key)
+                if definition.type == COUNTER:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(series[label_key])}")
+                    continue
+                histogram = series[label_key]
+                if len(histogram[_COUNTS_PROPERTY]) != len(definition.buckets) + 1:
+                    # Written with different buckets (by an older version)
+                    continue
+                cumulative_count = 0
+                for bound, count in zip(definition.buckets + (math.inf, ), histogram[_COUNTS_PROPERTY]):
+                    cumulative_count += count
+                    lines.append(f"{name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} "
+                                 f"{cumulative_count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram[_SUM_PROPERTY])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative_count}")
+        return "".join(f"{line}\n" for line in lines)
+
+
+def get_run_metrics(trace: Dict[str, Any]) -> Metrics:
+    """
+    Gets the metrics of a run from its profiler trace.
+    :param trace: the JSON trace of the run (see `Profiler.to_json`)
+    :return: the metrics of the run
+    """
+    metrics = Metrics()
+    labels = {PROJECT_LABEL: trace.get(PROJECT_PROPERTY, "")}
+    exit_code = trace.get(EXIT_CODE_PROPERTY)
+    metrics.increment(RUNS_METRIC, {**labels, EXIT_CODE_LABEL: str(exit_code) if exit_code is not None
+                                    else REPLACED_EXIT_CODE})
+
+    phases = trace.get(PHASES_PROPERTY, {})
+    for phase, name in ((CONFIGURATION_PHASE, CONFIGURATION_SECONDS_METRIC),
+                        (VARIABLES_PHASE, VARIABLES_SECONDS_METRIC), (DOCKER_PHASE, DOCKER_SECONDS_METRIC)):
+        if phase in phases:
+            metrics.observe(name, labels, phases[phase])
+
+    for source, status in trace.get(SOURCES_PROPERTY, {}).items():
+        metrics.increment(SOURCES_METRIC, {**labels, SOURCE_LABEL: source, STATUS_LABEL: status})
+    for status, count in trace.get(GITLAB_RESPONSES_PROPERTY, {}).items():
+        metrics.increment(GITLAB_REQUESTS_METRIC, {**labels, STATUS_LABEL: status}, count)
+    for duration in trace.get(GITLAB_REQUEST_DURATIONS_PROPERTY, []):
+        metrics.observe(GITLAB_REQUEST_SECONDS_METRIC, labels, duration)
+    for key, name in ((GITLAB_RETRIES_PROPERTY, GITLAB_RETRIES_METRIC), (GITLAB_HEDGES_PROPERTY, GITLAB_HEDGES_METRIC)):
+        if trace.get(key, 0) > 0:
+            metrics.increment(name, labels, trace[key])
+
+    if VARIABLE_COUNT_PROPERTY in trace:
+        metrics.observe(VARIABLES_INJECTED_METRIC, labels, trace[VARIABLE_COUNT_PROPERTY])
+    if VARIABLE_BYTES_PROPERTY in trace:
+        metrics.observe(VARIABLE_BYTES_INJECTED_METRIC, labels, trace[VARIABLE_BYTES_PROPERTY])
+    return metrics
+
+
+def write_metrics(location: str, metrics: Metrics) -> bool:
+    """
+    Adds the given metrics to those in the given metrics file, written in the Prometheus text format (e.g. for the node
+    exporter's textfile collector). Processes writing to the same file at the same time take turns, using a file lock.
+    The totals are kept in a JSON file next to the metrics file, which is replaced atomically so that it is never read
+    partially written.
+    :param location: the location of the metrics file
+    :param metrics: the metrics to add
+    :return: whether the metrics were written (failures are logged rather than raised, so as not to fail the run)
+    """
+    try:
+        with open(f"{location}{_LOCK_FILE_SUFFIX}", "a") as lock_file:
+            # Closing the file releases the lock
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            totals = _read_totals(f"{location}{_STATE_FILE_SUFFIX}")
+            totals.merge(metrics)
+            _replace_file(f"{location}{_STATE_FILE_SUFFIX}", json.dumps(totals.to_json()).encode(_ENCODING))
+            _replace_file(location, totals.to_text().encode(_ENCODING))
+        return True
+    except OSError as e:
+        _logger.warning(f"Could not write metrics to \"{location}\": {e}")
+        return False
+
+
+def _read_totals(location: str) -> Metrics:
+    """
+    Reads the metrics totals in the given file.
+    :param location: the location of the totals file
+    :return: the totals (empty if there is no (readable) file)
+    """
+    try:
+        with open(location, "r", encoding=_ENCODING) as file:
+            return Metrics.from_json(json.load(file))
+    except FileNotFoundError:
+        return Metrics()
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        _logger.warning(f"Ignoring unreadable metrics totals \"{location}\": {e}")
+        return Metrics()
+
+
+def _replace_file(location: str, contents: bytes):
+    """
+    Atomically replaces the given file with one containing the given contents, which all users can read.
+    :param location: the location of the file
+    :param contents: the contents to write
+    """
+    directory, name = os.path.split(os.path.abspath(location))
+    # The temp file is hidden so that the node exporter does not read it (it only reads files ending in `.prom`)
+    file_handle, temp_location = mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(file_handle, "wb") as file:
+            file.write(contents)
+            os.fchmod(file.fileno(), _METRICS_FILE_MODE)
+        os.replace(temp_location, location)
+    except BaseException:
+        os.remove(temp_location)
+        raise
+
+
+def _get_label_key(labels: Dict[str, str]) -> str:
+    """
+    Gets the key of the series with the given labels.
+    :param labels: the labels
+    :return: the key
+    """
+    return json.dumps(labels, sort_keys=True)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """
+    Formats the given labels in the Prometheus text format.
+    :param labels: the labels
+    :return: the formatted labels (empty if there are none)
+    """
+    if len(labels) == 0:
+        return ""
+    escaped = {key: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+               for key, value in labels.items()}
+    return "{" + ",".join(f"{key}=\"{value}\"" for key, value in escaped.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    """
+    Formats the given value in the Prometheus text format.
+    :param value: the value
+    :return: the formatted value
+    """
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
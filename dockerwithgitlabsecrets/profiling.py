@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Dict, Any, Iterator, Optional
+
+PROFILE_ENVIRONMENT_VARIABLE = "DWGS_PROFILE"
+STDERR_LOCATION = "-"
+
+CONFIGURATION_PHASE = "configuration"
+VARIABLES_PHASE = "variables"
+ENV_FILE_PHASE = "env_file"
+DOCKER_PHASE = "docker"
+
+PHASES_PROPERTY = "phases"
+TOTAL_PROPERTY = "total"
+TIMESTAMP_PROPERTY = "timestamp"
+PID_PROPERTY = "pid"
+
+
+class Profiler:
+    """
+    Records the duration of the phases of a run, along with other measurements, to be output as a JSON trace and/or
+    added to Prometheus metrics.
+    """
+    def __init__(self, location: Optional[str]=None, metrics_location: Optional[str]=None):
+        """
+        Constructor.
+        :param location: where to append the JSON trace (`STDERR_LOCATION` for stderr)
+        :param metrics_location: metrics file to add the run's metrics to (see `write_metrics`). Nothing is recorded if
+        neither this nor `location` is set
+        """
+        self.location = location
+        self.metrics_location = metrics_location
+        # Whether the trace has been written
+        self.written = False
+        self._started_at = time.monotonic()
+        self._timestamp = time.time()
+        self._phases: Dict[str, float] = {}
+        self._values: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Gets whether this profiler is recording.
+        :return: whether recording
+        """
+        return self.location is not None or self.metrics_location is not None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Times the phase with the given name for the duration of the context. Phases that are entered more than once
+        have their durations summed.
+        :param name: name of the phase
+        :return: context manager
+        """
+        if not self.enabled:
+            yield
+            return
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started_at
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + duration
+
+    def record(self, key: str, value: Any):
+        """
+        Records the given measurement.
+        :param key: name of the measurement
+        :param value: the (JSON serialisable) measurement
+        """
+        if self.enabled:
+            with self._lock:
+                self._values[key] = value
+
+    def record_item(self, key: str, item_key: str, value: Any):
+        """
+        Records the given measurement of an item (e.g. a variables source).
+        :param key: name of the measurement
+        :param item_key: the item
+        :param value: the (JSON serialisable) measurement
+        """
+        if self.enabled:
+            with self._lock:
+                self._values.setdefault(key, {})[item_key] = value
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Gets the JSON trace of what has been recorded.
+        :return: the JSON trace
+        """
+        with self._lock:
+            return {
+                TIMESTAMP_PROPERTY: self._timestamp,
+                PID_PROPERTY: os.getpid(),
+                TOTAL_PROPERTY: time.monotonic() - self._started_at,
+                PHASES_PROPERTY: dict(self._phases),
+                **self._values
+            }
+
+    def write(self):
+        """
+        Writes the JSON trace, as a single line, to the configured location and adds the run's metrics to the
+        configured metrics file.
+        """
+        if not self.enabled:
+            return
+        self.written = True
+        trace = self.to_json()
+        if self.location == STDERR_LOCATION:
+            sys.stderr.write(f"{json.dumps(trace)}\n")
+            sys.stderr.flush()
+        elif self.location is not None:
+            with open(self.location, "a") as file:
+                file.write(f"{json.dumps(trace)}\n")
+        if self.metrics_location is not None:
+            # Imported here as the metrics module depends on this one
+            from dockerwithgitlabsecrets.metrics import get_run_metrics, write_metrics
+            write_metrics(self.metrics_location, get_run_metrics(trace))
+
+
+NULL_PROFILER = Profiler()
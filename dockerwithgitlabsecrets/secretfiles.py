@@ -0,0 +1,113 @@
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from tempfile import mkdtemp, gettempdir
+
+from typing import Dict, NamedTuple, List, Iterator, Collection
+
+from dockerwithgitlabsecrets.configuration import SecretFilesConfiguration
+from dockerwithgitlabsecrets.envfile import TMPFS_DIRECTORY
+
+CONTAINER_SECRETS_DIRECTORY = "/run/secrets"
+FILE_VARIABLE_SUFFIX = "_FILE"
+
+_SECRET_FILES_DIRECTORY_PREFIX = "dwgs-secrets-"
+_SECRET_FILE_PERMISSIONS = 0o444
+_LINE_BREAK = "\n"
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+
+class SecretFile(NamedTuple):
+    """
+    Variable written to a file that is mounted into a container.
+    """
+    key: str
+    location: str
+    container_location: str
+
+    def get_file_variable(self) -> Dict[str, str]:
+        """
+        Gets the variable that gives the location of the file in the container.
+        :return: the variable, which has the key of the variable with `FILE_VARIABLE_SUFFIX` appended
+        """
+        return {f"{self.key}{FILE_VARIABLE_SUFFIX}": self.container_location}
+
+    def get_mount_arguments(self) -> List[str]:
+        """
+        Gets the arguments of `docker run` to mount the file (read-only) into the container.
+        :return: the Docker arguments
+        """
+        return ["--mount", f"type=bind,source={self.location},target={self.container_location},readonly"]
+
+
+def select_secret_file_keys(variables: Dict[str, str], configuration: SecretFilesConfiguration) -> List[str]:
+    """
+    Selects the keys of the given variables that are to be given as files, according to the given configuration.
+    :param variables: the variables
+    :param configuration: the secret files configuration
+    :return: the selected keys
+    """
+    selected = []
+    for key, value in variables.items():
+        if any(fnmatchcase(key, pattern) for pattern in configuration.keys) \
+                or (configuration.multiline and _LINE_BREAK in value) \
+                or (configuration.size_threshold > 0
+                    and len(value.encode(_ENCODING)) >= configuration.size_threshold):
+            selected.append(key)
+    return selected
+
+
+def replace_with_file_variables(variables: Dict[str, str], files: Collection[SecretFile]) -> Dict[str, str]:
+    """
+    Replaces the given variables that have been written to files with variables giving the files' locations.
+    :param variables: the variables
+    :param files: the files that (some of) the variables have been written to
+    :return: the variables to set in the environment
+    """
+    file_keys = {file.key for file in files}
+    replaced = {key: value for key, value in variables.items() if key not in file_keys}
+    for file in files:
+        replaced.update(file.get_file_variable())
+    return replaced
+
+
+@contextmanager
+def secret_files(variables: Dict[str, str], keys: Collection[str]) -> Iterator[List[SecretFile]]:
+    """
+    Writes the values of the variables with the given keys to files, which are removed on exit of the context.
+
+    The files are written, unescaped, to a directory on tmpfs (falling back to the temp directory) that only the
+    current user can access. The files themselves are read-only but readable by all so that they can be read by any
+    user in the container once mounted.
+    :param variables: the variables
+    :param keys: the keys of the variables to write to files
+    :return: context manager for the files
+    :raises ValueError: if a key cannot be used as a file name
+    """
+    if len(keys) == 0:
+        yield []
+        return
+
+    parent_directory = TMPFS_DIRECTORY if os.path.isdir(TMPFS_DIRECTORY) \
+        and os.access(TMPFS_DIRECTORY, os.W_OK | os.X_OK) else gettempdir()
+    directory = mkdtemp(prefix=_SECRET_FILES_DIRECTORY_PREFIX, dir=parent_directory)
+    try:
+        files = []
+        for key in keys:
+            if os.sep in key or key in (os.curdir, os.pardir):
+                raise ValueError(f"Variable key cannot be used as a file name: {key}")
+            location = os.path.join(directory, key)
+            file_descriptor = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(file_descriptor, "wb") as file:
+                file.write(variables[key].encode(_ENCODING))
+            os.chmod(location, _SECRET_FILE_PERMISSIONS)
+            files.append(SecretFile(key=key, location=location,
+                                    container_location=f"{CONTAINER_SECRETS_DIRECTORY}/{key}"))
+        _logger.info(f"Giving variables as files: {list(keys)}")
+        yield files
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
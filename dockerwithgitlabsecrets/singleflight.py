@@ -0,0 +1,215 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Dict, Optional, Collection, Iterator, Tuple
+
+from dockerwithgitlabsecrets.cache import VariablesFetcher, ensure_private_directory, write_private_file
+from dockerwithgitlabsecrets.defaults import DEFAULT_CACHE_DIRECTORY
+
+DEFAULT_SINGLE_FLIGHT_DIRECTORY = os.path.join(
+    os.environ["XDG_RUNTIME_DIR"], "dockerwithgitlabsecrets", "single-flight") if "XDG_RUNTIME_DIR" in os.environ \
+    else os.path.join(DEFAULT_CACHE_DIRECTORY, "single-flight")
+# Fetched variables are only shared via the runtime directory (which is not persisted), never on disk
+DEFAULT_SHARE_RESULTS = "XDG_RUNTIME_DIR" in os.environ
+# Seconds after which the variables shared by a process are removed
+DEFAULT_SHARE_WINDOW = 1.0
+
+_LOCK_FILE_SUFFIX = ".lock"
+_RESULT_FILE_SUFFIX = ".json"
+_LOCK_POLL_INTERVAL = 0.01
+_MAX_LOCK_POLL_INTERVAL = 0.1
+
+_VARIABLES_PROPERTY = "variables"
+_FETCHED_PROPERTY = "fetched"
+
+_ENCODING = "utf-8"
+
+_logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Collapses fetches of the same variables, made at the same time by processes of the current user on this machine,
+    into one fetch. The first process to take a (per-project) file lock fetches the variables and shares them, in a
+    file that only the current user can read, with the processes that were waiting for the lock. Variables are only
+    shared with processes that started waiting before the variables were fetched, so they are never older than those
+    the waiting process would have fetched itself. The shared variables are removed after the share window (or when
+    the fetching process exits, if sooner).
+    """
+    def __init__(self, wait: float, directory: str=DEFAULT_SINGLE_FLIGHT_DIRECTORY,
+                 share_results: bool=DEFAULT_SHARE_RESULTS, share_window: float=DEFAULT_SHARE_WINDOW):
+        """
+        Constructor.
+        :param wait: the maximum number of seconds to wait for another process to fetch the variables, after which they
+        are fetched regardless
+        :param directory: the directory in which to store lock and result files
+        :param share_results: whether fetched variables can be shared via files in the directory (which must not be
+        persisted, e.g. be in the runtime directory). If not, `get` only fetches
+        :param share_window: the number of seconds for which fetched variables are shared
+        """
+        self.wait = wait
+        self.directory = directory
+        self.share_results = share_results
+        self.share_window = share_window
+
+    def get(self, url: str, project: str, fetcher: VariablesFetcher, keys: Optional[Collection[str]]=None) \
+            -> Tuple[Dict[str, str], bool]:
+        """
+        Gets the variables for the given project, fetching them unless another process has just done so.
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :param fetcher: fetches the variables
+        :param keys: the keys of the variables that the fetcher fetches (`None` if it fetches all of the variables)
+        :return: tuple where the first element is the variables and the second is whether they were fetched by another
+        process
+        """
+        if not self.share_results:
+            return fetcher(), False
+        started = time.time()
+        key = _get_key(url, project, keys)
+        with self._lock(key) as locked:
+            if not locked:
+                return fetcher(), False
+            result_location = os.path.join(self.directory, f"{key}{_RESULT_FILE_SUFFIX}")
+            variables = _read_result(result_location, started)
+            if variables is not None:
+                return variables, True
+            variables = fetcher()
+            fetched = time.time()
+            json_result = {_VARIABLES_PROPERTY: variables, _FETCHED_PROPERTY: fetched}
+            write_private_file(result_location, json.dumps(json_result).encode(_ENCODING))
+        self._schedule_result_removal(result_location, fetched)
+        return variables, False
+
+    @contextmanager
+    def lock(self, url: str, project: str) -> Iterator[bool]:
+        """
+        Holds the lock of the given project whilst in the context, so that only one process at a time gets the
+        variables of the project (e.g. through the cache, which the first process then populates for the others).
+        :param url: the URL of the GitLab instance the variables come from
+        :param project: the project the variables belong to
+        :return: context manager, giving whether the lock was acquired (not if the wait timed out)
+        """
+        with self._lock(_get_key(url, project)) as locked:
+            yield locked
+
+    def _schedule_result_removal(self, location: str, fetched: float):
+        """
+        Schedules the removal of the given result file after the share window, or when this process exits.
+        :param location: the location of the result file
+        :param fetched: when the variables in the result file were fetched
+        """
+        timer = threading.Timer(self.share_window, _remove_result, args=(location, fetched))
+        timer.daemon = True
+        timer.start()
+        atexit.register(_remove_result, location, fetched)
+
+    @contextmanager
+    def _lock(self, key: str) -> Iterator[bool]:
+        """
+        Holds the lock with the given key whilst in the context.
+        :param key: the key of the lock
+        :return: context manager, giving whether the lock was acquired (not if the wait timed out or the lock file could
+        not be opened)
+        """
+        try:
+            if not ensure_private_directory(self.directory):
+                yield False
+                return
+            file_descriptor = os.open(os.path.join(self.directory, f"{key}{_LOCK_FILE_SUFFIX}"),
+                                      os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            _logger.warning(f"Could not open single flight lock (fetching variables regardless): {e}")
+            yield False
+            return
+
+        try:
+            locked = _acquire_lock(file_descriptor, self.wait)
+            if not locked:
+                _logger.warning(f"Timed out after {self.wait}s waiting for another process to fetch variables "
+                                f"(fetching them regardless)")
+            yield locked
+        finally:
+            # Closing the file releases the lock
+            os.close(file_descriptor)
+
+
+def _acquire_lock(file_descriptor: int, wait: float) -> bool:
+    """
+    Acquires an exclusive lock on the given file, waiting at most the given time for it.
+    :param file_descriptor: the file descriptor of the lock file
+    :param wait: the maximum number of seconds to wait
+    :return: whether the lock was acquired
+    """
+    deadline = time.monotonic() + wait
+    poll_interval = _LOCK_POLL_INTERVAL
+    while True:
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(poll_interval, remaining))
+            poll_interval = min(poll_interval * 2, _MAX_LOCK_POLL_INTERVAL)
+
+
+def _read_result(location: str, fetched_after: float) -> Optional[Dict[str, str]]:
+    """
+    Reads the variables in the given result file, if they were fetched after the given time.
+    :param location: the location of the result file
+    :param fetched_after: the time after which the variables must have been fetched to be used
+    :return: the variables or `None` if there are no (recent enough) variables
+    """
+    try:
+        with open(location, "r", encoding=_ENCODING) as file:
+            json_result = json.load(file)
+        if json_result[_FETCHED_PROPERTY] < fetched_after:
+            # Left by a process that exited without removing it
+            _remove_result(location, json_result[_FETCHED_PROPERTY])
+            return None
+        return json_result[_VARIABLES_PROPERTY]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        _logger.warning(f"Ignoring unreadable single flight result \"{location}\": {e}")
+        return None
+
+
+def _remove_result(location: str, fetched: float):
+    """
+    Removes the given result file, if it still contains the variables fetched at the given time.
+    :param location: the location of the result file
+    :param fetched: when the variables in the result file were fetched
+    """
+    try:
+        with open(location, "r", encoding=_ENCODING) as file:
+            if json.load(file)[_FETCHED_PROPERTY] != fetched:
+                return
+        os.remove(location)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        _logger.warning(f"Could not remove single flight result \"{location}\": {e}")
+
+
+def _get_key(url: str, project: str, keys: Optional[Collection[str]]=None) -> str:
+    """
+    Gets the key of the lock and result files for the given project.
+    :param url: the URL of the GitLab instance the variables come from
+    :param project: the project the variables belong to
+    :param keys: the keys of the variables fetched (`None` if all of the variables are fetched)
+    :return: the key
+    """
+    identifier = f"{url.rstrip('/')}\n{project}"
+    if keys is not None:
+        identifier += f"\n{json.dumps(sorted(keys))}"
+    return hashlib.sha256(identifier.encode(_ENCODING)).hexdigest()
@@ -0,0 +1,189 @@
+import json
+import os
+import struct
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer
+from tempfile import mkdtemp
+from urllib.parse import urlsplit, parse_qs
+
+from typing import Dict, List, Tuple
+
+from dockerwithgitlabsecrets.engine import API_VERSION
+
+MISSING_IMAGE = "missing"
+NOT_FOUND_COMMAND = "not-found"
+
+_SOCKET_NAME = "docker.sock"
+_FRAME_HEADER_FORMAT = ">BxxxL"
+_START_TIMEOUT = 10.0
+_POLL_INTERVAL = 0.05
+_ENCODING = "utf-8"
+
+
+class _FakeContainer:
+    """
+    Container in the fake Docker Engine.
+    """
+    def __init__(self, configuration: Dict, name: str):
+        self.configuration = configuration
+        self.name = name
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.killed = False
+
+
+class FakeDockerEngine:
+    """
+    Local server, on a Unix socket, that imitates the parts of the Docker Engine API that are used to run containers.
+    Containers do not run anything: they write the configured output then exit with the configured exit code.
+    """
+    def __init__(self, output: List[Tuple[int, bytes]]=(), exit_code: int=0):
+        """
+        Constructor.
+        :param output: the output that containers write, as tuples where the first element is the stream
+        (`STDOUT_STREAM` or `STDERR_STREAM`) and the second is the data written
+        :param exit_code: the exit code of containers
+        """
+        self.output = list(output)
+        self.exit_code = exit_code
+        self.containers: Dict[str, _FakeContainer] = {}
+        self.removed: List[str] = []
+        self.requests: List[str] = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._directory = mkdtemp()
+        self.socket_location = os.path.join(self._directory, _SOCKET_NAME)
+        self._server = ThreadingUnixStreamServer(self.socket_location, _create_request_handler(self))
+        self._server.daemon_threads = True
+        self._thread: threading.Thread = None
+
+    def start(self):
+        """
+        Starts the server in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(_POLL_INTERVAL, ), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        os.remove(self.socket_location)
+        os.rmdir(self._directory)
+
+    def __enter__(self) -> "FakeDockerEngine":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _create_request_handler(engine: FakeDockerEngine) -> type:
+    """
+    Creates a handler of requests to the given fake Docker Engine.
+    :param engine: the fake Docker Engine
+    :return: the request handler class
+    """
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with engine._lock:
+                engine.connections += 1
+
+        def address_string(self) -> str:
+            return engine.socket_location
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+        def _handle(self, method: str):
+            split_path = urlsplit(self.path)
+            with engine._lock:
+                engine.requests.append(f"{method} {split_path.path}")
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode(_ENCODING)) if length > 0 else None
+            query = parse_qs(split_path.query)
+
+            path_elements = split_path.path.split("/")
+            if len(path_elements) < 3 or path_elements[1] != f"v{API_VERSION}" or path_elements[2] != "containers":
+                self._respond(404, {"message": "page not found"})
+                return
+            if path_elements[3:] == ["create"] and method == "POST":
+                self._create(body, query.get("name", [None])[0])
+                return
+
+            container = engine.containers.get(path_elements[3]) if len(path_elements) > 3 else None
+            if container is None:
+                self._respond(404, {"message": f"No such container: {path_elements[3:]}"})
+                return
+            action = path_elements[4] if len(path_elements) > 4 else None
+            if method == "DELETE" and action is None:
+                with engine._lock:
+                    del engine.containers[path_elements[3]]
+                    engine.removed.append(path_elements[3])
+                self._respond(204, None)
+            elif action == "attach":
+                self._attach(container)
+            elif action == "start":
+                if container.configuration.get("Cmd") == [NOT_FOUND_COMMAND]:
+                    self._respond(400, {"message": f"failed to create shim task: exec: \"{NOT_FOUND_COMMAND}\": "
+                                                   f"executable file not found in $PATH: unknown"})
+                    return
+                container.started.set()
+                self._respond(204, None)
+            elif action == "wait":
+                container.exited.wait(_START_TIMEOUT)
+                self._respond(200, {"StatusCode": engine.exit_code if not container.killed else 137})
+            elif action == "kill":
+                container.killed = True
+                container.exited.set()
+                self._respond(204, None)
+            else:
+                self._respond(404, {"message": "page not found"})
+
+        def _create(self, configuration: Dict, name: str):
+            if configuration["Image"] == MISSING_IMAGE:
+                self._respond(404, {"message": f"No such image: {MISSING_IMAGE}:latest"})
+                return
+            container_id = uuid.uuid4().hex
+            with engine._lock:
+                engine.containers[container_id] = _FakeContainer(configuration, name)
+            self._respond(201, {"Id": container_id, "Warnings": []})
+
+        def _attach(self, container: _FakeContainer):
+            # The connection is hijacked: the output is streamed until the container exits, then the connection closes
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.end_headers()
+            self.wfile.flush()
+            if container.started.wait(_START_TIMEOUT):
+                for stream, data in engine.output:
+                    self.wfile.write(struct.pack(_FRAME_HEADER_FORMAT, stream, len(data)) + data)
+                    self.wfile.flush()
+                container.exited.set()
+            self.close_connection = True
+
+        def _respond(self, status: int, json_body):
+            body = json.dumps(json_body).encode(_ENCODING) if json_body is not None else b""
+            self.send_response(status)
+            if json_body is not None:
+                self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return RequestHandler
@@ -0,0 +1,82 @@
+import os
+import shutil
+import stat
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.agent import SecretsAgent, AgentClient, AgentError
+from dockerwithgitlabsecrets.configuration import Configuration, GitLabConfiguration, AgentConfiguration
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_TOKEN, EXAMPLE_PROJECT, EXAMPLE_VARIABLES
+
+_FETCH_DURATION = 0.2
+_CONCURRENT_REQUESTS = 10
+
+
+class TestSecretsAgent(unittest.TestCase):
+    """
+    Tests for `SecretsAgent` and `AgentClient`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.socket_location = os.path.join(self._temp_directory, "agent", "agent.sock")
+        self.fetches = 0
+        self._fetches_lock = threading.Lock()
+        configuration = Configuration(
+            gitlab=GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN),
+            agent=AgentConfiguration(socket=self.socket_location, ttl=60))
+        self.agent = SecretsAgent(configuration, self._fetch)
+        self._agent_thread = threading.Thread(target=self.agent.serve)
+        self._agent_thread.start()
+        while not os.path.exists(self.socket_location):
+            time.sleep(0.01)
+        self.client = AgentClient(self.socket_location)
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self._agent_thread.join()
+        shutil.rmtree(self._temp_directory)
+
+    def test_get(self):
+        self.assertEqual(EXAMPLE_VARIABLES, self.client.get(EXAMPLE_URL, EXAMPLE_PROJECT))
+        self.assertEqual(EXAMPLE_VARIABLES, self.client.get(EXAMPLE_URL, EXAMPLE_PROJECT))
+        self.assertEqual(1, self.fetches)
+
+    def test_refresh(self):
+        self.client.get(EXAMPLE_URL, EXAMPLE_PROJECT)
+        self.client.get(EXAMPLE_URL, EXAMPLE_PROJECT, refresh=True)
+        self.assertEqual(2, self.fetches)
+
+    def test_concurrent_requests_coalesced(self):
+        with ThreadPoolExecutor(_CONCURRENT_REQUESTS) as executor:
+            results = list(executor.map(lambda _: self.client.get(EXAMPLE_URL, EXAMPLE_PROJECT),
+                                        range(_CONCURRENT_REQUESTS)))
+        self.assertEqual([EXAMPLE_VARIABLES] * _CONCURRENT_REQUESTS, results)
+        self.assertEqual(1, self.fetches)
+
+    def test_different_gitlab(self):
+        self.assertRaises(AgentError, self.client.get, f"{EXAMPLE_URL}.other", EXAMPLE_PROJECT)
+
+    def test_fetch_error(self):
+        self.assertRaises(AgentError, self.client.get, EXAMPLE_URL, "missing")
+
+    def test_socket_only_accessible_by_user(self):
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.socket_location).st_mode))
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(os.path.dirname(self.socket_location)).st_mode))
+
+    def test_second_agent_refused(self):
+        self.assertRaises(AgentError, SecretsAgent(self.agent.configuration, self._fetch).serve)
+
+    def _fetch(self, gitlab_configuration: GitLabConfiguration, project: str):
+        with self._fetches_lock:
+            self.fetches += 1
+        time.sleep(_FETCH_DURATION)
+        if project != EXAMPLE_PROJECT:
+            raise ValueError(f"Project not found: {project}")
+        return EXAMPLE_VARIABLES
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import asyncio
+import sys
+import unittest
+
+from dockerwithgitlabsecrets.asynchronous import run_batch, run_wrapped_async, _run_docker_async
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_VARIABLES
+
+_PRINT_PROGRAM = "import sys; sys.stdout.write('out'); sys.stderr.write('err'); sys.exit(3)"
+
+
+class TestRunDockerAsync(unittest.TestCase):
+    """
+    Tests for `_run_docker_async`.
+    """
+    def setUp(self):
+        self.event_loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.event_loop.close()
+
+    def test_without_stream(self):
+        output = self.event_loop.run_until_complete(
+            _run_docker_async([sys.executable, "-c", _PRINT_PROGRAM], (), False, None))
+        self.assertEqual((3, "out", "err"), output)
+
+    def test_stream_with_tail(self):
+        program = "import sys; sys.stdout.write('x' * 1000 + 'end')"
+        return_code, stdout, stderr = self.event_loop.run_until_complete(
+            _run_docker_async([sys.executable, "-c", program], (), True, 3))
+        self.assertEqual(0, return_code)
+        self.assertEqual("end", stdout)
+        self.assertEqual("", stderr)
+
+    def test_stream_without_tail(self):
+        output = self.event_loop.run_until_complete(
+            _run_docker_async([sys.executable, "-c", "pass"], (), True, None))
+        self.assertEqual((0, None, None), output)
+
+    def test_concurrent(self):
+        program = "import time; time.sleep(0.5)"
+
+        async def run_all():
+            return await asyncio.gather(*[_run_docker_async([sys.executable, "-c", program], (), False, None)
+                                          for _ in range(4)])
+
+        started_at = self.event_loop.time()
+        outputs = self.event_loop.run_until_complete(run_all())
+        self.assertEqual([0] * 4, [return_code for return_code, _, _ in outputs])
+        self.assertLess(self.event_loop.time() - started_at, 4 * 0.5)
+
+    def test_with_environment(self):
+        program = "import os; print(os.environ['MY_VARIABLE'])"
+        return_code, stdout, stderr = self.event_loop.run_until_complete(
+            _run_docker_async([sys.executable, "-c", program], (), False, None, {"MY_VARIABLE": "value"}))
+        self.assertEqual("value", stdout.strip())
+
+    def test_cancel_kills_process(self):
+        async def run_then_cancel():
+            task = asyncio.ensure_future(
+                _run_docker_async([sys.executable, "-c", "import time; time.sleep(60)"], (), False, None))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        started_at = self.event_loop.time()
+        self.assertRaises(asyncio.CancelledError, self.event_loop.run_until_complete, run_then_cancel())
+        self.assertLess(self.event_loop.time() - started_at, 10)
+
+
+class TestRunWrappedAsync(unittest.TestCase):
+    """
+    Tests for `run_wrapped_async`.
+    """
+    def test_run_gets_variables(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        event_loop = asyncio.new_event_loop()
+        try:
+            return_code, stdout, stderr = event_loop.run_until_complete(
+                run_wrapped_async(["run", "--rm", "alpine", "printenv", key], EXAMPLE_VARIABLES))
+        finally:
+            event_loop.close()
+        self.assertEqual(0, return_code)
+        self.assertEqual(value, stdout.strip())
+
+    def test_run_with_secret_file(self):
+        event_loop = asyncio.new_event_loop()
+        try:
+            return_code, stdout, stderr = event_loop.run_until_complete(run_wrapped_async(
+                ["run", "--rm", "alpine", "sh", "-c", "cat $HELLO_FILE; printenv HELLO"], EXAMPLE_VARIABLES,
+                secret_file_keys=["HELLO"]))
+        finally:
+            event_loop.close()
+        self.assertEqual(1, return_code)
+        self.assertEqual(EXAMPLE_VARIABLES["HELLO"], stdout)
+
+
+class TestRunBatch(unittest.TestCase):
+    """
+    Tests for `run_batch`.
+    """
+    def test_gets_variables_once(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        calls = []
+
+        def get_variables():
+            calls.append(None)
+            return EXAMPLE_VARIABLES
+
+        results = run_batch([["run", "--rm", "alpine", "printenv", key]] * 3, get_variables, max_concurrency=2)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([0, 1, 2], sorted(result.index for result in results))
+        for result in results:
+            self.assertEqual(0, result.output[0])
+            self.assertEqual(value, result.output[1].strip())
+
+    def test_non_supported_actions_do_not_get_variables(self):
+        def get_variables():
+            raise AssertionError("Variables should not be got for actions that do not use them")
+        results = run_batch([["version"], ["ps", "--help"]], get_variables)
+        self.assertEqual([0, 0], [result.output[0] for result in results])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.bundle import Bundle, BundleError, write_bundle, get_bundle_passphrase, \
+    BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_NAMESPACE, EXAMPLE_PROJECT, EXAMPLE_VARIABLES
+
+_PASSPHRASE = "passphrase"
+_GROUP_SOURCE = "group:hgi"
+_GROUP_VARIABLES = {"GROUP": "group"}
+
+
+class TestBundle(unittest.TestCase):
+    """
+    Tests for `write_bundle` and `Bundle`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.location = os.path.join(self._temp_directory, "bundle")
+        write_bundle(self.location, {_GROUP_SOURCE: _GROUP_VARIABLES, EXAMPLE_PROJECT: EXAMPLE_VARIABLES},
+                     _PASSPHRASE, EXAMPLE_URL, EXAMPLE_NAMESPACE)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_directory)
+
+    def test_read(self):
+        bundle = Bundle(self.location, _PASSPHRASE)
+        self.assertEqual((EXAMPLE_URL, EXAMPLE_NAMESPACE, [_GROUP_SOURCE, EXAMPLE_PROJECT]),
+                         (bundle.url, bundle.namespace, bundle.sources))
+        self.assertEqual(EXAMPLE_VARIABLES, bundle.get_variables(EXAMPLE_PROJECT))
+        self.assertEqual(_GROUP_VARIABLES, bundle.get_variables(_GROUP_SOURCE))
+
+    def test_only_readable_by_user(self):
+        self.assertEqual(0o600, os.stat(self.location).st_mode & 0o777)
+
+    def test_does_not_contain_plain_variables(self):
+        with open(self.location, "rb") as file:
+            contents = file.read()
+        for value in list(EXAMPLE_VARIABLES.values()) + [EXAMPLE_PROJECT]:
+            self.assertNotIn(value.encode(), contents)
+
+    def test_read_with_wrong_passphrase(self):
+        self.assertRaises(BundleError, Bundle, self.location, f"{_PASSPHRASE}-wrong")
+
+    def test_read_missing_source(self):
+        bundle = Bundle(self.location, _PASSPHRASE)
+        self.assertRaises(BundleError, bundle.get_variables, f"{EXAMPLE_PROJECT}-other")
+
+    def test_read_without_decrypting_other_sources(self):
+        bundle = Bundle(self.location, _PASSPHRASE)
+        # The variables of the last source are at the end of the bundle
+        with open(self.location, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            last_byte = file.read(1)
+            file.seek(-1, os.SEEK_END)
+            file.write(bytes([last_byte[0] ^ 1]))
+        self.assertEqual(_GROUP_VARIABLES, bundle.get_variables(_GROUP_SOURCE))
+        self.assertRaises(BundleError, bundle.get_variables, EXAMPLE_PROJECT)
+
+    def test_read_non_bundle(self):
+        with open(self.location, "wb") as file:
+            file.write(b"not a bundle")
+        self.assertRaises(BundleError, Bundle, self.location, _PASSPHRASE)
+
+    def test_read_non_existent_bundle(self):
+        self.assertRaises(BundleError, Bundle, f"{self.location}-missing", _PASSPHRASE)
+
+
+class TestGetBundlePassphrase(unittest.TestCase):
+    """
+    Tests for `get_bundle_passphrase`.
+    """
+    def setUp(self):
+        self._passphrase = os.environ.pop(BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE, None)
+
+    def tearDown(self):
+        os.environ.pop(BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE, None)
+        if self._passphrase is not None:
+            os.environ[BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE] = self._passphrase
+
+    def test_get(self):
+        os.environ[BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE] = _PASSPHRASE
+        self.assertEqual(_PASSPHRASE, get_bundle_passphrase())
+
+    def test_get_when_not_set(self):
+        self.assertRaises(BundleError, get_bundle_passphrase)
+
+
+if __name__ == "__main__":
+    unittest.main()
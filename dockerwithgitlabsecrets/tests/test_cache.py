@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import stat
+import unittest
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.cache import VariablesCache, CacheStatus
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_PROJECT, EXAMPLE_VARIABLES
+
+_OTHER_VARIABLES = {"OTHER": "other"}
+
+
+class TestVariablesCache(unittest.TestCase):
+    """
+    Tests for `VariablesCache`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.cache_directory = os.path.join(self._temp_directory, "cache")
+        self.fetches = 0
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_directory)
+
+    def test_miss_then_hit(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.MISS), cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.HIT), cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertEqual(1, self.fetches)
+
+    def test_keyed_by_url_and_project(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        self.assertEqual(CacheStatus.MISS, cache.get(f"{EXAMPLE_URL}.other", EXAMPLE_PROJECT, self._fetch)[1])
+        self.assertEqual(CacheStatus.MISS, cache.get(EXAMPLE_URL, f"{EXAMPLE_PROJECT}-other", self._fetch)[1])
+
+    def test_refresh(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        self.assertEqual((_OTHER_VARIABLES, CacheStatus.REFRESH),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, lambda: _OTHER_VARIABLES, refresh=True))
+        self.assertEqual(_OTHER_VARIABLES, cache.get_entry(EXAMPLE_URL, EXAMPLE_PROJECT).variables)
+
+    def test_expired(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        self._set_aged_entry(cache, 120)
+        self.assertEqual((_OTHER_VARIABLES, CacheStatus.MISS),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, lambda: _OTHER_VARIABLES))
+
+    def test_stale_while_revalidate(self):
+        cache = VariablesCache(self.cache_directory, ttl=60, stale_while_revalidate=120)
+        self._set_aged_entry(cache, 120)
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.STALE),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, lambda: _OTHER_VARIABLES))
+        cache.wait_for_refreshes()
+        self.assertEqual((_OTHER_VARIABLES, CacheStatus.HIT),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+
+    def test_revalidated_when_unchanged(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        self._set_aged_entry(cache, 120)
+        location = cache._get_entry_location(EXAMPLE_URL, EXAMPLE_PROJECT)
+        with open(location, "r") as file:
+            contents = file.read()
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.REVALIDATED),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        with open(location, "r") as file:
+            self.assertEqual(contents, file.read())
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.HIT), cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+
+    def test_conditional_fetch_with_etag(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        etags = []
+
+        def conditional_fetch(etag):
+            etags.append(etag)
+            return (EXAMPLE_VARIABLES, "etag-1") if etag is None else (None, etag)
+
+        self.assertEqual(CacheStatus.MISS, cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch,
+                                                     conditional_fetcher=conditional_fetch)[1])
+        self.assertEqual((EXAMPLE_VARIABLES, CacheStatus.REVALIDATED),
+                         cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch, refresh=True,
+                                   conditional_fetcher=conditional_fetch))
+        self.assertEqual([None, "etag-1"], etags)
+        self.assertEqual(0, self.fetches)
+
+    def test_ignores_corrupt_entry(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        for file_name in os.listdir(self.cache_directory):
+            with open(os.path.join(self.cache_directory, file_name), "w") as file:
+                file.write("{")
+        self.assertIsNone(cache.get_entry(EXAMPLE_URL, EXAMPLE_PROJECT))
+
+    def test_owner_only_permissions(self):
+        cache = VariablesCache(self.cache_directory, ttl=60)
+        cache.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(self.cache_directory).st_mode))
+        for file_name in os.listdir(self.cache_directory):
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(os.path.join(self.cache_directory, file_name)).st_mode))
+
+    def _fetch(self):
+        self.fetches += 1
+        return EXAMPLE_VARIABLES
+
+    def _set_aged_entry(self, cache: VariablesCache, age: float):
+        cache.set_entry(EXAMPLE_URL, EXAMPLE_PROJECT, EXAMPLE_VARIABLES)
+        location = cache._get_entry_location(EXAMPLE_URL, EXAMPLE_PROJECT)
+        with open(location, "r") as file:
+            json_entry = json.load(file)
+        json_entry["fetched"] -= age
+        with open(location, "w") as file:
+            json.dump(json_entry, file)
+        os.utime(location, (json_entry["fetched"], json_entry["fetched"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
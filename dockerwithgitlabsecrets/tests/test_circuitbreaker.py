@@ -0,0 +1,110 @@
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.circuitbreaker import CircuitBreaker, CircuitOpenError, MIN_LATENCIES_FOR_PERCENTILE, \
+    MAX_LATENCIES
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL
+
+_FAILURE_THRESHOLD = 2
+_RESET_TIMEOUT = 60.0
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Tests for `CircuitBreaker`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.directory = os.path.join(self._temp_directory, "circuit-breakers")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_directory)
+
+    def _create_circuit_breaker(self, failure_threshold: int=_FAILURE_THRESHOLD,
+                                reset_timeout: float=_RESET_TIMEOUT) -> CircuitBreaker:
+        return CircuitBreaker(EXAMPLE_URL, failure_threshold, reset_timeout, self.directory)
+
+    def test_closed_until_threshold(self):
+        circuit_breaker = self._create_circuit_breaker()
+        circuit_breaker.before_request()
+        circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+        circuit_breaker.record_failure()
+        self.assertRaises(CircuitOpenError, circuit_breaker.before_request)
+
+    def test_success_resets_failures(self):
+        circuit_breaker = self._create_circuit_breaker()
+        circuit_breaker.record_failure()
+        circuit_breaker.record_success()
+        circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+
+    def test_state_shared_between_instances(self):
+        for _ in range(_FAILURE_THRESHOLD):
+            self._create_circuit_breaker().record_failure()
+        with self.assertRaises(CircuitOpenError) as context:
+            self._create_circuit_breaker().before_request()
+        self.assertEqual(EXAMPLE_URL, context.exception.host)
+        for name in os.listdir(self.directory):
+            self.assertEqual(0o600, os.stat(os.path.join(self.directory, name)).st_mode & 0o777)
+
+    def test_single_trial_after_reset_timeout(self):
+        circuit_breaker = self._create_circuit_breaker(reset_timeout=0)
+        for _ in range(_FAILURE_THRESHOLD):
+            circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+        self.assertRaises(CircuitOpenError, self._create_circuit_breaker().before_request)
+
+    def test_successful_trial_closes(self):
+        circuit_breaker = self._create_circuit_breaker(reset_timeout=0)
+        for _ in range(_FAILURE_THRESHOLD):
+            circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+        circuit_breaker.record_success()
+        self._create_circuit_breaker().before_request()
+
+    def test_failed_trial_reopens(self):
+        circuit_breaker = self._create_circuit_breaker(reset_timeout=0)
+        for _ in range(_FAILURE_THRESHOLD):
+            circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+        circuit_breaker.record_failure()
+        self.assertRaises(CircuitOpenError, self._create_circuit_breaker().before_request)
+
+    def test_success_when_closed_does_not_write_state(self):
+        circuit_breaker = self._create_circuit_breaker()
+        circuit_breaker.record_success()
+        self.assertFalse(os.path.exists(self.directory))
+        circuit_breaker.record_failure()
+        circuit_breaker.record_success()
+        # The state is replaced (with a new file) when it is written
+        state_location = os.path.join(self.directory, os.listdir(self.directory)[0])
+        inode = os.stat(state_location).st_ino
+        circuit_breaker.record_success()
+        self.assertEqual(inode, os.stat(state_location).st_ino)
+
+    def test_disabled(self):
+        circuit_breaker = self._create_circuit_breaker(failure_threshold=0)
+        for _ in range(_FAILURE_THRESHOLD * 2):
+            circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+
+    def test_latency_percentile(self):
+        circuit_breaker = self._create_circuit_breaker(failure_threshold=0)
+        circuit_breaker.record_success([0.1] * (MIN_LATENCIES_FOR_PERCENTILE - 1))
+        self.assertIsNone(circuit_breaker.get_latency_percentile(95))
+        circuit_breaker.record_success([1.0])
+        self.assertEqual(0.1, circuit_breaker.get_latency_percentile(50))
+        self.assertEqual(1.0, circuit_breaker.get_latency_percentile(100))
+
+    def test_keeps_recent_latencies(self):
+        circuit_breaker = self._create_circuit_breaker()
+        circuit_breaker.record_success([1.0] * MAX_LATENCIES)
+        circuit_breaker.record_success([0.1] * MAX_LATENCIES)
+        self.assertEqual(0.1, circuit_breaker.get_latency_percentile(100))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from typing import Callable, Tuple, Set
+
+from dockerwithgitlabsecrets.client import GitLabVariablesClient, GitLabRequestError, RETRY_AFTER_HEADER, \
+    is_transient_error, LEGACY_API_PATH, VERSION_PATH
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_TOKEN, EXAMPLE_NAMESPACE, EXAMPLE_PROJECT, EXAMPLE_VARIABLES
+from dockerwithgitlabsecrets.testsupport.fakegitlab import FakeGitLab
+
+_PROJECT = f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}"
+_MANY_VARIABLES = {f"VARIABLE_{i}": str(i) for i in range(250)}
+_PER_PAGE = 10
+_LATENCY = 0.1
+
+
+class TestGitLabVariablesClient(unittest.TestCase):
+    """
+    Tests for `GitLabVariablesClient`.
+    """
+    def setUp(self):
+        self.gitlab = FakeGitLab(EXAMPLE_TOKEN)
+        self.gitlab.set_project_variables(_PROJECT, EXAMPLE_VARIABLES)
+        self.gitlab.start()
+        self.client = self._create_client(per_page=_PER_PAGE)
+
+    def tearDown(self):
+        self.client.close()
+        self.gitlab.stop()
+
+    def test_get_project_variables(self):
+        self.assertEqual(EXAMPLE_VARIABLES, self.client.get_project_variables(_PROJECT))
+
+    def test_get_group_variables(self):
+        self.gitlab.set_group_variables(EXAMPLE_NAMESPACE, EXAMPLE_VARIABLES)
+        self.assertEqual(EXAMPLE_VARIABLES, self.client.get_group_variables(EXAMPLE_NAMESPACE))
+
+    def test_get_unknown_project(self):
+        with self.assertRaises(GitLabRequestError) as context:
+            self.client.get_project_variables(f"{_PROJECT}-other")
+        self.assertEqual(404, context.exception.status)
+
+    def test_get_with_invalid_token(self):
+        client = GitLabVariablesClient(self.gitlab.url, f"{EXAMPLE_TOKEN}-other")
+        with self.assertRaises(GitLabRequestError) as context:
+            client.get_project_variables(_PROJECT)
+        self.assertEqual(401, context.exception.status)
+
+    def test_reuses_connection(self):
+        self.client.get_project_variables(_PROJECT)
+        self.client.get_project_variables(_PROJECT)
+        self.assertEqual(1, self.gitlab.connections)
+        self.assertEqual([False, True], [timing.reused_connection for timing in self.client.timings])
+
+    def test_get_pages_in_parallel(self):
+        self.gitlab.set_project_variables(_PROJECT, _MANY_VARIABLES)
+        self.gitlab.latency = _LATENCY
+        started_at = time.monotonic()
+        self.assertEqual(_MANY_VARIABLES, self.client.get_project_variables(_PROJECT))
+        pages = len(_MANY_VARIABLES) // _PER_PAGE
+        self.assertEqual(pages, len(self.client.timings))
+        self.assertLess(time.monotonic() - started_at, pages * _LATENCY / 2)
+
+    def test_get_pages_without_total(self):
+        self.gitlab.set_project_variables(_PROJECT, _MANY_VARIABLES)
+        self.gitlab.report_total_pages = False
+        self.assertEqual(_MANY_VARIABLES, self.client.get_project_variables(_PROJECT))
+
+    def test_get_if_changed_when_unchanged(self):
+        variables, etag = self.client.get_project_variables_if_changed(_PROJECT, None)
+        self.assertEqual(EXAMPLE_VARIABLES, variables)
+        self.assertIsNotNone(etag)
+        self.assertEqual((None, etag), self.client.get_project_variables_if_changed(_PROJECT, etag))
+        self.assertEqual([200, 304], [timing.status for timing in self.client.timings])
+
+    def test_get_if_changed_when_changed(self):
+        _, etag = self.client.get_project_variables_if_changed(_PROJECT, None)
+        self.gitlab.set_project_variables(_PROJECT, _MANY_VARIABLES)
+        variables, new_etag = self.client.get_project_variables_if_changed(_PROJECT, etag)
+        self.assertEqual(_MANY_VARIABLES, variables)
+        self.assertIsNone(new_etag)
+
+    def test_get_environment_variables(self):
+        self.gitlab.add_project_variables(_PROJECT, {"SCOPED": "review", "OTHER": "review"}, "review/*")
+        self.gitlab.add_project_variables(_PROJECT, {"SCOPED": "production"}, "production")
+        variables = self.client.get_project_variables(_PROJECT, "production")
+        self.assertEqual(dict(EXAMPLE_VARIABLES, SCOPED="production"), variables)
+        variables = self.client.get_project_variables(_PROJECT, "review/feature")
+        self.assertEqual(dict(EXAMPLE_VARIABLES, SCOPED="review", OTHER="review"), variables)
+
+    def test_get_variables_by_key(self):
+        keys = list(EXAMPLE_VARIABLES.keys())[:2]
+        variables = self.client.get_project_variables_by_key(_PROJECT, keys + ["MISSING"])
+        self.assertEqual({key: EXAMPLE_VARIABLES[key] for key in keys}, variables)
+        # The API version is checked after the (first) missing variable
+        self.assertTrue(all(timing.path.startswith(f"/projects/{quote(_PROJECT, safe='')}/variables/")
+                            for timing in self.client.timings if timing.path != VERSION_PATH))
+
+    def test_get_environment_variables_by_key(self):
+        self.gitlab.add_project_variables(_PROJECT, {"SCOPED": "production", "OTHER": "production"}, "production")
+        self.gitlab.add_project_variables(_PROJECT, {"SCOPED": "staging", "OTHER": "staging"}, "staging")
+        self.gitlab.add_project_variables(_PROJECT, {"UNSCOPED": "value"}, "*")
+        self.assertEqual({"SCOPED": "staging", "UNSCOPED": "value"}, self.client.get_project_variables_by_key(
+            _PROJECT, ["SCOPED", "UNSCOPED"], "staging"))
+
+    def test_recording_timings(self):
+        self.gitlab.set_project_variables(_PROJECT, _MANY_VARIABLES)
+        self.gitlab.set_group_variables(EXAMPLE_NAMESPACE, EXAMPLE_VARIABLES)
+        self.gitlab.latency = _LATENCY
+
+        def get_recorded_paths(get: Callable) -> Tuple[Set[str], int]:
+            with self.client.recording_timings() as timings:
+                get()
+            return {timing.path.split("?")[0] for timing in timings}, len(timings)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            project_recorded = executor.submit(get_recorded_paths, lambda: self.client.get_project_variables(_PROJECT))
+            group_recorded = executor.submit(get_recorded_paths,
+                                             lambda: self.client.get_group_variables(EXAMPLE_NAMESPACE))
+        self.assertEqual(({f"/projects/{quote(_PROJECT, safe='')}/variables"}, len(_MANY_VARIABLES) // _PER_PAGE),
+                         project_recorded.result())
+        self.assertEqual(({f"/groups/{quote(EXAMPLE_NAMESPACE, safe='')}/variables"}, 1), group_recorded.result())
+        self.assertEqual(len(_MANY_VARIABLES) // _PER_PAGE + 1, len(self.client.timings))
+
+    def test_get_from_legacy_api(self):
+        with FakeGitLab(EXAMPLE_TOKEN, api_path=LEGACY_API_PATH) as gitlab:
+            gitlab.set_project_variables(_PROJECT, EXAMPLE_VARIABLES)
+            client = GitLabVariablesClient(gitlab.url, EXAMPLE_TOKEN)
+            self.addCleanup(client.close)
+            self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+            self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+            self.assertEqual(4, len(gitlab.requests))
+            with self.assertRaises(GitLabRequestError) as context:
+                client.get_project_variables(f"{_PROJECT}-other")
+            self.assertEqual(404, context.exception.status)
+
+    def test_unknown_project_does_not_switch_api(self):
+        self.assertRaises(GitLabRequestError, self.client.get_project_variables, f"{_PROJECT}-other")
+        self.assertEqual(EXAMPLE_VARIABLES, self.client.get_project_variables(_PROJECT))
+        self.assertEqual(3, len(self.gitlab.requests))
+
+    def _create_client(self, **kwargs) -> GitLabVariablesClient:
+        client = GitLabVariablesClient(self.gitlab.url, EXAMPLE_TOKEN, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_retry_after_transient_error(self):
+        self.gitlab.queued_responses = [(503, {}), (429, {RETRY_AFTER_HEADER: "0"})]
+        client = self._create_client(retries=2, retry_backoff=0.01)
+        self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+        self.assertEqual([503, 429, 200], [timing.status for timing in client.timings])
+        self.assertEqual(2, client.retried)
+
+    def test_retry_honours_retry_after(self):
+        self.gitlab.queued_responses = [(429, {RETRY_AFTER_HEADER: "1"})]
+        client = self._create_client(retry_backoff=0.01)
+        started_at = time.monotonic()
+        self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+        self.assertGreaterEqual(time.monotonic() - started_at, 1)
+
+    def test_no_retry_if_retry_after_too_long(self):
+        self.gitlab.queued_responses = [(503, {RETRY_AFTER_HEADER: "60"})]
+        client = self._create_client(max_retry_wait=1)
+        with self.assertRaises(GitLabRequestError) as context:
+            client.get_project_variables(_PROJECT)
+        self.assertEqual((503, 60), (context.exception.status, context.exception.retry_after))
+        self.assertEqual(1, len(self.gitlab.requests))
+
+    def test_no_retry_after_other_error(self):
+        self.assertRaises(GitLabRequestError, self.client.get_project_variables, f"{_PROJECT}-other")
+        # The other request checks the API version, after the project is not found
+        self.assertEqual(1, len([path for path in self.gitlab.requests if not path.endswith(VERSION_PATH)]))
+
+    def test_retries_exhausted(self):
+        self.gitlab.queued_responses = [(502, {})] * 3
+        client = self._create_client(retries=2, retry_backoff=0.01)
+        with self.assertRaises(GitLabRequestError) as context:
+            client.get_project_variables(_PROJECT)
+        self.assertTrue(is_transient_error(context.exception))
+        self.assertEqual(3, len(self.gitlab.requests))
+
+    def test_read_timeout(self):
+        self.gitlab.queued_latencies = [_LATENCY * 5]
+        client = self._create_client(read_timeout=_LATENCY, retries=0)
+        with self.assertRaises(OSError) as context:
+            client.get_project_variables(_PROJECT)
+        self.assertTrue(is_transient_error(context.exception))
+
+    def test_hedged_request(self):
+        self.gitlab.queued_latencies = [_LATENCY * 10]
+        client = self._create_client(hedge_delay=_LATENCY)
+        started_at = time.monotonic()
+        self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+        self.assertLess(time.monotonic() - started_at, _LATENCY * 5)
+        self.assertEqual((1, 2), (client.hedged, len(self.gitlab.requests)))
+
+    def test_not_hedged_if_fast(self):
+        client = self._create_client(hedge_delay=_LATENCY * 10)
+        self.assertEqual(EXAMPLE_VARIABLES, client.get_project_variables(_PROJECT))
+        self.assertEqual((0, 1), (client.hedged, len(self.gitlab.requests)))
+
+
+if __name__ == "__main__":
+    unittest.main()
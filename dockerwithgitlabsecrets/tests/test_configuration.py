@@ -1,13 +1,27 @@
+import json
 import os
+import shutil
+import subprocess
+import sys
 import unittest
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 
 import yaml
 from typing import Dict
 
 from dockerwithgitlabsecrets.configuration import GITLAB_PROPERTY, GITLAB_URL_PROPERTY, GITLAB_TOKEN_PROPERTY, \
-    GITLAB_NAMESPACE_PROPERTY, GITLAB_PROJECT_PROPERTY, parse_configuration, Configuration, GitLabConfiguration
-from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_TOKEN, EXAMPLE_NAMESPACE, EXAMPLE_PROJECT
+    GITLAB_NAMESPACE_PROPERTY, GITLAB_PROJECT_PROPERTY, GITLAB_PROJECTS_PROPERTY, parse_configuration, Configuration, GitLabConfiguration, \
+    load_configuration, \
+    CACHE_PROPERTY, CACHE_TTL_PROPERTY, CACHE_STALE_WHILE_REVALIDATE_PROPERTY, CACHE_LOCATION_PROPERTY, \
+    CacheConfiguration, AGENT_PROPERTY, AGENT_SOCKET_PROPERTY, AGENT_TTL_PROPERTY, AgentConfiguration, \
+    SECRET_FILES_PROPERTY, SECRET_FILES_KEYS_PROPERTY, SECRET_FILES_SIZE_THRESHOLD_PROPERTY, \
+    SECRET_FILES_MULTILINE_PROPERTY, SecretFilesConfiguration, GITLAB_INCLUDE_PROPERTY, GITLAB_EXCLUDE_PROPERTY, \
+    GITLAB_ENVIRONMENT_SCOPE_PROPERTY, SINGLE_FLIGHT_PROPERTY, SINGLE_FLIGHT_WAIT_PROPERTY, SingleFlightConfiguration, \
+    GITLAB_CONNECT_TIMEOUT_PROPERTY, GITLAB_READ_TIMEOUT_PROPERTY, GITLAB_RETRIES_PROPERTY, \
+    GITLAB_HEDGE_PERCENTILE_PROPERTY, GITLAB_CIRCUIT_BREAKER_PROPERTY, CIRCUIT_BREAKER_FAILURES_PROPERTY, \
+    CIRCUIT_BREAKER_RESET_TIMEOUT_PROPERTY, CircuitBreakerConfiguration
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_TOKEN, EXAMPLE_NAMESPACE, EXAMPLE_PROJECT, \
+    EXAMPLE_LOCATION
 
 
 class TestParseConfiguration(unittest.TestCase):
@@ -46,6 +60,119 @@ class TestParseConfiguration(unittest.TestCase):
             url=EXAMPLE_URL, token=EXAMPLE_TOKEN, project=EXAMPLE_PROJECT, namespace=EXAMPLE_NAMESPACE))
         self.assertEqual(expected, parse_configuration(self._temp_file_location))
 
+    def test_parse_multiple_projects_configuration(self):
+        projects = [f"{EXAMPLE_PROJECT}-1", f"{EXAMPLE_PROJECT}-2"]
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN,
+                GITLAB_PROJECT_PROPERTY: EXAMPLE_PROJECT,
+                GITLAB_PROJECTS_PROPERTY: projects
+            }
+        })
+        configuration = parse_configuration(self._temp_file_location)
+        self.assertEqual(projects, configuration.gitlab.projects)
+        self.assertEqual(projects, configuration.gitlab.get_default_sources())
+
+    def test_parse_variables_filter_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN,
+                GITLAB_INCLUDE_PROPERTY: ["APP_*"],
+                GITLAB_EXCLUDE_PROPERTY: ["*_ADMIN_*"],
+                GITLAB_ENVIRONMENT_SCOPE_PROPERTY: "production"
+            }
+        })
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN, include=["APP_*"],
+                                                     exclude=["*_ADMIN_*"], environment_scope="production"))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
+    def test_parse_cache_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN
+            },
+            CACHE_PROPERTY: {
+                CACHE_TTL_PROPERTY: 60,
+                CACHE_STALE_WHILE_REVALIDATE_PROPERTY: 600,
+                CACHE_LOCATION_PROPERTY: EXAMPLE_LOCATION
+            }
+        })
+        # The circuit breaker's state is stored in the cache location
+        expected = Configuration(
+            GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN,
+                                circuit_breaker=CircuitBreakerConfiguration(directory=EXAMPLE_LOCATION)),
+            CacheConfiguration(ttl=60, stale_while_revalidate=600, location=EXAMPLE_LOCATION))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
+    def test_parse_agent_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN
+            },
+            AGENT_PROPERTY: {
+                AGENT_SOCKET_PROPERTY: EXAMPLE_LOCATION,
+                AGENT_TTL_PROPERTY: 10
+            }
+        })
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN),
+                                 agent=AgentConfiguration(socket=EXAMPLE_LOCATION, ttl=10))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
+    def test_parse_secret_files_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN
+            },
+            SECRET_FILES_PROPERTY: {
+                SECRET_FILES_KEYS_PROPERTY: ["*_CERT"],
+                SECRET_FILES_SIZE_THRESHOLD_PROPERTY: 4096,
+                SECRET_FILES_MULTILINE_PROPERTY: True
+            }
+        })
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN),
+                                 secret_files=SecretFilesConfiguration(keys=["*_CERT"], size_threshold=4096,
+                                                                       multiline=True))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
+    def test_parse_single_flight_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN
+            },
+            SINGLE_FLIGHT_PROPERTY: {
+                SINGLE_FLIGHT_WAIT_PROPERTY: 10
+            }
+        })
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN),
+                                 single_flight=SingleFlightConfiguration(wait=10))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
+    def test_parse_resilience_configuration(self):
+        self._json_to_temp_file({
+            GITLAB_PROPERTY: {
+                GITLAB_URL_PROPERTY: EXAMPLE_URL,
+                GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN,
+                GITLAB_CONNECT_TIMEOUT_PROPERTY: 1,
+                GITLAB_READ_TIMEOUT_PROPERTY: 2.5,
+                GITLAB_RETRIES_PROPERTY: 0,
+                GITLAB_HEDGE_PERCENTILE_PROPERTY: 95,
+                GITLAB_CIRCUIT_BREAKER_PROPERTY: {
+                    CIRCUIT_BREAKER_FAILURES_PROPERTY: 3,
+                    CIRCUIT_BREAKER_RESET_TIMEOUT_PROPERTY: 30
+                }
+            }
+        })
+        expected = Configuration(GitLabConfiguration(
+            url=EXAMPLE_URL, token=EXAMPLE_TOKEN, connect_timeout=1, read_timeout=2.5, retries=0, hedge_percentile=95,
+            circuit_breaker=CircuitBreakerConfiguration(failure_threshold=3, reset_timeout=30)))
+        self.assertEqual(expected, parse_configuration(self._temp_file_location))
+
     def _json_to_temp_file(self, json: Dict):
         """
         Writes the equivalent YAML to the given JSON in the temp file.
@@ -55,5 +182,94 @@ class TestParseConfiguration(unittest.TestCase):
             yaml.dump(json, file)
 
 
+class TestLoadConfiguration(unittest.TestCase):
+    """
+    Tests for `load_configuration`.
+    """
+    def setUp(self):
+        self._temp_file_handle, self._temp_file_location = mkstemp()
+        self._compiled_directory = mkdtemp()
+        self._write_configuration(EXAMPLE_TOKEN)
+
+    def tearDown(self):
+        os.remove(self._temp_file_location)
+        shutil.rmtree(self._compiled_directory)
+
+    def test_load_non_existent_configuration(self):
+        self.assertRaises(ValueError, load_configuration, f"{self._temp_file_location}_does_not_exist",
+                          self._compiled_directory)
+
+    def test_load_without_compiling(self):
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN))
+        self.assertEqual(expected, load_configuration(self._temp_file_location, None))
+
+    def test_compiles_configuration(self):
+        expected = Configuration(GitLabConfiguration(url=EXAMPLE_URL, token=EXAMPLE_TOKEN))
+        self.assertEqual(expected, load_configuration(self._temp_file_location, self._compiled_directory))
+        self.assertEqual(0o600, os.stat(self._get_compiled_location()).st_mode & 0o777)
+
+    def test_loads_compiled_configuration(self):
+        load_configuration(self._temp_file_location, self._compiled_directory)
+        self._set_compiled_token("compiled")
+        configuration = load_configuration(self._temp_file_location, self._compiled_directory)
+        self.assertEqual("compiled", configuration.gitlab.token)
+
+    def test_ignores_compiled_configuration_readable_by_others(self):
+        load_configuration(self._temp_file_location, self._compiled_directory)
+        self._set_compiled_token("compiled")
+        os.chmod(self._get_compiled_location(), 0o644)
+        configuration = load_configuration(self._temp_file_location, self._compiled_directory)
+        self.assertEqual(EXAMPLE_TOKEN, configuration.gitlab.token)
+        self.assertEqual(0o600, os.stat(self._get_compiled_location()).st_mode & 0o777)
+
+    def test_recompiles_changed_configuration(self):
+        load_configuration(self._temp_file_location, self._compiled_directory)
+        self._write_configuration(f"{EXAMPLE_TOKEN}-changed")
+        configuration = load_configuration(self._temp_file_location, self._compiled_directory)
+        self.assertEqual(f"{EXAMPLE_TOKEN}-changed", configuration.gitlab.token)
+
+    def test_ignores_corrupt_compiled_configuration(self):
+        load_configuration(self._temp_file_location, self._compiled_directory)
+        with open(self._get_compiled_location(), "w") as file:
+            file.write("{")
+        configuration = load_configuration(self._temp_file_location, self._compiled_directory)
+        self.assertEqual(EXAMPLE_TOKEN, configuration.gitlab.token)
+
+    def test_loads_compiled_configuration_without_yaml(self):
+        load_configuration(self._temp_file_location, self._compiled_directory)
+        code = "import sys; from dockerwithgitlabsecrets.configuration import load_configuration; " \
+               f"load_configuration({self._temp_file_location!r}, {self._compiled_directory!r}); " \
+               "sys.exit(int('yaml' in sys.modules))"
+        self.assertEqual(0, subprocess.run([sys.executable, "-c", code]).returncode)
+
+    def _write_configuration(self, token: str):
+        """
+        Writes a configuration with the given GitLab token to the temp file.
+        :param token: the GitLab token
+        """
+        with open(self._temp_file_location, "w") as file:
+            yaml.dump({GITLAB_PROPERTY: {GITLAB_URL_PROPERTY: EXAMPLE_URL, GITLAB_TOKEN_PROPERTY: token}}, file)
+
+    def _get_compiled_location(self) -> str:
+        """
+        Gets the location of the (only) compiled configuration.
+        :return: the location of the compiled configuration
+        """
+        compiled = os.listdir(self._compiled_directory)
+        self.assertEqual(1, len(compiled))
+        return os.path.join(self._compiled_directory, compiled[0])
+
+    def _set_compiled_token(self, token: str):
+        """
+        Sets the GitLab token in the compiled configuration, without changing the configuration file.
+        :param token: the GitLab token
+        """
+        with open(self._get_compiled_location(), "r") as file:
+            compiled = json.load(file)
+        compiled["configuration"][GITLAB_PROPERTY][GITLAB_TOKEN_PROPERTY] = token
+        with open(self._get_compiled_location(), "w") as file:
+            json.dump(compiled, file)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,118 @@
+import os
+import unittest
+
+from dockerwithgitlabsecrets.engine import parse_run_arguments, RunConfiguration, get_docker_socket_location, \
+    DockerEngineClient, DockerEngineError, read_output_frames, DEFAULT_DOCKER_SOCKET, DOCKER_HOST_ENVIRONMENT_VARIABLE, \
+    DOCKER_CONTEXT_ENVIRONMENT_VARIABLE, STDOUT_STREAM, STDERR_STREAM
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_VARIABLES, EXAMPLE_PARAMETER, EXAMPLE_VALUE
+from dockerwithgitlabsecrets.tests._fake_docker_engine import FakeDockerEngine, MISSING_IMAGE
+
+_ENVIRONMENT_VARIABLES = [DOCKER_HOST_ENVIRONMENT_VARIABLE, DOCKER_CONTEXT_ENVIRONMENT_VARIABLE]
+
+
+class TestParseRunArguments(unittest.TestCase):
+    """
+    Tests for `parse_run_arguments`.
+    """
+    def test_parse_image(self):
+        expected = RunConfiguration(container={
+            "AttachStdout": True, "AttachStderr": True, "Image": "alpine",
+            "Env": [f"{key}={value}" for key, value in EXAMPLE_VARIABLES.items()], "HostConfig": {}})
+        self.assertEqual(expected, parse_run_arguments(["alpine"], EXAMPLE_VARIABLES))
+
+    def test_parse_supported_arguments(self):
+        key = list(EXAMPLE_VARIABLES.keys())[0]
+        run_configuration = parse_run_arguments([
+            "--rm", "--name=example", "-e", f"{key}=override", "--env", f"{EXAMPLE_PARAMETER}={EXAMPLE_VALUE}",
+            "-w", "/work", "--user=1000", "-l", "a=b", "-v", "/a:/b:ro", "--network", "host", "--init",
+            "--mount", "type=bind,source=/c,target=/d,readonly", "alpine", "printenv", key], EXAMPLE_VARIABLES)
+        self.assertTrue(run_configuration.remove)
+        self.assertEqual("example", run_configuration.name)
+        container = run_configuration.container
+        self.assertEqual(["printenv", key], container["Cmd"])
+        self.assertIn(f"{key}=override", container["Env"])
+        self.assertIn(f"{EXAMPLE_PARAMETER}={EXAMPLE_VALUE}", container["Env"])
+        self.assertEqual(len(EXAMPLE_VARIABLES) + 1, len(container["Env"]))
+        self.assertEqual(("/work", "1000", {"a": "b"}), (container["WorkingDir"], container["User"],
+                                                          container["Labels"]))
+        self.assertEqual({"Binds": ["/a:/b:ro"], "NetworkMode": "host", "Init": True,
+                          "Mounts": [{"Type": "bind", "Source": "/c", "Target": "/d", "ReadOnly": True}]},
+                         container["HostConfig"])
+
+    def test_parse_unsupported_arguments(self):
+        self.assertIsNone(parse_run_arguments(["--privileged", "alpine"], EXAMPLE_VARIABLES))
+        self.assertIsNone(parse_run_arguments(["-it", "alpine"], EXAMPLE_VARIABLES))
+        self.assertIsNone(parse_run_arguments(["--mount", "type=volume,source=a,target=/b", "alpine"],
+                                              EXAMPLE_VARIABLES))
+
+    def test_parse_without_image(self):
+        self.assertIsNone(parse_run_arguments(["--rm"], EXAMPLE_VARIABLES))
+        self.assertIsNone(parse_run_arguments(["--name"], EXAMPLE_VARIABLES))
+
+
+class TestGetDockerSocketLocation(unittest.TestCase):
+    """
+    Tests for `get_docker_socket_location`.
+    """
+    def setUp(self):
+        self._environment = {key: os.environ.pop(key) for key in _ENVIRONMENT_VARIABLES if key in os.environ}
+
+    def tearDown(self):
+        for key in _ENVIRONMENT_VARIABLES:
+            os.environ.pop(key, None)
+        os.environ.update(self._environment)
+
+    def test_unix_docker_host(self):
+        os.environ[DOCKER_HOST_ENVIRONMENT_VARIABLE] = "unix:///tmp/docker.sock"
+        self.assertEqual("/tmp/docker.sock", get_docker_socket_location())
+
+    def test_tcp_docker_host(self):
+        os.environ[DOCKER_HOST_ENVIRONMENT_VARIABLE] = "tcp://127.0.0.1:2375"
+        self.assertIsNone(get_docker_socket_location())
+
+    def test_docker_context(self):
+        os.environ[DOCKER_CONTEXT_ENVIRONMENT_VARIABLE] = "remote"
+        self.assertIsNone(get_docker_socket_location())
+        os.environ[DOCKER_CONTEXT_ENVIRONMENT_VARIABLE] = "default"
+        self.assertEqual(DEFAULT_DOCKER_SOCKET, get_docker_socket_location())
+
+
+class TestDockerEngineClient(unittest.TestCase):
+    """
+    Tests for `DockerEngineClient`.
+    """
+    def setUp(self):
+        self.engine = FakeDockerEngine(output=[(STDOUT_STREAM, b"out"), (STDERR_STREAM, b"err")], exit_code=3)
+        self.engine.start()
+        self.client = DockerEngineClient(self.engine.socket_location)
+
+    def tearDown(self):
+        self.client.close()
+        self.engine.stop()
+
+    def test_run_container(self):
+        container_id = self.client.create_container({"Image": "alpine"}, "example")
+        self.assertEqual("example", self.engine.containers[container_id].name)
+        attachment = self.client.attach_container(container_id)
+        try:
+            self.client.start_container(container_id)
+            self.assertEqual([(STDOUT_STREAM, b"out"), (STDERR_STREAM, b"err")], list(read_output_frames(attachment)))
+        finally:
+            attachment.close()
+        self.assertEqual(3, self.client.wait_container(container_id))
+        self.client.remove_container(container_id)
+        self.assertEqual([container_id], self.engine.removed)
+
+    def test_create_with_missing_image(self):
+        with self.assertRaises(DockerEngineError) as context:
+            self.client.create_container({"Image": MISSING_IMAGE})
+        self.assertEqual(404, context.exception.status)
+
+    def test_reuses_connection(self):
+        for _ in range(3):
+            self.client.create_container({"Image": "alpine"})
+        self.assertEqual(1, self.engine.connections)
+
+
+if __name__ == "__main__":
+    unittest.main()
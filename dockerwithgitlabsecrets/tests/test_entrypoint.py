@@ -1,9 +1,13 @@
+import json
 import os
 import re
+import shutil
+import sys
 import unittest
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 
 import yaml
+from typing import List
 from gitlab import Gitlab
 from gitlabbuildvariables.common import GitLabConfig
 from gitlabbuildvariables.manager import ProjectVariablesManager
@@ -13,13 +17,26 @@ from useintest.services.controllers import DockerisedServiceController
 
 from dockerwithgitlabsecrets.configuration import GITLAB_URL_PROPERTY, GITLAB_PROPERTY, GITLAB_TOKEN_PROPERTY, \
     GITLAB_PROJECT_PROPERTY, GITLAB_NAMESPACE_PROPERTY
+from dockerwithgitlabsecrets.asynchronous import BatchResult
+from dockerwithgitlabsecrets.bundle import Bundle, BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE
+from dockerwithgitlabsecrets.client import GitLabRequestError
+from dockerwithgitlabsecrets.metrics import ERROR_EXIT_CODE
+from dockerwithgitlabsecrets.variables import VariablesDiff
 from dockerwithgitlabsecrets.entrypoint import CliConfiguration, parse_cli_arguments, CONFIG_PARAMETER, \
-    PROJECT_PARAMETER, is_interactive, run
+    PROJECT_PARAMETER, is_interactive, run, parse_agent_cli_arguments, BATCH_PARAMETER, PARALLELISM_PARAMETER, \
+    read_batch, write_batch_report, get_batch_exit_code, run_batch_file, BATCH_EXIT_CODE_PROPERTY, \
+    BATCH_INDEX_PROPERTY, DIFF_PARAMETER, format_variables_diff, INCLUDE_PARAMETER, EXCLUDE_PARAMETER, \
+    ENVIRONMENT_SCOPE_PARAMETER, BUNDLE_PARAMETER, parse_export_cli_arguments, export_bundle, main, METRICS_PARAMETER
 from dockerwithgitlabsecrets.tests._common import EXAMPLE_PROJECT, EXAMPLE_LOCATION, EXAMPLE_DOCKER_ARGS, \
-    EXAMPLE_VARIABLES
+    EXAMPLE_VARIABLES, EXAMPLE_NAMESPACE, EXAMPLE_TOKEN
+from dockerwithgitlabsecrets.testsupport.fakegitlab import FakeGitLab
 
 _CONFIG_PARAMETER_FLAG = f"--{CONFIG_PARAMETER}"
 _PROJECT_PARAMETER_FLAG = f"--{PROJECT_PARAMETER}"
+_BATCH_PARAMETER_FLAG = f"--{BATCH_PARAMETER}"
+_PARALLELISM_PARAMETER_FLAG = f"--{PARALLELISM_PARAMETER}"
+_BUNDLE_PARAMETER_FLAG = f"--{BUNDLE_PARAMETER}"
+_METRICS_PARAMETER_FLAG = f"--{METRICS_PARAMETER}"
 
 _GITLAB_PORT = 80
 
@@ -41,16 +58,147 @@ class TestParseCliArguments(unittest.TestCase):
 
     def test_parse_only_project_argument(self):
         arguments = [_PROJECT_PARAMETER_FLAG, EXAMPLE_PROJECT]
-        expected = CliConfiguration(project=EXAMPLE_PROJECT)
+        expected = CliConfiguration(project=EXAMPLE_PROJECT, projects=[EXAMPLE_PROJECT])
+        self.assertEqual(expected, parse_cli_arguments(arguments))
+
+    def test_parse_multiple_project_arguments(self):
+        arguments = [_PROJECT_PARAMETER_FLAG, f"{EXAMPLE_PROJECT}-1", _PROJECT_PARAMETER_FLAG,
+                     f"{EXAMPLE_PROJECT}-2,{EXAMPLE_PROJECT}-3"]
+        expected = CliConfiguration(project=f"{EXAMPLE_PROJECT}-1",
+                                    projects=[f"{EXAMPLE_PROJECT}-1", f"{EXAMPLE_PROJECT}-2", f"{EXAMPLE_PROJECT}-3"])
         self.assertEqual(expected, parse_cli_arguments(arguments))
 
     def test_parse_program_arguments_with_docker_arguments(self):
         arguments = [_CONFIG_PARAMETER_FLAG, EXAMPLE_LOCATION, _PROJECT_PARAMETER_FLAG, EXAMPLE_PROJECT] \
                     + EXAMPLE_DOCKER_ARGS
-        expected = CliConfiguration(project=EXAMPLE_PROJECT, config_location=EXAMPLE_LOCATION,
-                                    docker_args=EXAMPLE_DOCKER_ARGS, interactive=True)
+        expected = CliConfiguration(project=EXAMPLE_PROJECT, projects=[EXAMPLE_PROJECT],
+                                    config_location=EXAMPLE_LOCATION, docker_args=EXAMPLE_DOCKER_ARGS, interactive=True)
+        self.assertEqual(expected, parse_cli_arguments(arguments))
+
+    def test_parse_batch_arguments(self):
+        arguments = [_BATCH_PARAMETER_FLAG, EXAMPLE_LOCATION, _PARALLELISM_PARAMETER_FLAG, "2"]
+        expected = CliConfiguration(batch_location=EXAMPLE_LOCATION, parallelism=2)
         self.assertEqual(expected, parse_cli_arguments(arguments))
 
+    def test_parse_batch_argument_with_docker_arguments(self):
+        self.assertRaises(SystemExit, parse_cli_arguments, [_BATCH_PARAMETER_FLAG, EXAMPLE_LOCATION]
+                          + EXAMPLE_DOCKER_ARGS)
+
+    def test_parse_diff_argument(self):
+        arguments = [_PROJECT_PARAMETER_FLAG, EXAMPLE_PROJECT, f"--{DIFF_PARAMETER}"]
+        self.assertEqual(CliConfiguration(project=EXAMPLE_PROJECT, projects=[EXAMPLE_PROJECT], diff=True),
+                         parse_cli_arguments(arguments))
+
+    def test_parse_variables_filter_arguments(self):
+        arguments = [f"--{INCLUDE_PARAMETER}", "APP_*,DATABASE_URL", f"--{INCLUDE_PARAMETER}", "OTHER",
+                     f"--{EXCLUDE_PARAMETER}", "*_ADMIN_*", f"--{ENVIRONMENT_SCOPE_PARAMETER}", "production"]
+        expected = CliConfiguration(include=["APP_*", "DATABASE_URL", "OTHER"], exclude=["*_ADMIN_*"],
+                                    environment_scope="production")
+        self.assertEqual(expected, parse_cli_arguments(arguments))
+
+    def test_parse_bundle_argument(self):
+        arguments = [_BUNDLE_PARAMETER_FLAG, EXAMPLE_LOCATION] + EXAMPLE_DOCKER_ARGS
+        expected = CliConfiguration(bundle_location=EXAMPLE_LOCATION, docker_args=EXAMPLE_DOCKER_ARGS,
+                                    interactive=True)
+        self.assertEqual(expected, parse_cli_arguments(arguments))
+
+    def test_parse_bundle_argument_with_diff_argument(self):
+        self.assertRaises(SystemExit, parse_cli_arguments, [_BUNDLE_PARAMETER_FLAG, EXAMPLE_LOCATION,
+                                                            f"--{DIFF_PARAMETER}"])
+
+
+class TestCliConfiguration(unittest.TestCase):
+    """
+    Tests for `CliConfiguration`.
+    """
+    def test_get_projects(self):
+        self.assertEqual([f"{EXAMPLE_PROJECT}-1", f"{EXAMPLE_PROJECT}-2"], CliConfiguration(
+            project=f"{EXAMPLE_PROJECT}-1", projects=[f"{EXAMPLE_PROJECT}-1", f"{EXAMPLE_PROJECT}-2"]).get_projects())
+
+    def test_get_projects_of_single_project(self):
+        self.assertEqual([EXAMPLE_PROJECT], CliConfiguration(project=EXAMPLE_PROJECT).get_projects())
+
+    def test_get_projects_when_not_given(self):
+        self.assertEqual([], CliConfiguration().get_projects())
+
+
+class TestFormatVariablesDiff(unittest.TestCase):
+    """
+    Tests for `format_variables_diff`.
+    """
+    def test_unchanged(self):
+        self.assertEqual(f"{EXAMPLE_PROJECT}: unchanged",
+                         format_variables_diff(EXAMPLE_PROJECT, VariablesDiff(added=[], changed=[], removed=[])))
+
+    def test_changed(self):
+        self.assertEqual(f"{EXAMPLE_PROJECT}: added A, B; removed C", format_variables_diff(
+            EXAMPLE_PROJECT, VariablesDiff(added=["A", "B"], changed=[], removed=["C"])))
+
+
+class TestParseAgentCliArguments(unittest.TestCase):
+    """
+    Tests for `parse_agent_cli_arguments`.
+    """
+    def test_parse_no_arguments(self):
+        self.assertEqual(CliConfiguration(), parse_agent_cli_arguments([]))
+
+    def test_parse_config_location_argument(self):
+        expected = CliConfiguration(config_location=EXAMPLE_LOCATION)
+        self.assertEqual(expected, parse_agent_cli_arguments([_CONFIG_PARAMETER_FLAG, EXAMPLE_LOCATION]))
+
+
+class TestParseExportCliArguments(unittest.TestCase):
+    """
+    Tests for `parse_export_cli_arguments`.
+    """
+    def test_parse_arguments(self):
+        arguments = [_CONFIG_PARAMETER_FLAG, EXAMPLE_LOCATION, _PROJECT_PARAMETER_FLAG, f"{EXAMPLE_PROJECT},group:hgi",
+                     f"--{EXCLUDE_PARAMETER}", "*_ADMIN_*", _BUNDLE_PARAMETER_FLAG, EXAMPLE_LOCATION]
+        expected = CliConfiguration(config_location=EXAMPLE_LOCATION, project=EXAMPLE_PROJECT,
+                                    projects=[EXAMPLE_PROJECT, "group:hgi"], exclude=["*_ADMIN_*"],
+                                    bundle_location=EXAMPLE_LOCATION)
+        self.assertEqual(expected, parse_export_cli_arguments(arguments))
+
+    def test_parse_without_bundle_argument(self):
+        self.assertRaises(SystemExit, parse_export_cli_arguments, [_PROJECT_PARAMETER_FLAG, EXAMPLE_PROJECT])
+
+
+class TestExportBundle(unittest.TestCase):
+    """
+    Tests for `export_bundle`.
+    """
+    def setUp(self):
+        self.gitlab = FakeGitLab(EXAMPLE_TOKEN)
+        self.gitlab.set_project_variables(f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}", EXAMPLE_VARIABLES)
+        self.gitlab.start()
+        self._temp_directory = mkdtemp()
+        self.configuration_location = os.path.join(self._temp_directory, "config.yml")
+        with open(self.configuration_location, "w") as file:
+            yaml.dump({GITLAB_PROPERTY: {GITLAB_URL_PROPERTY: self.gitlab.url, GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN,
+                                         GITLAB_NAMESPACE_PROPERTY: EXAMPLE_NAMESPACE}}, file)
+        self.bundle_location = os.path.join(self._temp_directory, "bundle")
+        self._passphrase = os.environ.get(BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE)
+        os.environ[BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE] = "passphrase"
+
+    def tearDown(self):
+        self.gitlab.stop()
+        shutil.rmtree(self._temp_directory)
+        os.environ.pop(BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE)
+        if self._passphrase is not None:
+            os.environ[BUNDLE_PASSPHRASE_ENVIRONMENT_VARIABLE] = self._passphrase
+
+    def test_export(self):
+        key = list(EXAMPLE_VARIABLES.keys())[0]
+        cli_configuration = CliConfiguration(config_location=self.configuration_location, projects=[EXAMPLE_PROJECT],
+                                             exclude=[key], bundle_location=self.bundle_location)
+        source = f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}"
+        self.assertEqual([source], export_bundle(cli_configuration))
+
+        bundle = Bundle(self.bundle_location, "passphrase")
+        self.assertEqual((self.gitlab.url, EXAMPLE_NAMESPACE, [source]),
+                         (bundle.url, bundle.namespace, bundle.sources))
+        self.assertEqual({k: v for k, v in EXAMPLE_VARIABLES.items() if k != key}, bundle.get_variables(source))
+
 
 class TestIsInteractive(unittest.TestCase):
     """
@@ -68,6 +216,115 @@ class TestIsInteractive(unittest.TestCase):
     def test_with_interactive_flag_and_stdin_attach_reversed(self):
         self.assertTrue(is_interactive(["run", "-ti", "ubuntu"]))
 
+    def test_exec_with_interactive_flag(self):
+        self.assertTrue(is_interactive(["exec", "-it", "container", "sh"]))
+
+    def test_compose_run(self):
+        self.assertTrue(is_interactive(["compose", "run", "service"]))
+
+    def test_compose_run_without_tty(self):
+        self.assertFalse(is_interactive(["compose", "run", "-T", "service"]))
+
+    def test_compose_up(self):
+        self.assertFalse(is_interactive(["compose", "up"]))
+
+
+class TestRunWithoutVariables(unittest.TestCase):
+    """
+    Tests for `run` with Docker commands that do not use variables.
+    """
+    def test_does_not_require_configuration(self):
+        cli_configuration = CliConfiguration(docker_args=["version"], config_location=f"{EXAMPLE_LOCATION}/missing")
+        return_code, stdout, stderr = run(cli_configuration)
+        self.assertEqual(0, return_code)
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Tests for `read_batch`, `write_batch_report` and `get_batch_exit_code`.
+    """
+    def setUp(self):
+        _, self.location = mkstemp()
+
+    def tearDown(self):
+        os.remove(self.location)
+
+    def test_read_batch(self):
+        with open(self.location, "w") as file:
+            file.write(f"{json.dumps(['run', 'alpine', 'true'])}\n\n{json.dumps(['version'])}\n")
+        self.assertEqual([["run", "alpine", "true"], ["version"]], read_batch(self.location))
+
+    def test_read_invalid_batch(self):
+        with open(self.location, "w") as file:
+            file.write(f"{json.dumps({'run': 'alpine'})}\n")
+        self.assertRaises(ValueError, read_batch, self.location)
+
+    def test_write_batch_report(self):
+        results = [BatchResult(1, ["version"], (0, None, None), 0.1), BatchResult(0, ["ps"], (2, None, None), 0.2)]
+        write_batch_report(results, self.location)
+        with open(self.location, "r") as file:
+            report = [json.loads(line) for line in file.readlines()]
+        self.assertEqual([(1, 0), (0, 2)], [(line[BATCH_INDEX_PROPERTY], line[BATCH_EXIT_CODE_PROPERTY])
+                                            for line in report])
+
+    def test_get_batch_exit_code(self):
+        results = [BatchResult(2, [], (3, None, None), 0), BatchResult(0, [], (0, None, None), 0),
+                   BatchResult(1, [], (1, None, None), 0)]
+        self.assertEqual(1, get_batch_exit_code(results))
+
+    def test_get_batch_exit_code_when_all_succeed(self):
+        self.assertEqual(0, get_batch_exit_code([BatchResult(0, [], (0, None, None), 0)]))
+
+    def test_run_batch_file_without_variables(self):
+        with open(self.location, "w") as file:
+            file.write(f"{json.dumps(['version'])}\n{json.dumps(['version'])}\n")
+        cli_configuration = CliConfiguration(batch_location=self.location,
+                                             config_location=f"{EXAMPLE_LOCATION}/missing")
+        results = run_batch_file(cli_configuration)
+        self.assertEqual([0, 0], [result.output[0] for result in results])
+
+
+class TestMain(unittest.TestCase):
+    """
+    Tests for `main`.
+    """
+    def setUp(self):
+        # No variables are set for the project, so fetching them fails
+        self.gitlab = FakeGitLab(EXAMPLE_TOKEN)
+        self.gitlab.start()
+        self._temp_directory = mkdtemp()
+        self.configuration_location = os.path.join(self._temp_directory, "config.yml")
+        with open(self.configuration_location, "w") as file:
+            yaml.dump({GITLAB_PROPERTY: {GITLAB_URL_PROPERTY: self.gitlab.url, GITLAB_TOKEN_PROPERTY: EXAMPLE_TOKEN,
+                                         GITLAB_NAMESPACE_PROPERTY: EXAMPLE_NAMESPACE}}, file)
+        self.metrics_location = os.path.join(self._temp_directory, "dwgs.prom")
+        self._argv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self._argv
+        self.gitlab.stop()
+        shutil.rmtree(self._temp_directory)
+
+    def test_metrics_written_when_fetch_fails(self):
+        self._main_fails(["run", "alpine", "true"])
+        self._main_fails([_BATCH_PARAMETER_FLAG, self._write_batch([["run", "alpine", "true"]])])
+        with open(self.metrics_location, "r") as file:
+            self.assertIn(f"dwgs_runs_total{{exit_code=\"{ERROR_EXIT_CODE}\","
+                          f"project=\"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}\"}} 2\n", file.read())
+
+    def _main_fails(self, arguments: List[str]):
+        sys.argv = ["docker-with-gitlab-secrets", _CONFIG_PARAMETER_FLAG, self.configuration_location,
+                    _PROJECT_PARAMETER_FLAG, EXAMPLE_PROJECT, _METRICS_PARAMETER_FLAG, self.metrics_location,
+                    *arguments]
+        self.assertRaises(GitLabRequestError, main)
+
+    def _write_batch(self, docker_argument_lists: List[List[str]]) -> str:
+        location = os.path.join(self._temp_directory, "batch.jsonl")
+        with open(location, "w") as file:
+            for docker_arguments in docker_argument_lists:
+                file.write(f"{json.dumps(docker_arguments)}\n")
+        return location
+
 
 class TestRun(unittest.TestCase):
     """
@@ -131,6 +388,14 @@ class TestRun(unittest.TestCase):
         self.assertEqual(0, return_code)
         self.assertIn(value, stdout.strip())
 
+    def test_run_with_excluded_variable(self):
+        key = list(EXAMPLE_VARIABLES.keys())[0]
+        cli_configuration = CliConfiguration(docker_args=["run", "--rm", "alpine", "printenv", key],
+                                             config_location=self.configuration_location, exclude=[key])
+        return_code, stdout, stderr = run(cli_configuration)
+        self.assertNotEqual(0, return_code)
+        self.assertEqual("", stdout.strip())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,124 @@
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import unittest
+from io import BytesIO
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.envfile import env_file, write_env_file, is_env_file_backend_available, \
+    shared_env_file, ENV_FILE_BACKEND_MEMFD, ENV_FILE_BACKEND_TMPFS, ENV_FILE_BACKEND_FILE, ENV_FILE_BACKEND_SHARED, \
+    SAFE_LINE_BREAK
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_VARIABLES
+
+_EXPECTED_ENV_FILE = "".join(f"{key}={value.replace(chr(10), SAFE_LINE_BREAK)}\n"
+                             for key, value in EXAMPLE_VARIABLES.items())
+
+
+class TestWriteEnvFile(unittest.TestCase):
+    """
+    Tests for `write_env_file`.
+    """
+    def test_write(self):
+        file = BytesIO()
+        write_env_file(file, EXAMPLE_VARIABLES)
+        self.assertEqual(_EXPECTED_ENV_FILE, file.getvalue().decode())
+
+
+class TestEnvFile(unittest.TestCase):
+    """
+    Tests for `env_file`.
+    """
+    @unittest.skipUnless(is_env_file_backend_available(ENV_FILE_BACKEND_MEMFD), "memfd not available")
+    def test_memfd(self):
+        with env_file(EXAMPLE_VARIABLES, ENV_FILE_BACKEND_MEMFD) as docker_env_file:
+            self.assertIsNotNone(docker_env_file.file_descriptor)
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+
+    @unittest.skipUnless(is_env_file_backend_available(ENV_FILE_BACKEND_TMPFS), "tmpfs not available")
+    def test_tmpfs(self):
+        with env_file(EXAMPLE_VARIABLES, ENV_FILE_BACKEND_TMPFS) as docker_env_file:
+            self.assertIsNone(docker_env_file.file_descriptor)
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(docker_env_file.location).st_mode))
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+        self.assertFalse(os.path.exists(docker_env_file.location))
+
+    def test_file(self):
+        with env_file(EXAMPLE_VARIABLES, ENV_FILE_BACKEND_FILE) as docker_env_file:
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+        self.assertFalse(os.path.exists(docker_env_file.location))
+
+    def test_anonymous_file(self):
+        with env_file(EXAMPLE_VARIABLES, ENV_FILE_BACKEND_FILE, anonymous=True) as docker_env_file:
+            self.assertIsNotNone(docker_env_file.file_descriptor)
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            with env_file(EXAMPLE_VARIABLES, "unknown"):
+                pass
+
+    def test_shared_not_anonymous(self):
+        with env_file(EXAMPLE_VARIABLES, ENV_FILE_BACKEND_SHARED, anonymous=True) as docker_env_file:
+            self.assertFalse(docker_env_file.reused)
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+
+class TestSharedEnvFile(unittest.TestCase):
+    """
+    Tests for `shared_env_file`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.directory = os.path.join(self._temp_directory, "env-files")
+        os.makedirs(self.directory, mode=0o700)
+        self.rotated_variables = {key: f"{value}-rotated" for key, value in EXAMPLE_VARIABLES.items()}
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_directory)
+
+    def test_reused(self):
+        with shared_env_file(EXAMPLE_VARIABLES, self.directory) as docker_env_file:
+            self.assertFalse(docker_env_file.reused)
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(docker_env_file.location).st_mode))
+            self.assertEqual(_EXPECTED_ENV_FILE, _read_in_child(docker_env_file))
+        with shared_env_file(dict(reversed(EXAMPLE_VARIABLES.items())), self.directory) as reused_env_file:
+            self.assertTrue(reused_env_file.reused)
+            self.assertEqual(docker_env_file, reused_env_file._replace(reused=False))
+        self.assertEqual([os.path.basename(docker_env_file.location)], os.listdir(self.directory))
+
+    def test_removed_when_rotated(self):
+        with shared_env_file(EXAMPLE_VARIABLES, self.directory):
+            pass
+        with shared_env_file(self.rotated_variables, self.directory) as docker_env_file:
+            pass
+        self.assertEqual([os.path.basename(docker_env_file.location)], os.listdir(self.directory))
+
+    def test_not_removed_when_in_use(self):
+        with shared_env_file(EXAMPLE_VARIABLES, self.directory) as docker_env_file:
+            with shared_env_file(self.rotated_variables, self.directory):
+                pass
+            self.assertTrue(os.path.exists(docker_env_file.location))
+        self.assertFalse(os.path.exists(docker_env_file.location))
+
+    def test_different_keys_kept(self):
+        with shared_env_file(EXAMPLE_VARIABLES, self.directory):
+            pass
+        with shared_env_file({"OTHER": "value"}, self.directory):
+            pass
+        self.assertEqual(2, len(os.listdir(self.directory)))
+
+    def test_removed_after_ttl(self):
+        with shared_env_file(EXAMPLE_VARIABLES, self.directory, ttl=0) as docker_env_file:
+            self.assertTrue(os.path.exists(docker_env_file.location))
+        self.assertEqual([], os.listdir(self.directory))
+
+
+def _read_in_child(docker_env_file) -> str:
+    return subprocess.check_output(
+        [sys.executable, "-c", f"print(open('{docker_env_file.location}').read(), end='')"],
+        pass_fds=docker_env_file.get_inherited_file_descriptors()).decode()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+
+from dockerwithgitlabsecrets.metrics import Metrics, get_run_metrics, write_metrics, RUNS_METRIC, \
+    DOCKER_SECONDS_METRIC, GITLAB_REQUESTS_METRIC, GITLAB_REQUEST_SECONDS_METRIC, SOURCES_METRIC, \
+    VARIABLES_INJECTED_METRIC, CONFIGURATION_SECONDS_METRIC, PROJECT_PROPERTY, EXIT_CODE_PROPERTY, \
+    GITLAB_RESPONSES_PROPERTY, GITLAB_REQUEST_DURATIONS_PROPERTY, SOURCES_PROPERTY, VARIABLE_COUNT_PROPERTY, \
+    REPLACED_EXIT_CODE
+from dockerwithgitlabsecrets.profiling import Profiler, PHASES_PROPERTY, CONFIGURATION_PHASE, DOCKER_PHASE
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_PROJECT
+
+_LABELS = {"project": EXAMPLE_PROJECT}
+_TRACE = {
+    PROJECT_PROPERTY: EXAMPLE_PROJECT,
+    PHASES_PROPERTY: {CONFIGURATION_PHASE: 0.02, DOCKER_PHASE: 2.0},
+    SOURCES_PROPERTY: {EXAMPLE_PROJECT: "fetched"},
+    GITLAB_RESPONSES_PROPERTY: {"200": 2, "503": 1},
+    GITLAB_REQUEST_DURATIONS_PROPERTY: [0.1, 0.2, 0.3],
+    VARIABLE_COUNT_PROPERTY: 3,
+    EXIT_CODE_PROPERTY: 0
+}
+_WRITES = 20
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for `Metrics`.
+    """
+    def test_counter(self):
+        metrics = Metrics()
+        metrics.increment(RUNS_METRIC, {**_LABELS, "exit_code": "0"})
+        metrics.increment(RUNS_METRIC, {**_LABELS, "exit_code": "0"}, 2)
+        self.assertIn(f"dwgs_runs_total{{exit_code=\"0\",project=\"{EXAMPLE_PROJECT}\"}} 3\n", metrics.to_text())
+
+    def test_histogram(self):
+        metrics = Metrics()
+        for value in (0.5, 5.0, 5000.0):
+            metrics.observe(DOCKER_SECONDS_METRIC, _LABELS, value)
+        text = metrics.to_text()
+        self.assertIn("# TYPE dwgs_docker_seconds histogram\n", text)
+        self.assertIn(f"dwgs_docker_seconds_bucket{{project=\"{EXAMPLE_PROJECT}\",le=\"0.5\"}} 1\n", text)
+        self.assertIn(f"dwgs_docker_seconds_bucket{{project=\"{EXAMPLE_PROJECT}\",le=\"5.0\"}} 2\n", text)
+        self.assertIn(f"dwgs_docker_seconds_bucket{{project=\"{EXAMPLE_PROJECT}\",le=\"+Inf\"}} 3\n", text)
+        self.assertIn(f"dwgs_docker_seconds_sum{{project=\"{EXAMPLE_PROJECT}\"}} 5005.5\n", text)
+        self.assertIn(f"dwgs_docker_seconds_count{{project=\"{EXAMPLE_PROJECT}\"}} 3\n", text)
+
+    def test_escapes_labels(self):
+        metrics = Metrics()
+        metrics.increment(RUNS_METRIC, {"project": "a\"b\\c\nd"})
+        self.assertIn("dwgs_runs_total{project=\"a\\\"b\\\\c\\nd\"} 1\n", metrics.to_text())
+
+    def test_merge(self):
+        metrics = Metrics()
+        metrics.increment(RUNS_METRIC, _LABELS)
+        metrics.observe(DOCKER_SECONDS_METRIC, _LABELS, 1.0)
+        other = Metrics.from_json(json.loads(json.dumps(metrics.to_json())))
+        other.observe(DOCKER_SECONDS_METRIC, {"project": "other"}, 1.0)
+        metrics.merge(other)
+        text = metrics.to_text()
+        self.assertIn(f"dwgs_runs_total{{project=\"{EXAMPLE_PROJECT}\"}} 2\n", text)
+        self.assertIn(f"dwgs_docker_seconds_count{{project=\"{EXAMPLE_PROJECT}\"}} 2\n", text)
+        self.assertIn("dwgs_docker_seconds_count{project=\"other\"} 1\n", text)
+
+    def test_empty(self):
+        self.assertEqual("", Metrics().to_text())
+
+
+class TestGetRunMetrics(unittest.TestCase):
+    """
+    Tests for `get_run_metrics`.
+    """
+    def test_get_run_metrics(self):
+        metrics = get_run_metrics(_TRACE)
+        self.assertEqual({json.dumps({**_LABELS, "exit_code": "0"}, sort_keys=True): 1}, metrics.counters[RUNS_METRIC])
+        self.assertEqual({json.dumps({**_LABELS, "status": "200"}, sort_keys=True): 2,
+                          json.dumps({**_LABELS, "status": "503"}, sort_keys=True): 1},
+                         metrics.counters[GITLAB_REQUESTS_METRIC])
+        self.assertEqual(1, len(metrics.counters[SOURCES_METRIC]))
+        histograms = {name: list(series.values())[0] for name, series in metrics.histograms.items()}
+        self.assertEqual(3, sum(histograms[GITLAB_REQUEST_SECONDS_METRIC]["counts"]))
+        self.assertEqual(3, histograms[VARIABLES_INJECTED_METRIC]["sum"])
+        self.assertEqual(2.0, histograms[DOCKER_SECONDS_METRIC]["sum"])
+        self.assertIn(CONFIGURATION_SECONDS_METRIC, histograms)
+
+    def test_get_run_metrics_without_variables(self):
+        metrics = get_run_metrics({PHASES_PROPERTY: {DOCKER_PHASE: 1.0}})
+        self.assertEqual({json.dumps({"exit_code": REPLACED_EXIT_CODE, "project": ""}, sort_keys=True): 1},
+                         metrics.counters[RUNS_METRIC])
+        self.assertEqual([DOCKER_SECONDS_METRIC], list(metrics.histograms.keys()))
+
+
+class TestWriteMetrics(unittest.TestCase):
+    """
+    Tests for `write_metrics`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.location = os.path.join(self._temp_directory, "dwgs.prom")
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_directory)
+
+    def test_write_metrics(self):
+        self.assertTrue(write_metrics(self.location, get_run_metrics(_TRACE)))
+        with open(self.location, "r") as file:
+            self.assertEqual(get_run_metrics(_TRACE).to_text(), file.read())
+        self.assertEqual(0o644, os.stat(self.location).st_mode & 0o777)
+
+    def test_merges_concurrent_writes(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertTrue(all(executor.map(lambda _: write_metrics(self.location, get_run_metrics(_TRACE)),
+                                             range(_WRITES))))
+        with open(self.location, "r") as file:
+            self.assertIn(f"dwgs_runs_total{{exit_code=\"0\",project=\"{EXAMPLE_PROJECT}\"}} {_WRITES}\n", file.read())
+        self.assertEqual(["dwgs.prom", "dwgs.prom.json", "dwgs.prom.lock"], sorted(os.listdir(self._temp_directory)))
+
+    def test_ignores_corrupt_totals(self):
+        with open(f"{self.location}.json", "w") as file:
+            file.write("[]")
+        self.assertTrue(write_metrics(self.location, get_run_metrics(_TRACE)))
+        with open(self.location, "r") as file:
+            self.assertEqual(get_run_metrics(_TRACE).to_text(), file.read())
+
+    def test_write_failure_does_not_raise(self):
+        self.assertFalse(write_metrics(os.path.join(self._temp_directory, "missing", "dwgs.prom"), Metrics()))
+
+    def test_written_by_profiler(self):
+        profiler = Profiler(metrics_location=self.location)
+        self.assertTrue(profiler.enabled)
+        profiler.record(EXIT_CODE_PROPERTY, 1)
+        profiler.write()
+        with open(self.location, "r") as file:
+            self.assertIn("dwgs_runs_total{exit_code=\"1\",project=\"\"} 1\n", file.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
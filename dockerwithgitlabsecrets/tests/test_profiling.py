@@ -0,0 +1,62 @@
+import json
+import os
+import time
+import unittest
+from tempfile import mkstemp
+
+from dockerwithgitlabsecrets.profiling import Profiler, NULL_PROFILER, PHASES_PROPERTY, TOTAL_PROPERTY
+
+_PHASE = "phase"
+_PHASE_DURATION = 0.05
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    Tests for `Profiler`.
+    """
+    def setUp(self):
+        _, self.trace_location = mkstemp()
+        self.profiler = Profiler(self.trace_location)
+
+    def tearDown(self):
+        os.remove(self.trace_location)
+
+    def test_phase(self):
+        with self.profiler.phase(_PHASE):
+            time.sleep(_PHASE_DURATION)
+        trace = self.profiler.to_json()
+        self.assertGreaterEqual(trace[PHASES_PROPERTY][_PHASE], _PHASE_DURATION)
+        self.assertGreaterEqual(trace[TOTAL_PROPERTY], trace[PHASES_PROPERTY][_PHASE])
+
+    def test_repeated_phase_summed(self):
+        for _ in range(2):
+            with self.profiler.phase(_PHASE):
+                time.sleep(_PHASE_DURATION)
+        self.assertGreaterEqual(self.profiler.to_json()[PHASES_PROPERTY][_PHASE], 2 * _PHASE_DURATION)
+
+    def test_record(self):
+        self.profiler.record("exit_code", 1)
+        self.profiler.record_item("sources", "a", "hit")
+        self.profiler.record_item("sources", "b", "miss")
+        trace = self.profiler.to_json()
+        self.assertEqual(1, trace["exit_code"])
+        self.assertEqual({"a": "hit", "b": "miss"}, trace["sources"])
+
+    def test_write_appends_lines(self):
+        self.profiler.record("exit_code", 0)
+        self.profiler.write()
+        self.profiler.write()
+        with open(self.trace_location, "r") as file:
+            traces = [json.loads(line) for line in file]
+        self.assertEqual(2, len(traces))
+        self.assertEqual(0, traces[0]["exit_code"])
+
+    def test_disabled(self):
+        with NULL_PROFILER.phase(_PHASE):
+            NULL_PROFILER.record("exit_code", 0)
+        self.assertEqual({}, NULL_PROFILER.to_json()[PHASES_PROPERTY])
+        self.assertNotIn("exit_code", NULL_PROFILER.to_json())
+
+
+if __name__ == "__main__":
+    unittest.main()
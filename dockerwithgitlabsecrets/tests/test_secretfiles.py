@@ -0,0 +1,64 @@
+import os
+import stat
+import unittest
+
+from dockerwithgitlabsecrets.configuration import SecretFilesConfiguration
+from dockerwithgitlabsecrets.secretfiles import select_secret_file_keys, secret_files, replace_with_file_variables, \
+    CONTAINER_SECRETS_DIRECTORY
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_VARIABLES
+
+
+class TestSelectSecretFileKeys(unittest.TestCase):
+    """
+    Tests for `select_secret_file_keys`.
+    """
+    def test_none_selected_by_default(self):
+        self.assertEqual([], select_secret_file_keys(EXAMPLE_VARIABLES, SecretFilesConfiguration()))
+
+    def test_select_by_key_pattern(self):
+        configuration = SecretFilesConfiguration(keys=["EX*", "OTHER"])
+        self.assertEqual(["EXAMPLE", "OTHER"], select_secret_file_keys(EXAMPLE_VARIABLES, configuration))
+
+    def test_select_by_size(self):
+        configuration = SecretFilesConfiguration(size_threshold=len("hello\nworld"))
+        self.assertEqual(["HELLO"], select_secret_file_keys(EXAMPLE_VARIABLES, configuration))
+
+    def test_select_multiline(self):
+        configuration = SecretFilesConfiguration(multiline=True)
+        self.assertEqual(["HELLO"], select_secret_file_keys(EXAMPLE_VARIABLES, configuration))
+
+
+class TestSecretFiles(unittest.TestCase):
+    """
+    Tests for `secret_files` and `replace_with_file_variables`.
+    """
+    def test_without_keys(self):
+        with secret_files(EXAMPLE_VARIABLES, []) as files:
+            self.assertEqual([], files)
+
+    def test_write(self):
+        with secret_files(EXAMPLE_VARIABLES, ["HELLO"]) as files:
+            self.assertEqual(1, len(files))
+            file = files[0]
+            with open(file.location, "r") as opened_file:
+                self.assertEqual(EXAMPLE_VARIABLES["HELLO"], opened_file.read())
+            self.assertEqual(0o444, stat.S_IMODE(os.stat(file.location).st_mode))
+            self.assertEqual(0o700, stat.S_IMODE(os.stat(os.path.dirname(file.location)).st_mode))
+            self.assertEqual(f"{CONTAINER_SECRETS_DIRECTORY}/HELLO", file.container_location)
+        self.assertFalse(os.path.exists(os.path.dirname(file.location)))
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            with secret_files({"../HELLO": "value"}, ["../HELLO"]):
+                pass
+
+    def test_replace_with_file_variables(self):
+        with secret_files(EXAMPLE_VARIABLES, ["HELLO"]) as files:
+            variables = replace_with_file_variables(EXAMPLE_VARIABLES, files)
+        self.assertNotIn("HELLO", variables)
+        self.assertEqual(f"{CONTAINER_SECRETS_DIRECTORY}/HELLO", variables["HELLO_FILE"])
+        self.assertEqual(EXAMPLE_VARIABLES["EXAMPLE"], variables["EXAMPLE"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+
+from typing import Dict
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_SINGLE_FLIGHT_WAIT
+from dockerwithgitlabsecrets.singleflight import SingleFlight
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_URL, EXAMPLE_PROJECT, EXAMPLE_VARIABLES
+
+_TIMEOUT = 10.0
+_RELEASE_DELAY = 0.1
+_SHARE_WINDOW = 0.1
+
+
+class TestSingleFlight(unittest.TestCase):
+    """
+    Tests for `SingleFlight`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self.directory = os.path.join(self._temp_directory, "single-flight")
+        self.fetches = 0
+        self.fetching = threading.Event()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        shutil.rmtree(self._temp_directory)
+
+    def _create_single_flight(self) -> SingleFlight:
+        return SingleFlight(_TIMEOUT, self.directory, share_results=True, share_window=_SHARE_WINDOW)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(0, DEFAULT_SINGLE_FLIGHT_WAIT)
+
+    def test_fetches_alone(self):
+        single_flight = self._create_single_flight()
+        self.assertEqual((EXAMPLE_VARIABLES, False), single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertEqual(1, self.fetches)
+        for name in os.listdir(self.directory):
+            self.assertEqual(0o600, os.stat(os.path.join(self.directory, name)).st_mode & 0o777)
+
+    def test_removes_result_after_share_window(self):
+        self._create_single_flight().get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        self.assertTrue(any(name.endswith(".json") for name in os.listdir(self.directory)))
+        deadline = time.monotonic() + _TIMEOUT
+        while any(name.endswith(".json") for name in os.listdir(self.directory)) and time.monotonic() < deadline:
+            time.sleep(_SHARE_WINDOW)
+        self.assertFalse(any(name.endswith(".json") for name in os.listdir(self.directory)))
+
+    def test_does_not_share_without_runtime_directory(self):
+        single_flight = SingleFlight(_TIMEOUT, self.directory, share_results=False)
+        self.assertEqual((EXAMPLE_VARIABLES, False), single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_does_not_share_earlier_fetch(self):
+        single_flight = self._create_single_flight()
+        single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch)
+        self.assertEqual((EXAMPLE_VARIABLES, False), single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertEqual(2, self.fetches)
+
+    def test_shares_concurrent_fetch(self):
+        single_flight = self._create_single_flight()
+        leader = self._start_slow_fetch(single_flight)
+        # Released after this thread has started to get the variables
+        threading.Timer(_RELEASE_DELAY, self.release.set).start()
+        self.assertEqual((EXAMPLE_VARIABLES, True), single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        leader.join()
+        self.assertEqual(1, self.fetches)
+
+    def test_does_not_share_fetch_of_other_keys(self):
+        single_flight = self._create_single_flight()
+        leader = self._start_slow_fetch(single_flight)
+        # Released after this thread has started to get the variables
+        threading.Timer(_RELEASE_DELAY, self.release.set).start()
+        self.assertEqual((EXAMPLE_VARIABLES, False),
+                         single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch, keys=["EXAMPLE"]))
+        leader.join()
+        self.assertEqual(2, self.fetches)
+
+    def test_fetches_after_wait(self):
+        leader = self._start_slow_fetch(self._create_single_flight())
+        single_flight = SingleFlight(0.1, self.directory, share_results=True)
+        self.assertEqual((EXAMPLE_VARIABLES, False), single_flight.get(EXAMPLE_URL, EXAMPLE_PROJECT, self._fetch))
+        self.assertFalse(self.release.is_set())
+        self.release.set()
+        leader.join()
+        self.assertEqual(2, self.fetches)
+
+    def test_lock(self):
+        single_flight = SingleFlight(0.1, self.directory)
+        with single_flight.lock(EXAMPLE_URL, EXAMPLE_PROJECT) as locked:
+            self.assertTrue(locked)
+            with single_flight.lock(EXAMPLE_URL, EXAMPLE_PROJECT) as locked_again:
+                self.assertFalse(locked_again)
+        with single_flight.lock(EXAMPLE_URL, EXAMPLE_PROJECT) as locked:
+            self.assertTrue(locked)
+
+    def _fetch(self) -> Dict[str, str]:
+        self.fetches += 1
+        return EXAMPLE_VARIABLES
+
+    def _slow_fetch(self) -> Dict[str, str]:
+        self.fetching.set()
+        self.release.wait(_TIMEOUT)
+        return self._fetch()
+
+    def _start_slow_fetch(self, single_flight: SingleFlight) -> threading.Thread:
+        """
+        Starts fetching variables in another thread, which holds the lock until released.
+        :param single_flight: the single flight to fetch the variables through
+        :return: the thread fetching the variables
+        """
+        thread = threading.Thread(target=single_flight.get, args=(EXAMPLE_URL, EXAMPLE_PROJECT, self._slow_fetch))
+        thread.start()
+        self.assertTrue(self.fetching.wait(_TIMEOUT))
+        return thread
+
+
+if __name__ == "__main__":
+    unittest.main()
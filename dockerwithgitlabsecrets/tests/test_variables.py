@@ -0,0 +1,172 @@
+import time
+import unittest
+
+from dockerwithgitlabsecrets.configuration import GitLabConfiguration
+from dockerwithgitlabsecrets.tests._common import EXAMPLE_PROJECT, EXAMPLE_NAMESPACE, EXAMPLE_TOKEN, EXAMPLE_VARIABLES
+from dockerwithgitlabsecrets.testsupport.fakegitlab import FakeGitLab
+from dockerwithgitlabsecrets.variables import parse_sources, namespace_source, get_merged_variables, \
+    GROUP_SOURCE_PREFIX, fetch_variables, diff_variables, VariablesDiff, scope_source, split_source_scope, \
+    filter_variables, get_keys_to_fetch, parse_key_patterns, MAX_KEYS_FETCHED_INDIVIDUALLY, find_client, get_client
+
+_FETCH_DURATION = 0.5
+
+
+class TestParseSources(unittest.TestCase):
+    """
+    Tests for `parse_sources`.
+    """
+    def test_parse_none(self):
+        self.assertEqual([], parse_sources([]))
+
+    def test_parse_separated(self):
+        self.assertEqual(["a", "b", "c"], parse_sources(["a", "b, c,"]))
+
+
+class TestNamespaceSource(unittest.TestCase):
+    """
+    Tests for `namespace_source`.
+    """
+    def test_project(self):
+        self.assertEqual(f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}", namespace_source(EXAMPLE_PROJECT, EXAMPLE_NAMESPACE))
+
+    def test_namespaced_project(self):
+        project = f"other/{EXAMPLE_PROJECT}"
+        self.assertEqual(project, namespace_source(project, EXAMPLE_NAMESPACE))
+
+    def test_group(self):
+        group = f"{GROUP_SOURCE_PREFIX}{EXAMPLE_NAMESPACE}"
+        self.assertEqual(group, namespace_source(group, EXAMPLE_NAMESPACE))
+
+    def test_scoped_project(self):
+        self.assertEqual(f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}@review/feature",
+                         namespace_source(f"{EXAMPLE_PROJECT}@review/feature", EXAMPLE_NAMESPACE))
+
+
+class TestScopeSource(unittest.TestCase):
+    """
+    Tests for `scope_source` and `split_source_scope`.
+    """
+    def test_unscoped(self):
+        self.assertEqual(EXAMPLE_PROJECT, scope_source(EXAMPLE_PROJECT, None))
+        self.assertEqual((EXAMPLE_PROJECT, None), split_source_scope(EXAMPLE_PROJECT))
+
+    def test_scoped(self):
+        source = scope_source(EXAMPLE_PROJECT, "production")
+        self.assertEqual((EXAMPLE_PROJECT, "production"), split_source_scope(source))
+
+    def test_already_scoped(self):
+        source = scope_source(EXAMPLE_PROJECT, "staging")
+        self.assertEqual(source, scope_source(source, "production"))
+
+
+class TestFilterVariables(unittest.TestCase):
+    """
+    Tests for `filter_variables` and `get_keys_to_fetch`.
+    """
+    _VARIABLES = {"APP_TOKEN": "1", "APP_PASSWORD": "2", "DATABASE_PASSWORD": "3"}
+
+    def test_parse_key_patterns(self):
+        self.assertEqual(["APP_*", "OTHER"], parse_key_patterns(["APP_*,", "OTHER"]))
+
+    def test_filter_none(self):
+        self.assertEqual(self._VARIABLES, filter_variables(self._VARIABLES, [], []))
+
+    def test_filter_include(self):
+        self.assertEqual({"APP_TOKEN": "1", "APP_PASSWORD": "2"}, filter_variables(self._VARIABLES, ["APP_*"], []))
+
+    def test_filter_exclude_takes_precedence(self):
+        self.assertEqual({"APP_TOKEN": "1"}, filter_variables(self._VARIABLES, ["APP_*"], ["*_PASSWORD"]))
+
+    def test_get_keys_to_fetch(self):
+        self.assertEqual(["APP_TOKEN"], get_keys_to_fetch(["APP_TOKEN", "APP_PASSWORD"], ["*_PASSWORD"]))
+
+    def test_get_keys_to_fetch_when_patterns(self):
+        self.assertIsNone(get_keys_to_fetch([], []))
+        self.assertIsNone(get_keys_to_fetch(["APP_TOKEN", "DATABASE_*"], []))
+        self.assertIsNone(get_keys_to_fetch([f"KEY_{i}" for i in range(MAX_KEYS_FETCHED_INDIVIDUALLY + 1)], []))
+
+
+class TestFetchVariables(unittest.TestCase):
+    """
+    Tests for `fetch_variables`.
+    """
+    def setUp(self):
+        self.gitlab = FakeGitLab(EXAMPLE_TOKEN)
+        self.gitlab.start()
+        self.gitlab_configuration = GitLabConfiguration(url=self.gitlab.url, token=EXAMPLE_TOKEN)
+
+    def tearDown(self):
+        self.gitlab.stop()
+
+    def test_fetch_project_variables(self):
+        project = f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}"
+        self.gitlab.set_project_variables(project, EXAMPLE_VARIABLES)
+        self.assertEqual(EXAMPLE_VARIABLES, fetch_variables(self.gitlab_configuration, project))
+
+    def test_fetch_group_variables(self):
+        self.gitlab.set_group_variables(EXAMPLE_NAMESPACE, EXAMPLE_VARIABLES)
+        self.assertEqual(EXAMPLE_VARIABLES,
+                         fetch_variables(self.gitlab_configuration, f"{GROUP_SOURCE_PREFIX}{EXAMPLE_NAMESPACE}"))
+
+    def test_find_client_only_once_created(self):
+        project = f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}"
+        self.gitlab.set_project_variables(project, EXAMPLE_VARIABLES)
+        self.assertIsNone(find_client(self.gitlab_configuration))
+        fetch_variables(self.gitlab_configuration, project)
+        self.assertIs(get_client(self.gitlab_configuration), find_client(self.gitlab_configuration))
+
+    def test_fetch_scoped_variables_by_key(self):
+        project = f"{EXAMPLE_NAMESPACE}/{EXAMPLE_PROJECT}"
+        self.gitlab.set_project_variables(project, EXAMPLE_VARIABLES)
+        self.gitlab.add_project_variables(project, {"SCOPED": "production"}, "production")
+        self.gitlab.add_project_variables(project, {"SCOPED": "staging"}, "staging")
+        source = scope_source(project, "production")
+        self.assertEqual({"SCOPED": "production"}, fetch_variables(self.gitlab_configuration, source, ["SCOPED"]))
+        self.assertEqual(dict(EXAMPLE_VARIABLES, SCOPED="production"),
+                         fetch_variables(self.gitlab_configuration, source))
+
+
+class TestDiffVariables(unittest.TestCase):
+    """
+    Tests for `diff_variables`.
+    """
+    def test_unchanged(self):
+        diff = diff_variables(EXAMPLE_VARIABLES, dict(EXAMPLE_VARIABLES))
+        self.assertTrue(diff.is_empty())
+
+    def test_changed(self):
+        previous = {"KEPT": "1", "ROTATED": "old", "REMOVED": "1"}
+        current = {"KEPT": "1", "ROTATED": "new", "ADDED": "1"}
+        self.assertEqual(VariablesDiff(added=["ADDED"], changed=["ROTATED"], removed=["REMOVED"]),
+                         diff_variables(previous, current))
+
+
+class TestGetMergedVariables(unittest.TestCase):
+    """
+    Tests for `get_merged_variables`.
+    """
+    SOURCE_VARIABLES = {
+        "group": {"A": "group", "B": "group"},
+        "service": {"B": "service", "C": "service"},
+        "environment": {"C": "environment"}
+    }
+
+    def test_single_source(self):
+        self.assertEqual(self.SOURCE_VARIABLES["group"], get_merged_variables(["group"], self._get))
+
+    def test_later_sources_take_precedence(self):
+        self.assertEqual({"A": "group", "B": "service", "C": "environment"},
+                         get_merged_variables(["group", "service", "environment"], self._get))
+
+    def test_sources_got_concurrently(self):
+        started_at = time.monotonic()
+        get_merged_variables(list(self.SOURCE_VARIABLES.keys()), self._get)
+        self.assertLess(time.monotonic() - started_at, _FETCH_DURATION * len(self.SOURCE_VARIABLES))
+
+    def _get(self, source: str):
+        time.sleep(_FETCH_DURATION)
+        return self.SOURCE_VARIABLES[source]
+
+
+if __name__ == "__main__":
+    unittest.main()
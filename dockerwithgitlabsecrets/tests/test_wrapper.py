@@ -1,8 +1,23 @@
+import os
+import signal
+import subprocess
+import sys
 import unittest
+from contextlib import ExitStack
+from io import BytesIO
 from tempfile import NamedTemporaryFile
+from threading import Timer
 
+from dockerwithgitlabsecrets.engine import DOCKER_BACKEND_ENGINE, DOCKER_HOST_ENVIRONMENT_VARIABLE, STDOUT_STREAM, \
+    STDERR_STREAM, get_engine_client
 from dockerwithgitlabsecrets.tests._common import EXAMPLE_VALUE, EXAMPLE_PARAMETER, EXAMPLE_VARIABLES
-from dockerwithgitlabsecrets.wrapper import run_wrapped, SAFE_LINE_BREAK
+from dockerwithgitlabsecrets.secretfiles import FILE_VARIABLE_SUFFIX
+from dockerwithgitlabsecrets.tests._fake_docker_engine import FakeDockerEngine, NOT_FOUND_COMMAND
+from dockerwithgitlabsecrets.wrapper import run_wrapped, SAFE_LINE_BREAK, OutputTail, _forward_output, \
+    get_supported_action_index, create_docker_call, create_docker_environment, uses_env_file, \
+    _run_interactive, prepare_secret_files, prepare_docker_call
+
+_LARGE_OUTPUT_SIZE = 1024 * 1024
 
 
 class TestWrapper(unittest.TestCase):
@@ -19,6 +34,18 @@ class TestWrapper(unittest.TestCase):
         self.assertEqual(0, return_code)
         self.assertIn("Version", stdout.strip())
 
+    def test_with_non_supported_action_does_not_get_variables(self):
+        def get_variables():
+            raise AssertionError("Variables should not be got for an action that does not use them")
+        return_code, stdout, stderr = run_wrapped(["version"], get_variables)
+        self.assertEqual(0, return_code)
+
+    def test_run_gets_variables(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        return_code, stdout, stderr = run_wrapped(["run", "--rm", "alpine", "printenv", key], lambda: EXAMPLE_VARIABLES)
+        self.assertEqual(0, return_code)
+        self.assertEqual(value, stdout.strip())
+
     def test_has_standard_variable(self):
         return_code, stdout, stderr = run_wrapped(
             ["run", "-e", f"{EXAMPLE_PARAMETER}={EXAMPLE_VALUE}", "--rm", "alpine", "printenv", EXAMPLE_PARAMETER],
@@ -66,12 +93,280 @@ class TestWrapper(unittest.TestCase):
             self.assertEqual(0, return_code)
             self.assertEqual(value_2, stdout.strip())
 
+    def test_run_streamed_with_tail(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        return_code, stdout, stderr = run_wrapped(["run", "--rm", "alpine", "printenv", key], EXAMPLE_VARIABLES,
+                                                  stream=True, tail_size=1024)
+        self.assertEqual(0, return_code)
+        self.assertEqual(value, stdout.strip())
+
+    def test_run_streamed_without_tail(self):
+        return_code, stdout, stderr = run_wrapped(["run", "--rm", "alpine", "true"], EXAMPLE_VARIABLES, stream=True)
+        self.assertEqual((0, None, None), (return_code, stdout, stderr))
+
     def test_run_in_interactive_mode(self):
         key, value = list(EXAMPLE_VARIABLES.items())[0]
         return_code, stdout, stderr = run_wrapped(["run", "--rm", "-t", "alpine", "printenv", key], EXAMPLE_VARIABLES,
                                                   interactive=True)
         self.assertEqual(0, return_code)
 
+    def test_run_in_interactive_mode_with_shell_metacharacters(self):
+        return_code, stdout, stderr = run_wrapped(["run", "--rm", "-t", "alpine", "sh", "-c", "exit 3; echo $HOME"],
+                                                  EXAMPLE_VARIABLES, interactive=True)
+        self.assertEqual(3, return_code)
+
+    def test_create_gets_variables(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        return_code, container_id, stderr = run_wrapped(["create", "alpine"], EXAMPLE_VARIABLES)
+        self.assertEqual(0, return_code)
+        try:
+            return_code, stdout, stderr = run_wrapped(
+                ["inspect", "--format", "{{json .Config.Env}}", container_id.strip()], EXAMPLE_VARIABLES)
+            self.assertIn(f"{key}={value}", stdout)
+        finally:
+            subprocess.run(["docker", "rm", container_id.strip()], stdout=subprocess.DEVNULL)
+
+    def test_exec_gets_variables(self):
+        key, value = list(EXAMPLE_VARIABLES.items())[0]
+        container_id = subprocess.check_output(
+            ["docker", "run", "-d", "--rm", "alpine", "sleep", "60"]).decode().strip()
+        try:
+            return_code, stdout, stderr = run_wrapped(["exec", container_id, "printenv", key], EXAMPLE_VARIABLES)
+            self.assertEqual(0, return_code)
+            self.assertEqual(value, stdout.strip())
+        finally:
+            subprocess.run(["docker", "rm", "-f", container_id], stdout=subprocess.DEVNULL)
+
+    def test_run_with_secret_file(self):
+        return_code, stdout, stderr = run_wrapped(
+            ["run", "--rm", "alpine", "sh", "-c", "cat $HELLO_FILE; printenv HELLO"], EXAMPLE_VARIABLES,
+            secret_file_keys=["HELLO"])
+        self.assertEqual(1, return_code)
+        self.assertEqual(EXAMPLE_VARIABLES["HELLO"], stdout)
+
+
+class TestRunWrappedWithEngine(unittest.TestCase):
+    """
+    Tests for `run_wrapped` with the Docker Engine API backend.
+    """
+    def setUp(self):
+        self.engine = FakeDockerEngine(output=[(STDOUT_STREAM, b"out"), (STDERR_STREAM, b"err")], exit_code=3)
+        self.engine.start()
+        self._docker_host = os.environ.get(DOCKER_HOST_ENVIRONMENT_VARIABLE)
+        os.environ[DOCKER_HOST_ENVIRONMENT_VARIABLE] = f"unix://{self.engine.socket_location}"
+
+    def tearDown(self):
+        get_engine_client(self.engine.socket_location).close()
+        self.engine.stop()
+        if self._docker_host is not None:
+            os.environ[DOCKER_HOST_ENVIRONMENT_VARIABLE] = self._docker_host
+        else:
+            del os.environ[DOCKER_HOST_ENVIRONMENT_VARIABLE]
+
+    def test_run(self):
+        output = run_wrapped(["run", "--rm", "alpine", "printenv"], EXAMPLE_VARIABLES,
+                             docker_backend=DOCKER_BACKEND_ENGINE)
+        self.assertEqual((3, "out", "err"), output)
+        self.assertEqual(1, len(self.engine.removed))
+
+    def test_run_sets_variables_in_container_configuration(self):
+        run_wrapped(["run", "alpine"], EXAMPLE_VARIABLES, docker_backend=DOCKER_BACKEND_ENGINE)
+        container = list(self.engine.containers.values())[0]
+        self.assertEqual([f"{key}={value}" for key, value in EXAMPLE_VARIABLES.items()], container.configuration["Env"])
+        self.assertEqual([], self.engine.removed)
+
+    def test_run_streamed_with_tail(self):
+        output = run_wrapped(["run", "--rm", "alpine"], EXAMPLE_VARIABLES, stream=True, tail_size=2,
+                             docker_backend=DOCKER_BACKEND_ENGINE)
+        self.assertEqual((3, "ut", "rr"), output)
+
+    def test_run_streamed_without_tail(self):
+        output = run_wrapped(["run", "--rm", "alpine"], EXAMPLE_VARIABLES, stream=True,
+                             docker_backend=DOCKER_BACKEND_ENGINE)
+        self.assertEqual((3, None, None), output)
+
+    def test_run_command_not_found(self):
+        return_code, stdout, stderr = run_wrapped(["run", "--rm", "alpine", NOT_FOUND_COMMAND], EXAMPLE_VARIABLES,
+                                                  docker_backend=DOCKER_BACKEND_ENGINE)
+        self.assertEqual(127, return_code)
+        self.assertIn("executable file not found", stderr)
+        self.assertEqual(1, len(self.engine.removed))
+
+    def test_run_with_secret_file(self):
+        run_wrapped(["run", "alpine"], EXAMPLE_VARIABLES, secret_file_keys=["HELLO"],
+                    docker_backend=DOCKER_BACKEND_ENGINE)
+        container = list(self.engine.containers.values())[0]
+        self.assertIn("HELLO_FILE=/run/secrets/HELLO", container.configuration["Env"])
+        self.assertEqual("/run/secrets/HELLO", container.configuration["HostConfig"]["Mounts"][0]["Target"])
+
+
+class TestCreateDockerCall(unittest.TestCase):
+    """
+    Tests for `get_supported_action_index`, `uses_env_file`, `create_docker_call` and `create_docker_environment`.
+    """
+    def test_supported_action_index(self):
+        self.assertEqual(1, get_supported_action_index(["--debug", "run", "alpine"]))
+        self.assertEqual(1, get_supported_action_index(["container", "create", "alpine"]))
+        self.assertEqual(0, get_supported_action_index(["compose", "-f", "compose.yml", "up"]))
+        self.assertIsNone(get_supported_action_index(["compose", "ps"]))
+        self.assertIsNone(get_supported_action_index(["version"]))
+        self.assertIsNone(get_supported_action_index([]))
+
+    def test_supported_action_index_after_global_options(self):
+        self.assertEqual(2, get_supported_action_index(["-H", "unix:///run.sock", "exec", "container", "env"]))
+        self.assertEqual(2, get_supported_action_index(["--context", "build", "run", "alpine"]))
+        self.assertEqual(3, get_supported_action_index(["--host=tcp://run:2375", "--tls", "image", "build", "."]))
+        self.assertEqual(0, get_supported_action_index(["compose", "-p", "run", "up"]))
+        self.assertIsNone(get_supported_action_index(["compose", "-p", "up", "ps"]))
+
+    def test_supported_action_must_be_command(self):
+        self.assertIsNone(get_supported_action_index(["network", "create", "mynet"]))
+        self.assertIsNone(get_supported_action_index(["volume", "create", "myvolume"]))
+        self.assertIsNone(get_supported_action_index(["rm", "-f", "exec"]))
+        self.assertIsNone(get_supported_action_index(["logs", "build"]))
+        self.assertIsNone(get_supported_action_index(["buildx", "create"]))
+        self.assertIsNone(get_supported_action_index(["container", "ls"]))
+        self.assertIsNone(get_supported_action_index(["image", "run"]))
+
+    def test_uses_env_file(self):
+        self.assertTrue(uses_env_file(["exec", "container", "printenv"]))
+        self.assertFalse(uses_env_file(["build", "."]))
+        self.assertFalse(uses_env_file(["compose", "up"]))
+        self.assertFalse(uses_env_file(["version"]))
+
+    def test_run_call(self):
+        self.assertEqual(["docker", "run", "--env-file", EXAMPLE_PARAMETER, "alpine"],
+                         create_docker_call(["run", "alpine"], EXAMPLE_PARAMETER, EXAMPLE_VARIABLES.keys()))
+
+    def test_build_call(self):
+        self.assertEqual(["docker", "build", "--secret", "id=A,env=A", "--secret", "id=B,env=B", "."],
+                         create_docker_call(["build", "."], None, ["A", "B"]))
+
+    def test_compose_run_call(self):
+        self.assertEqual(["docker", "compose", "-f", "compose.yml", "run", "-e", "A", "service"],
+                         create_docker_call(["compose", "-f", "compose.yml", "run", "service"], None, ["A"]))
+
+    def test_compose_up_call(self):
+        self.assertEqual(["docker", "compose", "up", "-d"], create_docker_call(["compose", "up", "-d"], None, ["A"]))
+
+    def test_management_command_call(self):
+        self.assertEqual(["docker", "container", "run", "--env-file", EXAMPLE_PARAMETER, "alpine"],
+                         create_docker_call(["container", "run", "alpine"], EXAMPLE_PARAMETER, ["A"]))
+        self.assertEqual(["docker", "buildx", "build", "--secret", "id=A,env=A", "."],
+                         create_docker_call(["buildx", "build", "."], None, ["A"]))
+
+    def test_unsupported_call(self):
+        self.assertEqual(["docker", "compose", "ps"], create_docker_call(["compose", "ps"], EXAMPLE_PARAMETER, ["A"]))
+
+    def test_unsupported_calls_passed_through(self):
+        for docker_arguments in (["network", "create", "mynet"], ["volume", "create", "myvolume"],
+                                 ["rm", "-f", "exec"], ["logs", "build"]):
+            self.assertEqual(["docker"] + docker_arguments,
+                             create_docker_call(docker_arguments, EXAMPLE_PARAMETER, ["A"]))
+            self.assertIsNone(create_docker_environment(docker_arguments, EXAMPLE_VARIABLES))
+
+    def test_build_environment(self):
+        environment = create_docker_environment(["build", "."], EXAMPLE_VARIABLES)
+        self.assertEqual(EXAMPLE_VARIABLES["HELLO"], environment["HELLO"])
+        self.assertEqual("1", environment["DOCKER_BUILDKIT"])
+        self.assertEqual(os.environ["PATH"], environment["PATH"])
+
+    def test_compose_environment(self):
+        environment = create_docker_environment(["compose", "run", "service"], EXAMPLE_VARIABLES)
+        self.assertEqual(EXAMPLE_VARIABLES["HELLO"], environment["HELLO"])
+        self.assertNotIn("DOCKER_BUILDKIT", environment)
+
+    def test_run_environment(self):
+        self.assertIsNone(create_docker_environment(["run", "alpine"], EXAMPLE_VARIABLES))
+
+
+class TestPrepareDockerCall(unittest.TestCase):
+    """
+    Tests for `prepare_secret_files` and `prepare_docker_call`.
+    """
+    def test_prepare_run_call(self):
+        with ExitStack() as exit_stack:
+            variables, action_arguments = prepare_secret_files(exit_stack, EXAMPLE_VARIABLES, ["HELLO"])
+            docker_call = prepare_docker_call(exit_stack, ["run", "alpine"], variables, action_arguments)
+            env_file_location = docker_call.arguments[docker_call.arguments.index("--env-file") + 1]
+            with open(env_file_location, "r") as file:
+                env_file_contents = file.read()
+            self.assertIn(f"HELLO{FILE_VARIABLE_SUFFIX}=", env_file_contents)
+            self.assertNotIn(EXAMPLE_VARIABLES["HELLO"], env_file_contents)
+            self.assertEqual(action_arguments, docker_call.arguments[4:4 + len(action_arguments)])
+            self.assertIsNone(docker_call.environment)
+        self.assertFalse(os.path.exists(env_file_location))
+
+    def test_prepare_secret_files_when_replacing_process(self):
+        with ExitStack() as exit_stack:
+            self.assertEqual((EXAMPLE_VARIABLES, []),
+                             prepare_secret_files(exit_stack, EXAMPLE_VARIABLES, ["HELLO"], replace_process=True))
+
+    def test_prepare_build_call(self):
+        with ExitStack() as exit_stack:
+            docker_call = prepare_docker_call(exit_stack, ["build", "."], EXAMPLE_VARIABLES)
+        self.assertEqual(create_docker_call(["build", "."], None, EXAMPLE_VARIABLES.keys()), docker_call.arguments)
+        self.assertEqual((), docker_call.pass_fds)
+        self.assertEqual(EXAMPLE_VARIABLES["HELLO"], docker_call.environment["HELLO"])
+
+
+class TestRunInteractive(unittest.TestCase):
+    """
+    Tests for `_run_interactive`.
+    """
+    def test_exit_code(self):
+        self.assertEqual(3, _run_interactive([sys.executable, "-c", "import sys; sys.exit(3)"]))
+
+    def test_forwards_signals(self):
+        child = "import signal, sys, time; signal.signal(signal.SIGUSR1, lambda *args: sys.exit(7)); time.sleep(30)"
+        Timer(1.0, os.kill, (os.getpid(), signal.SIGUSR1)).start()
+        self.assertEqual(7, _run_interactive([sys.executable, "-c", child]))
+
+    def test_exit_code_when_killed_by_signal(self):
+        child = "import os, signal; os.kill(os.getpid(), signal.SIGTERM)"
+        self.assertEqual(128 + signal.SIGTERM, _run_interactive([sys.executable, "-c", child]))
+
+
+class TestOutputTail(unittest.TestCase):
+    """
+    Tests for `OutputTail`.
+    """
+    def test_holds_all_when_smaller_than_size(self):
+        tail = OutputTail(10)
+        tail.write(b"abc")
+        tail.write(b"def")
+        self.assertEqual("abcdef", tail.getvalue())
+
+    def test_holds_end_when_larger_than_size(self):
+        tail = OutputTail(4)
+        tail.write(b"abc")
+        tail.write(b"defgh")
+        self.assertEqual("efgh", tail.getvalue())
+
+
+class TestForwardOutput(unittest.TestCase):
+    """
+    Tests for `_forward_output`.
+    """
+    def test_forwards_raw_output(self):
+        process = self._start_python(
+            f"import sys; sys.stdout.buffer.write(b'x' * {_LARGE_OUTPUT_SIZE}); sys.stderr.buffer.write(b'\\xff')")
+        stdout, stderr = BytesIO(), BytesIO()
+        self.assertEqual((None, None), _forward_output(process, stdout, stderr, None))
+        self.assertEqual(0, process.returncode)
+        self.assertEqual(b"x" * _LARGE_OUTPUT_SIZE, stdout.getvalue())
+        self.assertEqual(b"\xff", stderr.getvalue())
+
+    def test_returns_tail(self):
+        process = self._start_python("import sys; print('hello'); print('world', file=sys.stderr); sys.exit(3)")
+        stdout_tail, stderr_tail = _forward_output(process, BytesIO(), BytesIO(), 3)
+        self.assertEqual(3, process.returncode)
+        self.assertEqual("lo\n", stdout_tail)
+        self.assertEqual("ld\n", stderr_tail)
+
+    def _start_python(self, code: str) -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import math
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from typing import Dict, List, Tuple
+
+from dockerwithgitlabsecrets.client import API_PATH, VERSION_PATH, TOKEN_HEADER, ETAG_HEADER, IF_NONE_MATCH_HEADER
+
+_DEFAULT_PER_PAGE = 20
+_MAX_PER_PAGE = 100
+_POLL_INTERVAL = 0.05
+_ALL_ENVIRONMENTS_SCOPE = "*"
+_VERSION = "9.0.0"
+_ENVIRONMENT_SCOPE_FILTER_PARAMETER = "filter[environment_scope]"
+_ENCODING = "utf-8"
+
+
+class FakeGitLab:
+    """
+    Local HTTP server that imitates the parts of the GitLab API that are used to get variables (used by the tests and
+    benchmarks, and not installed with the package).
+    """
+    def __init__(self, token: str, latency: float=0.0, max_per_page: int=_MAX_PER_PAGE,
+                 report_total_pages: bool=True, api_path: str=API_PATH):
+        """
+        Constructor.
+        :param token: the access token that requests must have
+        :param latency: seconds to wait before responding to each request
+        :param max_per_page: the maximum page size
+        :param report_total_pages: whether to report the total number of pages (GitLab does not for large collections)
+        :param api_path: the path of the (only) API version that is served
+
+        Error responses (given as the status and headers) can be added to `queued_responses`, which are given in turn in
+        place of the responses to the next requests. Similarly, latencies added to `queued_latencies` are used in place
+        of `latency` for the next requests.
+        """
+        self.token = token
+        self.latency = latency
+        self.max_per_page = max_per_page
+        self.report_total_pages = report_total_pages
+        self.api_path = api_path
+        self.projects: Dict[str, List[Dict]] = {}
+        self.groups: Dict[str, List[Dict]] = {}
+        self.requests: List[str] = []
+        self.connections = 0
+        self.queued_responses: List[Tuple[int, Dict[str, str]]] = []
+        self.queued_latencies: List[float] = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _create_request_handler(self))
+        self._thread: threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        Gets the URL of the server.
+        :return: the server URL
+        """
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def set_project_variables(self, project: str, variables: Dict[str, str]):
+        """
+        Sets the variables of the given project.
+        :param project: the namespaced project
+        :param variables: the project's variables
+        """
+        self.projects[project] = [{"key": key, "value": value, "environment_scope": _ALL_ENVIRONMENTS_SCOPE}
+                                  for key, value in variables.items()]
+
+    def add_project_variables(self, project: str, variables: Dict[str, str], environment_scope: str):
+        """
+        Adds variables with the given environment scope to the given project.
+        :param project: the namespaced project
+        :param variables: the variables to add
+        :param environment_scope: the environment scope of the variables
+        """
+        self.projects.setdefault(project, []).extend(
+            {"key": key, "value": value, "environment_scope": environment_scope} for key, value in variables.items())
+
+    def set_group_variables(self, group: str, variables: Dict[str, str]):
+        """
+        Sets the variables of the given group.
+        :param group: the group
+        :param variables: the group's variables
+        """
+        self.groups[group] = [{"key": key, "value": value, "environment_scope": _ALL_ENVIRONMENTS_SCOPE}
+                              for key, value in variables.items()]
+
+    def start(self):
+        """
+        Starts the server in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(_POLL_INTERVAL, ), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> "FakeGitLab":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that handles each request in a thread (`http.server.ThreadingHTTPServer` requires Python 3.7).
+    """
+    daemon_threads = True
+
+
+def _create_request_handler(fake_gitlab: FakeGitLab) -> type:
+    """
+    Creates a handler of requests to the given fake GitLab.
+    :param fake_gitlab: the fake GitLab
+    :return: the request handler class
+    """
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with fake_gitlab._lock:
+                fake_gitlab.connections += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            with fake_gitlab._lock:
+                fake_gitlab.requests.append(self.path)
+                latency = fake_gitlab.queued_latencies.pop(0) if len(fake_gitlab.queued_latencies) > 0 \
+                    else fake_gitlab.latency
+                queued_response = fake_gitlab.queued_responses.pop(0) if len(fake_gitlab.queued_responses) > 0 \
+                    else None
+            time.sleep(latency)
+
+            if queued_response is not None:
+                status, headers = queued_response
+                self._respond(status, {"message": f"{status} Error"}, headers)
+                return
+
+            if self.headers.get(TOKEN_HEADER) != fake_gitlab.token:
+                self._respond(401, {"message": "401 Unauthorized"})
+                return
+
+            split_path = urlsplit(self.path)
+            if split_path.path == f"{fake_gitlab.api_path}{VERSION_PATH}":
+                self._respond(200, {"version": _VERSION, "revision": "unknown"})
+                return
+            path_elements = split_path.path[len(fake_gitlab.api_path):].split("/")
+            if not split_path.path.startswith(fake_gitlab.api_path) or len(path_elements) not in (4, 5) \
+                    or path_elements[3] != "variables":
+                self._respond(404, {"error": "404 Not Found"})
+                return
+            collections = fake_gitlab.projects if path_elements[1] == "projects" else fake_gitlab.groups
+            variables = collections.get(unquote(path_elements[2]))
+            if variables is None:
+                self._respond(404, {"message": f"404 {path_elements[1]} Not Found"})
+                return
+
+            query = parse_qs(split_path.query)
+            if len(path_elements) == 5:
+                self._respond_with_variable(variables, unquote(path_elements[4]),
+                                            query.get(_ENVIRONMENT_SCOPE_FILTER_PARAMETER, [None])[0])
+                return
+            per_page = min(int(query.get("per_page", [_DEFAULT_PER_PAGE])[0]), fake_gitlab.max_per_page)
+            page = int(query.get("page", [1])[0])
+            total_pages = max(1, math.ceil(len(variables) / per_page))
+            headers = {"X-Page": str(page), "X-Per-Page": str(per_page),
+                       "X-Next-Page": str(page + 1) if page < total_pages else ""}
+            if fake_gitlab.report_total_pages:
+                headers.update({"X-Total": str(len(variables)), "X-Total-Pages": str(total_pages)})
+            json_body = variables[(page - 1) * per_page:page * per_page]
+            etag = f"W/\"{hashlib.md5(json.dumps(json_body).encode(_ENCODING)).hexdigest()}\""
+            headers[ETAG_HEADER] = etag
+            if self.headers.get(IF_NONE_MATCH_HEADER) == etag:
+                self._respond(304, None, headers)
+                return
+            self._respond(200, json_body, headers)
+
+        def _respond_with_variable(self, variables: List[Dict], key: str, environment_scope: str=None):
+            matching = [variable for variable in variables if variable["key"] == key
+                        and (environment_scope is None or variable["environment_scope"] == environment_scope)]
+            if len(matching) == 0:
+                self._respond(404, {"message": "404 Variable Not Found"})
+            elif len(matching) > 1:
+                self._respond(409, {"message": "There are multiple variables with provided parameters. Please use "
+                                               "'filter[environment_scope]'"})
+            else:
+                self._respond(200, matching[0])
+
+        def _respond(self, status: int, json_body, headers: Dict[str, str]=None):
+            body = json.dumps(json_body).encode(_ENCODING) if json_body is not None else b""
+            self.send_response(status)
+            if json_body is not None:
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return RequestHandler
@@ -0,0 +1,330 @@
+import threading
+from fnmatch import fnmatchcase
+
+from typing import Dict, List, Callable, Iterable, Tuple, NamedTuple, Optional, Collection, TypeVar, TYPE_CHECKING
+
+from dockerwithgitlabsecrets.circuitbreaker import CircuitBreaker
+from dockerwithgitlabsecrets.configuration import GitLabConfiguration
+
+if TYPE_CHECKING:
+    # The client (and the HTTP and SSL libraries) are only imported when GitLab is contacted
+    from dockerwithgitlabsecrets.client import GitLabVariablesClient
+
+GROUP_SOURCE_PREFIX = "group:"
+SOURCE_SEPARATOR = ","
+ENVIRONMENT_SCOPE_SEPARATOR = "@"
+KEY_PATTERN_SEPARATOR = ","
+MAX_KEYS_FETCHED_INDIVIDUALLY = 10
+
+_NAMESPACE_PROJECT_SEPARATOR = "/"
+_GLOB_CHARACTERS = "*?["
+
+SourceVariablesGetter = Callable[[str], Dict[str, str]]
+_FetchResult = TypeVar("_FetchResult")
+
+_clients: Dict[Tuple, "GitLabVariablesClient"] = {}
+_circuit_breakers: Dict[Tuple, CircuitBreaker] = {}
+_clients_lock = threading.Lock()
+
+
+class VariablesDiff(NamedTuple):
+    """
+    Keys of variables that have changed.
+    """
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+    def is_empty(self) -> bool:
+        """
+        Gets whether no variables have changed.
+        :return: whether there are no changes
+        """
+        return len(self.added) == 0 and len(self.changed) == 0 and len(self.removed) == 0
+
+
+def is_group_source(source: str) -> bool:
+    """
+    Gets whether the given variables source is a group (rather than a project).
+    :param source: the variables source
+    :return: whether the source is a group
+    """
+    return source.startswith(GROUP_SOURCE_PREFIX)
+
+
+def parse_sources(values: Iterable[str]) -> List[str]:
+    """
+    Parses variable sources, which may be given as comma-separated lists.
+    :param values: the values to parse
+    :return: the variable sources, in the order given
+    """
+    return [source.strip() for value in values for source in value.split(SOURCE_SEPARATOR) if source.strip() != ""]
+
+
+def namespace_source(source: str, namespace: str) -> str:
+    """
+    Namespaces the given variables source, if it is a project that is not already namespaced.
+    :param source: the variables source
+    :param namespace: the default namespace
+    :return: the namespaced source
+    """
+    if is_group_source(source) or _NAMESPACE_PROJECT_SEPARATOR in split_source_scope(source)[0]:
+        return source
+    return f"{namespace}{_NAMESPACE_PROJECT_SEPARATOR}{source}"
+
+
+def scope_source(source: str, environment_scope: Optional[str]) -> str:
+    """
+    Scopes the given variables source to the given environment, if it is not already scoped.
+    :param source: the variables source
+    :param environment_scope: the environment (`None` for variables of all environment scopes)
+    :return: the scoped source
+    """
+    if environment_scope is None or ENVIRONMENT_SCOPE_SEPARATOR in source:
+        return source
+    return f"{source}{ENVIRONMENT_SCOPE_SEPARATOR}{environment_scope}"
+
+
+def split_source_scope(source: str) -> Tuple[str, Optional[str]]:
+    """
+    Splits the environment scope from the given variables source.
+    :param source: the (possibly scoped) variables source
+    :return: tuple where the first element is the source and the second is the environment (`None` if not scoped)
+    """
+    unscoped_source, separator, environment_scope = source.partition(ENVIRONMENT_SCOPE_SEPARATOR)
+    return unscoped_source, environment_scope if separator != "" else None
+
+
+def parse_key_patterns(values: Iterable[str]) -> List[str]:
+    """
+    Parses variable key (glob) patterns, which may be given as comma-separated lists.
+    :param values: the values to parse
+    :return: the patterns
+    """
+    return [pattern.strip() for value in values for pattern in value.split(KEY_PATTERN_SEPARATOR)
+            if pattern.strip() != ""]
+
+
+def is_included_key(key: str, include: Collection[str], exclude: Collection[str]) -> bool:
+    """
+    Gets whether the variable with the given key is included by the given patterns.
+    :param key: the variable's key
+    :param include: glob patterns of the keys to include (all keys are included if empty)
+    :param exclude: glob patterns of the keys to exclude, which takes precedence over `include`
+    :return: whether the variable is included
+    """
+    return (len(include) == 0 or any(fnmatchcase(key, pattern) for pattern in include)) \
+        and not any(fnmatchcase(key, pattern) for pattern in exclude)
+
+
+def filter_variables(variables: Dict[str, str], include: Collection[str], exclude: Collection[str]) -> Dict[str, str]:
+    """
+    Filters the given variables to those with keys included by the given patterns.
+    :param variables: the variables
+    :param include: see `is_included_key`
+    :param exclude: see `is_included_key`
+    :return: the included variables
+    """
+    if len(include) == 0 and len(exclude) == 0:
+        return variables
+    return {key: value for key, value in variables.items() if is_included_key(key, include, exclude)}
+
+
+def get_keys_to_fetch(include: Collection[str], exclude: Collection[str]) -> Optional[List[str]]:
+    """
+    Gets the keys of the variables to fetch individually, rather than listing all variables, which is possible if the
+    include patterns are all literal keys and there are not too many of them.
+    :param include: see `is_included_key`
+    :param exclude: see `is_included_key`
+    :return: the keys to fetch (`None` if all variables should be listed)
+    """
+    if len(include) == 0 or len(include) > MAX_KEYS_FETCHED_INDIVIDUALLY \
+            or any(character in pattern for pattern in include for character in _GLOB_CHARACTERS):
+        return None
+    return [key for key in include if is_included_key(key, include, exclude)]
+
+
+def get_client(gitlab_configuration: GitLabConfiguration) -> "GitLabVariablesClient":
+    """
+    Gets the client of the given GitLab instance, which is shared so that its connections are reused.
+    :param gitlab_configuration: configuration to access GitLab
+    :return: the client
+    """
+    from dockerwithgitlabsecrets.client import GitLabVariablesClient
+    key = _get_client_key(gitlab_configuration)
+    circuit_breaker = get_circuit_breaker(gitlab_configuration)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = GitLabVariablesClient(
+                gitlab_configuration.url, gitlab_configuration.token, ssl_verify=gitlab_configuration.ssl_verify,
+                connect_timeout=gitlab_configuration.connect_timeout, read_timeout=gitlab_configuration.read_timeout,
+                retries=gitlab_configuration.retries,
+                hedge_delay=_get_hedge_delay(gitlab_configuration, circuit_breaker))
+        return _clients[key]
+
+
+def find_client(gitlab_configuration: GitLabConfiguration) -> Optional["GitLabVariablesClient"]:
+    """
+    Gets the client of the given GitLab instance, if it has been created (i.e. GitLab has been contacted), without
+    creating it.
+    :param gitlab_configuration: configuration to access GitLab
+    :return: the client or `None` if it has not been created
+    """
+    with _clients_lock:
+        return _clients.get(_get_client_key(gitlab_configuration))
+
+
+def _get_client_key(gitlab_configuration: GitLabConfiguration) -> Tuple:
+    """
+    Gets the key of the (shared) client of the given GitLab instance.
+    :param gitlab_configuration: configuration to access GitLab
+    :return: the key
+    """
+    return (gitlab_configuration.url, gitlab_configuration.token, gitlab_configuration.ssl_verify,
+            gitlab_configuration.connect_timeout, gitlab_configuration.read_timeout, gitlab_configuration.retries,
+            gitlab_configuration.hedge_percentile)
+
+
+def get_circuit_breaker(gitlab_configuration: GitLabConfiguration) -> Optional[CircuitBreaker]:
+    """
+    Gets the circuit breaker of the given GitLab instance, which also records the latencies used to decide when to
+    hedge requests.
+    :param gitlab_configuration: configuration to access GitLab
+    :return: the circuit breaker or `None` if neither it nor hedging is enabled
+    """
+    circuit_breaker_configuration = gitlab_configuration.circuit_breaker
+    if circuit_breaker_configuration.failure_threshold <= 0 and gitlab_configuration.hedge_percentile is None:
+        return None
+    key = (gitlab_configuration.url, circuit_breaker_configuration)
+    with _clients_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker(gitlab_configuration.url.rstrip("/"),
+                                                    circuit_breaker_configuration.failure_threshold,
+                                                    circuit_breaker_configuration.reset_timeout,
+                                                    circuit_breaker_configuration.directory)
+        return _circuit_breakers[key]
+
+
+def fetch_variables(gitlab_configuration: GitLabConfiguration, source: str, keys: Collection[str]=None) \
+        -> Dict[str, str]:
+    """
+    Fetches the variables of the given project or group from GitLab.
+    :param gitlab_configuration: configuration to access GitLab
+    :param source: the namespaced project or the group (prefixed with `GROUP_SOURCE_PREFIX`), optionally scoped to an
+    environment (see `scope_source`)
+    :param keys: the keys of the variables to fetch (`None` for all variables)
+    :return: the variables
+    """
+    source, environment_scope = split_source_scope(source)
+
+    def fetch(client: "GitLabVariablesClient") -> Dict[str, str]:
+        if is_group_source(source):
+            group = source[len(GROUP_SOURCE_PREFIX):]
+            return client.get_group_variables(group, environment_scope) if keys is None \
+                else client.get_group_variables_by_key(group, keys, environment_scope)
+        return client.get_project_variables(source, environment_scope) if keys is None \
+            else client.get_project_variables_by_key(source, keys, environment_scope)
+
+    return _fetch_with_circuit_breaker(gitlab_configuration, fetch)
+
+
+def fetch_variables_if_changed(gitlab_configuration: GitLabConfiguration, source: str, etag: Optional[str]) \
+        -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    """
+    Fetches the variables of the given project or group from GitLab, if they have changed since they were fetched with
+    the given ETag.
+    :param gitlab_configuration: configuration to access GitLab
+    :param source: the namespaced project or the group (prefixed with `GROUP_SOURCE_PREFIX`), optionally scoped to an
+    environment (see `scope_source`)
+    :param etag: the ETag of the variables when they were last fetched (`None` to fetch them unconditionally)
+    :return: tuple where the first element is the variables (`None` if they have not changed) and the second is their
+    ETag (`None` if there is not one)
+    """
+    source, environment_scope = split_source_scope(source)
+
+    def fetch(client: "GitLabVariablesClient") -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+        if is_group_source(source):
+            return client.get_group_variables_if_changed(source[len(GROUP_SOURCE_PREFIX):], etag, environment_scope)
+        return client.get_project_variables_if_changed(source, etag, environment_scope)
+
+    return _fetch_with_circuit_breaker(gitlab_configuration, fetch)
+
+
+def _fetch_with_circuit_breaker(gitlab_configuration: GitLabConfiguration,
+                                fetch: Callable[["GitLabVariablesClient"], _FetchResult]) -> _FetchResult:
+    """
+    Fetches from GitLab using the given function, through the GitLab instance's circuit breaker (if enabled).
+    :param gitlab_configuration: configuration to access GitLab
+    :param fetch: fetches using the given client
+    :return: what was fetched
+    :raises CircuitOpenError: if GitLab is not contacted because its circuit breaker is open
+    """
+    from dockerwithgitlabsecrets.client import is_transient_error
+    client = get_client(gitlab_configuration)
+    circuit_breaker = get_circuit_breaker(gitlab_configuration)
+    if circuit_breaker is None:
+        return fetch(client)
+
+    circuit_breaker.before_request()
+    try:
+        # Only the requests of this fetch are recorded, as other sources may be fetched with the client at the same time
+        with client.recording_timings() as timings:
+            fetched = fetch(client)
+    except Exception as e:
+        # Other errors (e.g. a project that does not exist) do not mean that GitLab is unavailable
+        if is_transient_error(e):
+            circuit_breaker.record_failure()
+        raise
+    # Latencies are only recorded (which rewrites the breaker's state) if they are used to decide when to hedge
+    latencies = [timing.duration for timing in timings if timing.status < 400] \
+        if gitlab_configuration.hedge_percentile is not None else []
+    circuit_breaker.record_success(latencies)
+    client.hedge_delay = _get_hedge_delay(gitlab_configuration, circuit_breaker)
+    return fetched
+
+
+def _get_hedge_delay(gitlab_configuration: GitLabConfiguration, circuit_breaker: Optional[CircuitBreaker]) \
+        -> Optional[float]:
+    """
+    Gets the time after which requests to the given GitLab instance are hedged.
+    :param gitlab_configuration: configuration to access GitLab
+    :param circuit_breaker: the circuit breaker of the GitLab instance, which records the latencies of requests
+    :return: the hedge delay or `None` if requests are not to be hedged (or too few latencies have been recorded)
+    """
+    if gitlab_configuration.hedge_percentile is None or circuit_breaker is None:
+        return None
+    return circuit_breaker.get_latency_percentile(gitlab_configuration.hedge_percentile)
+
+
+def diff_variables(previous: Dict[str, str], current: Dict[str, str]) -> VariablesDiff:
+    """
+    Gets the keys of the variables that differ between the given variables.
+    :param previous: the previous variables
+    :param current: the current variables
+    :return: the difference (with keys in sorted order)
+    """
+    return VariablesDiff(added=sorted(current.keys() - previous.keys()),
+                         changed=sorted(key for key in current.keys() & previous.keys()
+                                        if current[key] != previous[key]),
+                         removed=sorted(previous.keys() - current.keys()))
+
+
+def get_merged_variables(sources: List[str], getter: SourceVariablesGetter) -> Dict[str, str]:
+    """
+    Gets the variables of the given sources concurrently, then merges them. Variables of sources later in the list
+    take precedence over those with the same key from earlier sources.
+    :param sources: the variable sources
+    :param getter: gets the variables of a source
+    :return: the merged variables
+    """
+    if len(sources) == 1:
+        return getter(sources[0])
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        source_variables = list(executor.map(getter, sources))
+
+    merged_variables = {}
+    for variables in source_variables:
+        merged_variables.update(variables)
+    return merged_variables
@@ -1,17 +1,61 @@
 import logging
 import os
+import signal
 import subprocess
-from tempfile import NamedTemporaryFile
+import sys
+from contextlib import ExitStack
+from threading import Thread, current_thread, main_thread
 
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Callable, Union, BinaryIO, Collection, NamedTuple, TYPE_CHECKING
+
+from dockerwithgitlabsecrets.defaults import DEFAULT_DOCKER_BACKEND, DOCKER_BACKEND_ENGINE
+from dockerwithgitlabsecrets.envfile import env_file, SAFE_LINE_BREAK, warn_if_new_lines_in_variables, \
+    DEFAULT_ENV_FILE_BACKEND, EnvFile
+from dockerwithgitlabsecrets.secretfiles import secret_files, replace_with_file_variables
+from dockerwithgitlabsecrets.profiling import Profiler, NULL_PROFILER, ENV_FILE_PHASE, DOCKER_PHASE
+
+if TYPE_CHECKING:
+    # The Docker Engine API backend (and the HTTP library) is only imported when it is used
+    from dockerwithgitlabsecrets.engine import DockerEngineClient
 
 _DOCKER_ENV_FILE_PARAMETER = "env-file"
-_DOCKER_ENV_FILE_SUFFIX = ".env"
+_DOCKER_SECRET_PARAMETER = "secret"
+_DOCKER_ENV_PARAMETER = "e"
 _DOCKER_BINARY = "docker"
-_SUPPORTED_DOCKER_ACTIONS = ["run"]
+_BUILDKIT_ENVIRONMENT_VARIABLE = "DOCKER_BUILDKIT"
+_RUN_DOCKER_ACTION = "run"
+_ENV_FILE_DOCKER_ACTIONS = [_RUN_DOCKER_ACTION, "create", "exec"]
+_SECRET_FILE_DOCKER_ACTIONS = [_RUN_DOCKER_ACTION]
+_BUILD_DOCKER_ACTION = "build"
+_COMPOSE_DOCKER_ACTION = "compose"
+_SUPPORTED_DOCKER_ACTIONS = _ENV_FILE_DOCKER_ACTIONS + [_BUILD_DOCKER_ACTION, _COMPOSE_DOCKER_ACTION]
+# Management commands that have a supported action as a subcommand, e.g. `docker container run`
+_MANAGEMENT_COMMAND_ACTIONS = {
+    "container": _ENV_FILE_DOCKER_ACTIONS,
+    "image": [_BUILD_DOCKER_ACTION],
+    "builder": [_BUILD_DOCKER_ACTION],
+    "buildx": [_BUILD_DOCKER_ACTION]
+}
+_COMPOSE_RUN_ACTION = "run"
+_SUPPORTED_COMPOSE_ACTIONS = ["up", _COMPOSE_RUN_ACTION]
+# Global options that take a value as a separate argument (e.g. `docker -H host run`), so the value is not mistaken
+# for the action
+_DOCKER_OPTIONS_WITH_VALUES = ["-H", "--host", "-c", "--context", "--config", "-l", "--log-level", "--tlscacert",
+                               "--tlscert", "--tlskey"]
+_COMPOSE_OPTIONS_WITH_VALUES = ["-f", "--file", "-p", "--project-name", "--profile", "--env-file",
+                                "--project-directory", "--ansi", "--parallel", "--progress"]
+_FORWARDED_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2]
+_SIGNAL_EXIT_CODE_OFFSET = 128
+_DOCKER_ERROR_EXIT_CODE = 125
+_COMMAND_NOT_EXECUTABLE_EXIT_CODE = 126
+_COMMAND_NOT_FOUND_EXIT_CODE = 127
+_COMMAND_NOT_FOUND_ERRORS = ["executable file not found", "no such file or directory"]
+_COMMAND_NOT_EXECUTABLE_ERRORS = ["permission denied", "exec format error"]
 
-_LINE_BREAK = "\n"
-SAFE_LINE_BREAK = "\\n"
+INTERACTIVE_MODE_SPAWN = "spawn"
+INTERACTIVE_MODE_EXEC = "exec"
+
+STREAM_CHUNK_SIZE = 64 * 1024
 
 _ENCODING = "utf-8"
 
@@ -19,72 +63,535 @@ StdOutType = str
 StdErrType = str
 ReturnCodeType = int
 ProgramOutputType = Tuple[ReturnCodeType, Optional[StdOutType], Optional[StdErrType]]
+VariablesType = Union[Dict[str, str], Callable[[], Dict[str, str]]]
+SecretFileKeysType = Union[Collection[str], Callable[[Dict[str, str]], Collection[str]]]
 
 _logger = logging.getLogger(__name__)
 
 
+class DockerCall(NamedTuple):
+    """
+    Call to Docker, with the variables given in the way that the Docker action supports (see `create_docker_call`).
+    """
+    arguments: List[str]
+    pass_fds: Tuple[int, ...]
+    environment: Optional[Dict[str, str]]
+
+
+class OutputTail:
+    """
+    Bounded buffer that holds the end of an output stream.
+    """
+    def __init__(self, size: int):
+        """
+        Constructor.
+        :param size: the maximum number of bytes to hold
+        """
+        self.size = size
+        self._buffer = bytearray()
+
+    def write(self, data: bytes):
+        """
+        Writes the given data to the end of the buffer, discarding the oldest data if the buffer is full.
+        :param data: the data to write
+        """
+        self._buffer += data
+        if len(self._buffer) > self.size:
+            del self._buffer[:len(self._buffer) - self.size]
+
+    def getvalue(self) -> str:
+        """
+        Gets the contents of the buffer.
+        :return: the buffered data (decoded)
+        """
+        return self._buffer.decode(_ENCODING, errors="replace")
+
+
 def get_supported_action_index(docker_arguments: List[str]) -> Optional[int]:
     """
-    Gets the index of the action to which 
-    :param docker_arguments: 
-    :return: 
+    Gets the index of the Docker action, which uses the variables, in the given arguments. The action is the first
+    argument that is not a global option (or the subcommand of a management command, e.g. `docker container run`).
+    :param docker_arguments: the arguments given to Docker
+    :return: the index of the action or `None` if the action does not use the variables
     """
-    if len(docker_arguments) == 0:
+    docker_action_index = _get_command_index(docker_arguments, _DOCKER_OPTIONS_WITH_VALUES)
+    if docker_action_index is None:
         return None
-
-    docker_action_index = 0
-    while docker_arguments[docker_action_index] not in _SUPPORTED_DOCKER_ACTIONS:
+    management_command_actions = _MANAGEMENT_COMMAND_ACTIONS.get(docker_arguments[docker_action_index])
+    if management_command_actions is not None:
         docker_action_index += 1
-        if docker_action_index == len(docker_arguments):
+        if docker_action_index == len(docker_arguments) \
+                or docker_arguments[docker_action_index] not in management_command_actions:
             return None
+    elif docker_arguments[docker_action_index] not in _SUPPORTED_DOCKER_ACTIONS:
+        return None
+    if docker_arguments[docker_action_index] != _COMPOSE_DOCKER_ACTION:
+        return docker_action_index
+    # Only some Compose actions start containers
+    compose_action_index = _get_compose_action_index(docker_arguments, docker_action_index)
+    if compose_action_index is None \
+            or docker_arguments[compose_action_index] not in _SUPPORTED_COMPOSE_ACTIONS:
+        return None
     return docker_action_index
 
 
-def warn_if_new_lines_in_variables(variables: Dict[str, str]):
+def uses_env_file(docker_arguments: List[str]) -> bool:
     """
-    Emits a warning to the logger if one of the given key/value variables contains new line characters in its output.
-    :param variables: the variables
+    Gets whether the variables are given to Docker via an env file, rather than via Docker's environment.
+    :param docker_arguments: the arguments given to Docker
+    :return: whether an env file is used
+    """
+    docker_action_index = get_supported_action_index(docker_arguments)
+    return docker_action_index is not None and docker_arguments[docker_action_index] in _ENV_FILE_DOCKER_ACTIONS
+
+
+def uses_secret_files(docker_arguments: List[str]) -> bool:
     """
-    for key, value in variables.items():
-        if _LINE_BREAK in value:
-            _logger.warning(f"New line characters in variable with key \"{key}\" have been escaped to \\\\n")
+    Gets whether variables can be given to Docker as files mounted into the container.
+    :param docker_arguments: the arguments given to Docker
+    :return: whether secret files can be used
+    """
+    docker_action_index = get_supported_action_index(docker_arguments)
+    return docker_action_index is not None and docker_arguments[docker_action_index] in _SECRET_FILE_DOCKER_ACTIONS
 
 
-def run_wrapped(docker_arguments: List[str], variables: Dict[str, str], interactive: bool=False) -> ProgramOutputType:
+def run_wrapped(docker_arguments: List[str], variables: VariablesType, interactive: bool=False, stream: bool=False,
+                tail_size: int=None, interactive_mode: str=INTERACTIVE_MODE_SPAWN,
+                env_file_backend: str=DEFAULT_ENV_FILE_BACKEND, secret_file_keys: SecretFileKeysType=(),
+                docker_backend: str=DEFAULT_DOCKER_BACKEND, profiler: Profiler=NULL_PROFILER) -> ProgramOutputType:
     """
     Runs Docker with the given arguments with the given variables set in the envrionment.
     :param docker_arguments: the arguments to pass to Dcoker
-    :param variables: the variables to set in the environment
+    :param variables: the variables to set in the environment or a callable that gets them, which is only called if
+    the Docker action uses the variables
     :param interactive: whether the wrapped Docker run should be interactive
+    :param stream: whether Docker's output should be written to this process' stdout and stderr as it is produced,
+    instead of being returned
+    :param tail_size: when streaming, the maximum number of bytes at the end of stdout and stderr to return (output is
+    not returned if not set)
+    :param interactive_mode: how Docker is ran interactively: `INTERACTIVE_MODE_SPAWN` runs Docker as a child process,
+    to which signals are forwarded, whereas `INTERACTIVE_MODE_EXEC` replaces this process with Docker (this function
+    will then not return)
+    :param env_file_backend: where the env file containing the variables is created (see `envfile.env_file`)
+    :param secret_file_keys: keys of the variables to give to the container as read-only files, or a callable that
+    selects them from the variables (see `secretfiles.secret_files`). Only used with `run`, when not replacing this
+    process
+    :param docker_backend: how Docker is ran: `DOCKER_BACKEND_ENGINE` runs non-interactive `run` calls via the Docker
+    Engine API, with the variables given in memory rather than in an env file, falling back to the Docker CLI for calls
+    that the Engine API backend does not support (see `engine.parse_run_arguments`)
+    :param profiler: profiler of the run
     :return: the output of running Docker
     """
     docker_action_index = get_supported_action_index(docker_arguments)
-    docker_call = [_DOCKER_BINARY]
 
     if docker_action_index is None:
-        docker_call += docker_arguments
-        process = subprocess.Popen(docker_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        returncode = process.returncode
-    else:
-        with NamedTemporaryFile(suffix=_DOCKER_ENV_FILE_SUFFIX, mode="w") as env_file:
-            warn_if_new_lines_in_variables(variables)
-            env_variables = os.linesep.join([f"{key}={value.replace(_LINE_BREAK, SAFE_LINE_BREAK)}"
-                                             for key, value in variables.items()])
-            env_file.write(env_variables)
-            env_file.flush()
+        with profiler.phase(DOCKER_PHASE):
+            return _run_docker(create_docker_call(docker_arguments, None), stream, tail_size)
+
+    profiler.record("action", docker_arguments[docker_action_index])
+    if callable(variables):
+        variables = variables()
+    replace_process = interactive and interactive_mode == INTERACTIVE_MODE_EXEC
+
+    with ExitStack() as exit_stack:
+        profiler.record("variable_count", len(variables))
+        action_arguments = []
+        if uses_secret_files(docker_arguments):
+            variables, action_arguments = prepare_secret_files(exit_stack, variables, secret_file_keys, profiler,
+                                                               replace_process)
+
+        if docker_backend == DOCKER_BACKEND_ENGINE and not interactive \
+                and docker_arguments[docker_action_index] == _RUN_DOCKER_ACTION:
+            with profiler.phase(DOCKER_PHASE):
+                output = _run_with_engine(docker_arguments, docker_action_index, variables, action_arguments, stream,
+                                          tail_size)
+            if output is not None:
+                profiler.record("docker_backend", DOCKER_BACKEND_ENGINE)
+                return output
 
-            docker_call += docker_arguments[0:docker_action_index+1] + \
-                           [f"--{_DOCKER_ENV_FILE_PARAMETER}", env_file.name] \
-                           + docker_arguments[docker_action_index+1:]
+        # When replacing the process, the env file must not be linked into the file system as it would not be removed
+        docker_call = prepare_docker_call(exit_stack, docker_arguments, variables, action_arguments, env_file_backend,
+                                          profiler, anonymous_env_file=replace_process)
 
+        if replace_process:
+            _logger.info("Replacing process with Docker in interactive mode")
+            profiler.write()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execvpe(_DOCKER_BINARY, docker_call.arguments,
+                       docker_call.environment if docker_call.environment is not None else os.environ)
+
+        with profiler.phase(DOCKER_PHASE):
             if interactive:
                 _logger.info("Running Docker in interactive mode")
-                returncode = os.WEXITSTATUS(os.system(" ".join(docker_call)))
-                return returncode, None, None
+                return _run_interactive(docker_call.arguments, docker_call.pass_fds, docker_call.environment), \
+                    None, None
+            else:
+                return _run_docker(docker_call.arguments, stream, tail_size, docker_call.pass_fds,
+                                   docker_call.environment)
+
+
+def prepare_secret_files(exit_stack: ExitStack, variables: Dict[str, str], secret_file_keys: SecretFileKeysType,
+                         profiler: Profiler=NULL_PROFILER, replace_process: bool=False) \
+        -> Tuple[Dict[str, str], List[str]]:
+    """
+    Gives the selected variables to the container as read-only files, which are removed when the given exit stack is
+    closed.
+    :param exit_stack: the exit stack that the files are removed with
+    :param variables: the variables
+    :param secret_file_keys: see `run_wrapped`
+    :param profiler: profiler of the run
+    :param replace_process: whether this process is to be replaced with Docker (the files could then not be removed,
+    so none are created)
+    :return: tuple where the first element is the variables (with those given as files replaced by the files'
+    locations) and the second is the arguments that mount the files, to give to the Docker action
+    """
+    if callable(secret_file_keys):
+        secret_file_keys = secret_file_keys(variables)
+    if replace_process and len(secret_file_keys) > 0:
+        _logger.warning(f"Variables cannot be given as files when replacing the process, so will be set in the "
+                        f"environment: {list(secret_file_keys)}")
+        secret_file_keys = ()
+    files = exit_stack.enter_context(secret_files(variables, secret_file_keys))
+    if len(files) == 0:
+        return variables, []
+    profiler.record("secret_file_count", len(files))
+    return replace_with_file_variables(variables, files), \
+        [argument for file in files for argument in file.get_mount_arguments()]
+
+
+def prepare_env_file(exit_stack: ExitStack, variables: Dict[str, str], env_file_backend: str=DEFAULT_ENV_FILE_BACKEND,
+                     profiler: Profiler=NULL_PROFILER, anonymous: bool=False) -> EnvFile:
+    """
+    Creates an env file containing the given variables, which is removed when the given exit stack is closed.
+    :param exit_stack: the exit stack that the env file is removed with
+    :param variables: the variables
+    :param env_file_backend: see `run_wrapped`
+    :param profiler: profiler of the run
+    :param anonymous: see `envfile.env_file`
+    :return: the env file
+    """
+    with profiler.phase(ENV_FILE_PHASE):
+        docker_env_file = exit_stack.enter_context(env_file(variables, env_file_backend, anonymous=anonymous))
+    profiler.record("variable_bytes", docker_env_file.size)
+    if docker_env_file.reused:
+        profiler.record("env_file_reused", True)
+    return docker_env_file
+
+
+def prepare_docker_call(exit_stack: ExitStack, docker_arguments: List[str], variables: Dict[str, str],
+                        action_arguments: List[str]=(), env_file_backend: str=DEFAULT_ENV_FILE_BACKEND,
+                        profiler: Profiler=NULL_PROFILER, anonymous_env_file: bool=False) -> DockerCall:
+    """
+    Prepares the call to Docker with the given arguments, creating an env file for the variables if the Docker action
+    uses one (see `create_docker_call`), which is removed when the given exit stack is closed.
+    :param exit_stack: the exit stack that the env file is removed with
+    :param docker_arguments: the arguments to pass to Docker
+    :param variables: the variables
+    :param action_arguments: additional arguments to give to the Docker action
+    :param env_file_backend: see `run_wrapped`
+    :param profiler: profiler of the run
+    :param anonymous_env_file: see `envfile.env_file`
+    :return: the Docker call
+    """
+    env_file_location = None
+    pass_fds = ()
+    if uses_env_file(docker_arguments):
+        docker_env_file = prepare_env_file(exit_stack, variables, env_file_backend, profiler, anonymous_env_file)
+        env_file_location = docker_env_file.location
+        pass_fds = docker_env_file.get_inherited_file_descriptors()
+    return DockerCall(arguments=create_docker_call(docker_arguments, env_file_location, variables.keys(),
+                                                   action_arguments),
+                      pass_fds=pass_fds, environment=create_docker_environment(docker_arguments, variables))
+
+
+def create_docker_call(docker_arguments: List[str], env_file_location: Optional[str],
+                       variable_keys: Collection[str]=(), action_arguments: List[str]=()) -> List[str]:
+    """
+    Creates the call to Docker with the given arguments, which gets the variables in the way that the Docker action
+    supports:
+    - `run`, `create` and `exec` use the env file;
+    - `build` gets each variable as a BuildKit secret (with the variable's key as its ID), which can be mounted in a
+      `RUN` instruction without becoming part of the image or invalidating cached layers when its value changes;
+    - `compose up` and `compose run` get the variables from Docker's environment (see `create_docker_environment`), for
+      use in the Compose file, with `compose run` also setting them in the container.
+    :param docker_arguments: the arguments to pass to Docker
+    :param env_file_location: location of the env file (`None` if there is not one)
+    :param variable_keys: keys of the variables, which are in Docker's environment
+    :param action_arguments: additional arguments to give to the Docker action
+    :return: the Docker call
+    """
+    docker_action_index = get_supported_action_index(docker_arguments)
+    if docker_action_index is None:
+        return [_DOCKER_BINARY] + docker_arguments
+
+    docker_action = docker_arguments[docker_action_index]
+    if docker_action in _ENV_FILE_DOCKER_ACTIONS:
+        if env_file_location is None:
+            return [_DOCKER_BINARY] + docker_arguments
+        injected_arguments = [f"--{_DOCKER_ENV_FILE_PARAMETER}", env_file_location]
+    elif docker_action == _BUILD_DOCKER_ACTION:
+        injected_arguments = [argument for key in variable_keys
+                              for argument in (f"--{_DOCKER_SECRET_PARAMETER}", f"id={key},env={key}")]
+    else:
+        docker_action_index = _get_compose_action_index(docker_arguments, docker_action_index)
+        injected_arguments = [argument for key in variable_keys for argument in (f"-{_DOCKER_ENV_PARAMETER}", key)] \
+            if docker_arguments[docker_action_index] == _COMPOSE_RUN_ACTION else []
+
+    return [_DOCKER_BINARY] + docker_arguments[0:docker_action_index+1] + injected_arguments \
+        + list(action_arguments) + docker_arguments[docker_action_index+1:]
+
+
+def create_docker_environment(docker_arguments: List[str], variables: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """
+    Creates the environment that Docker is ran in, which contains the variables if the Docker action gets them from its
+    environment (see `create_docker_call`).
+    :param docker_arguments: the arguments to pass to Docker
+    :param variables: the variables
+    :return: the environment or `None` if Docker is to inherit this process' environment
+    """
+    docker_action_index = get_supported_action_index(docker_arguments)
+    if docker_action_index is None or uses_env_file(docker_arguments):
+        return None
+    environment = dict(os.environ, **variables)
+    if docker_arguments[docker_action_index] == _BUILD_DOCKER_ACTION:
+        environment[_BUILDKIT_ENVIRONMENT_VARIABLE] = "1"
+    return environment
+
+
+def _get_command_index(docker_arguments: List[str], options_with_values: Collection[str], start_index: int=0) \
+        -> Optional[int]:
+    """
+    Gets the index of the first argument that is not an option (or an option's value) in the given arguments.
+    :param docker_arguments: the arguments given to Docker
+    :param options_with_values: the options that take a value as the next argument
+    :param start_index: the index to start looking from
+    :return: the index of the command or `None` if there is not one
+    """
+    index = start_index
+    while index < len(docker_arguments):
+        argument = docker_arguments[index]
+        if not argument.startswith("-"):
+            return index
+        index += 2 if argument in options_with_values else 1
+    return None
+
+
+def _get_compose_action_index(docker_arguments: List[str], docker_action_index: int) -> Optional[int]:
+    """
+    Gets the index of the Compose action (e.g. `up`) in the given arguments.
+    :param docker_arguments: the arguments given to Docker
+    :param docker_action_index: the index of the `compose` action
+    :return: the index of the Compose action or `None` if there is not one
+    """
+    return _get_command_index(docker_arguments, _COMPOSE_OPTIONS_WITH_VALUES, docker_action_index + 1)
+
+
+def _run_with_engine(docker_arguments: List[str], docker_action_index: int, variables: Dict[str, str],
+                     action_arguments: List[str], stream: bool, tail_size: Optional[int]) \
+        -> Optional[ProgramOutputType]:
+    """
+    Runs the given `docker run` call via the Docker Engine API, rather than the Docker CLI, keeping the Docker CLI's
+    exit code and output.
+    :param docker_arguments: the arguments given to Docker
+    :param docker_action_index: the index of the `run` action in the arguments
+    :param variables: the variables to set in the container's environment
+    :param action_arguments: additional arguments to give to `docker run`
+    :param stream: see `run_wrapped`
+    :param tail_size: see `run_wrapped`
+    :return: the output of running the container or `None` if it must be ran using the Docker CLI (e.g. if the
+    arguments are not supported, Docker's global options are given or the image needs to be pulled)
+    """
+    from dockerwithgitlabsecrets.engine import DockerEngineError, get_docker_socket_location, get_engine_client, \
+        parse_run_arguments, read_output_frames, STDOUT_STREAM
+    socket_location = get_docker_socket_location()
+    run_configuration = parse_run_arguments(list(action_arguments) + docker_arguments[docker_action_index + 1:],
+                                            variables) if docker_action_index == 0 else None
+    if socket_location is None or run_configuration is None:
+        _logger.info("Docker call not supported by the Docker Engine API backend: using the Docker CLI")
+        return None
+
+    client = get_engine_client(socket_location)
+    try:
+        container_id = client.create_container(run_configuration.container, run_configuration.name)
+    except (OSError, DockerEngineError) as e:
+        # e.g. the image needs to be pulled, which is left to the Docker CLI
+        _logger.info(f"Could not create container via the Docker Engine API (using the Docker CLI instead): {e}")
+        return None
+
+    stdout: BinaryIO = sys.stdout.buffer if stream else None
+    stderr: BinaryIO = sys.stderr.buffer if stream else None
+    if stream:
+        tails = (OutputTail(tail_size), OutputTail(tail_size)) if tail_size is not None else (None, None)
+    else:
+        tails = (OutputTail(sys.maxsize), OutputTail(sys.maxsize))
+    try:
+        attachment = client.attach_container(container_id)
+        try:
+            try:
+                client.start_container(container_id)
+            except DockerEngineError as e:
+                write_output(f"docker: Error response from daemon: {e.message}.\n".encode(_ENCODING), stderr, tails[1])
+                returncode = _get_start_error_exit_code(e.message)
             else:
-                process = subprocess.Popen(docker_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout, stderr = process.communicate()
-                returncode = process.returncode
+                for stream_type, data in read_output_frames(attachment):
+                    if stream_type == STDOUT_STREAM:
+                        stdout = write_output(data, stdout, tails[0])
+                    else:
+                        stderr = write_output(data, stderr, tails[1])
+                returncode = client.wait_container(container_id)
+        finally:
+            attachment.close()
+    except BaseException:
+        _stop_container(client, container_id)
+        raise
+    finally:
+        if run_configuration.remove:
+            try:
+                client.remove_container(container_id)
+            except (OSError, DockerEngineError) as e:
+                _logger.warning(f"Could not remove container {container_id}: {e}")
 
-    return returncode, stdout.decode(_ENCODING), stderr.decode(_ENCODING)
+    if tails[0] is None:
+        return returncode, None, None
+    return returncode, tails[0].getvalue(), tails[1].getvalue()
+
+
+def write_output(data: bytes, sink: Optional[BinaryIO], tail: Optional[OutputTail]) -> Optional[BinaryIO]:
+    """
+    Writes the given output of Docker (or a container) to the given sink and tail.
+    :param data: the output
+    :param sink: where to forward the output (optional)
+    :param tail: buffer for the end of the output (optional)
+    :return: the sink to write subsequent output to (`None` if the sink can no longer be written to)
+    """
+    if sink is not None:
+        try:
+            sink.write(data)
+            sink.flush()
+        except OSError as e:
+            # Output continues to be written to the tail (and the source drained, so the process does not block on a
+            # full pipe)
+            _logger.warning(f"Could not forward output: {e}")
+            sink = None
+    if tail is not None:
+        tail.write(data)
+    return sink
+
+
+def _get_start_error_exit_code(message: str) -> ReturnCodeType:
+    """
+    Gets the exit code that the Docker CLI exits with when a container fails to start with the given error.
+    :param message: the error message from the Docker Engine
+    :return: the exit code
+    """
+    message = message.lower()
+    if any(error in message for error in _COMMAND_NOT_FOUND_ERRORS):
+        return _COMMAND_NOT_FOUND_EXIT_CODE
+    if any(error in message for error in _COMMAND_NOT_EXECUTABLE_ERRORS):
+        return _COMMAND_NOT_EXECUTABLE_EXIT_CODE
+    return _DOCKER_ERROR_EXIT_CODE
+
+
+def _stop_container(client: "DockerEngineClient", container_id: str):
+    """
+    Kills the given container, if it is running (e.g. because the wrapper has been interrupted).
+    :param client: the Docker Engine client
+    :param container_id: the ID of the container
+    """
+    from dockerwithgitlabsecrets.engine import DockerEngineError
+    try:
+        client.kill_container(container_id)
+    except (OSError, DockerEngineError) as e:
+        _logger.debug(f"Could not kill container {container_id}: {e}")
+
+
+def _run_interactive(docker_call: List[str], pass_fds: Tuple[int, ...]=(), environment: Dict[str, str]=None) \
+        -> ReturnCodeType:
+    """
+    Runs the given Docker call interactively, as a child process that shares this process' terminal and to which the
+    signals this process receives are forwarded.
+    :param docker_call: the Docker call
+    :param pass_fds: file descriptors that Docker is to inherit
+    :param environment: the environment to run Docker in (inherits this process' if `None`)
+    :return: the exit code of Docker (128 + the signal number if Docker was killed by a signal)
+    """
+    process = subprocess.Popen(docker_call, pass_fds=pass_fds, env=environment)
+
+    def forward_signal(signal_number: int, frame):
+        process.send_signal(signal_number)
+
+    previous_handlers = {}
+    if current_thread() is main_thread():
+        for signal_number in _FORWARDED_SIGNALS:
+            previous_handlers[signal_number] = signal.signal(signal_number, forward_signal)
+    try:
+        returncode = process.wait()
+    finally:
+        for signal_number, handler in previous_handlers.items():
+            signal.signal(signal_number, handler)
+
+    return returncode if returncode >= 0 else _SIGNAL_EXIT_CODE_OFFSET - returncode
+
+
+def _run_docker(docker_call: List[str], stream: bool, tail_size: Optional[int], pass_fds: Tuple[int, ...]=(),
+                environment: Dict[str, str]=None) -> ProgramOutputType:
+    """
+    Runs the given (non-interactive) Docker call.
+    :param docker_call: the Docker call
+    :param stream: see `run_wrapped`
+    :param tail_size: see `run_wrapped`
+    :param pass_fds: file descriptors that Docker is to inherit
+    :param environment: the environment to run Docker in (inherits this process' if `None`)
+    :return: the output of running Docker
+    """
+    process = subprocess.Popen(docker_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds,
+                               env=environment)
+    if not stream:
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout.decode(_ENCODING), stderr.decode(_ENCODING)
+
+    stdout_tail, stderr_tail = _forward_output(process, sys.stdout.buffer, sys.stderr.buffer, tail_size)
+    return process.returncode, stdout_tail, stderr_tail
+
+
+def _forward_output(process: subprocess.Popen, stdout: BinaryIO, stderr: BinaryIO, tail_size: Optional[int]) \
+        -> Tuple[Optional[StdOutType], Optional[StdErrType]]:
+    """
+    Forwards the output of the given process to the given streams as it is produced, then waits for it to exit.
+    :param process: the process, with piped stdout and stderr
+    :param stdout: where to write the process' stdout
+    :param stderr: where to write the process' stderr
+    :param tail_size: the maximum number of bytes at the end of each output to return (none returned if `None`)
+    :return: tuple where the first element is the end of stdout and the second is the end of stderr
+    """
+    tails = (OutputTail(tail_size), OutputTail(tail_size)) if tail_size is not None else (None, None)
+    threads = [Thread(target=_pump, args=(process.stdout, stdout, tails[0])),
+               Thread(target=_pump, args=(process.stderr, stderr, tails[1]))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    process.wait()
+
+    if tail_size is None:
+        return None, None
+    return tails[0].getvalue(), tails[1].getvalue()
+
+
+def _pump(source: BinaryIO, sink: BinaryIO, tail: Optional[OutputTail]):
+    """
+    Copies raw bytes from the given source to the given sink until the end of the source is reached.
+    :param source: the source
+    :param sink: the sink
+    :param tail: buffer for the end of the output (optional)
+    """
+    source_file_descriptor = source.fileno()
+    try:
+        while True:
+            data = os.read(source_file_descriptor, STREAM_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            sink = write_output(data, sink, tail)
+    finally:
+        source.close()
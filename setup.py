@@ -18,8 +18,11 @@ setup(
     author="Colin Nolan",
     author_email="colin.nolan@sanger.ac.uk",
     version="2.0.1",
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "benchmarks", "dockerwithgitlabsecrets.testsupport"]),
     install_requires=open("requirements.txt", "r").readlines(),
+    extras_require={
+        "bundle": ["cryptography>=2.0"]
+    },
     url="https://github.com/wtsi-hgi/docker-with-gitlab-secrets",
     license="MIT",
     description="Wraps Docker to run with GitLab build variables",